@@ -0,0 +1,78 @@
+import re
+from typing import Dict, List, Optional
+
+
+class AcronymMatcher:
+    """
+    Compiled multi-pattern matcher for the relative (substring) label mapping.
+
+    All substrings are compiled once into regular expressions, so a label is scanned by the regex engine instead of
+    with one `substring in label` check per acronym. The substrings of a modality are merged into a prefix trie and
+    every modality becomes a named group, in the priority order of the mapping dictionary. A search returns the
+    leftmost match, which is not necessarily the first modality; the label is then only searched again for the
+    modalities with a higher priority than the one found. Usually this ends after one or two scans, and it keeps the
+    first-modality-wins semantics of the plain loop.
+    """
+    def __init__(self, mapping_dict: Dict[str, List[str]]) -> None:
+        """
+        Compile the substrings of the mapping dictionary.
+
+        Args:
+            mapping_dict (Dict[str, List[str]]): Dictionary with the modality names as keys and the lists of substrings
+            as values, as returned by LabelMapper.load_mapping_dict_from_root. The order of the keys is the priority.
+        """
+        self._modalities = list(mapping_dict.keys())
+        groups = []
+        #self._patterns[k] matches any substring of the modalities with a priority lower than k
+        self._patterns = [None]
+        for priority, substrings in enumerate(mapping_dict.values()):
+            if substrings:
+                #Lowercase the substrings (not re.IGNORECASE) so the case folding is identical to str.lower() on the label
+                groups.append(f'(?P<m{priority}>{self._trie_regex([s.lower() for s in substrings])})')
+            self._patterns.append(re.compile('|'.join(groups)) if groups else None)
+
+    @staticmethod
+    def _trie_regex(substrings: List[str]) -> str:
+        """Build a regex alternation of the substrings that shares common prefixes, so the regex engine does
+        not retry every substring at every position of the label."""
+        trie = {}
+        for substring in substrings:
+            node = trie
+            for char in substring:
+                node = node.setdefault(char, {})
+            node[''] = {}                                   #End of substring marker
+
+        def to_regex(node: dict) -> str:
+            #Any substring that ends here is a complete match, so the remainder of the branch does not matter
+            if '' in node:
+                return ''
+            branches = [re.escape(char) + to_regex(child) for char, child in sorted(node.items())]
+            return branches[0] if len(branches) == 1 else f"(?:{'|'.join(branches)})"
+
+        return to_regex(trie)
+
+    def match(self, label: str) -> Optional[str]:
+        """
+        Return the first modality (in mapping dictionary order) with a substring in the label, or None if there is none.
+        The comparison is case-insensitive.
+
+        Args:
+            label (str): The original label from the dataset.
+
+        Returns:
+            Optional[str]: The matched modality or None.
+        """
+        label_lower = label.lower()
+        best = None
+        pattern = self._patterns[-1]
+        while pattern is not None:
+            match = pattern.search(label_lower)
+            if match is None:
+                break
+            best = int(match.lastgroup[1:])
+            pattern = self._patterns[best]                  #Only a higher priority modality can still win
+        return None if best is None else self._modalities[best]
+
+    @property
+    def modalities(self) -> List[str]:
+        return self._modalities
@@ -0,0 +1,204 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+import pandas as pd
+from MetaDataFrameHandler import MetaDataFrameHandler
+from LabelMapper import LabelMapper
+from FileMover import FileMover
+from SSHClientHandler import SSHClientHandler, SSHConnectionPool
+from PipelineRunner import PipelineRunner
+from Instrumentation import Instrumentation
+
+#The label mapper of a worker process, set once by _init_worker
+_worker_label_mapper: Optional[LabelMapper] = None
+
+
+def _init_worker(label_mapper: LabelMapper) -> None:
+    global _worker_label_mapper
+    _worker_label_mapper = label_mapper
+
+
+class BatchProcessor:
+    """
+    Runs the main.py flow (filter the metadata, add the local DICOM root, map the labels) for several datasets, e.g. the
+    prostate and kidney collections, in one process pool instead of one single-core run per dataset.
+
+    The acronyms are loaded and compiled in a LabelMapper of the parent process, which is handed to every worker once,
+    through the pool initializer, instead of with every task. With the fork start method (the default on Linux) the
+    workers inherit the compiled patterns; with spawn or forkserver the mapper is pickled, so every worker recompiles
+    the patterns once (but does not read the acronym files again). The workers return the processed metadata; the files are
+    then migrated by the parent, over one SSH connection pool that is shared by all datasets, since connections can not
+    be shared between processes. A combined summary of the mapped and unmapped labels of all datasets is made as well.
+
+    Example config (YAML):
+        acronym_dir: acronyms
+        operations:                                 #MetaDataFrameHandler operations, before add_root_to_path
+          - filter_by_key: {col: Modality, key: MR}
+          - remove_nan: {cols: [Series Description]}
+        datasets:
+          - name: prostate
+            metadata_file: files/prostate/metadata.csv
+            dicom_root: /data/prostate/dicom_source
+            remote_root: /data/data_for_dds/prostate          #Optional; the files are only migrated if it is given
+          - name: kidney
+            metadata_file: files/kidney/metadata.csv
+            dicom_root: /data/kidney/dicom_source
+    """
+    def __init__(self,
+                 datasets: List[Dict[str, str]],
+                 acronym_dir: Union[str, Path] = Path.cwd() / 'acronyms',
+                 operations: Optional[List[Dict[str, dict]]] = None,
+                 col_path: str = 'File Location',
+                 col_label: str = 'Series Description',
+                 col_uid: str = 'Series UID') -> None:
+        """
+        Args:
+            datasets (List[Dict[str, str]]): The dataset configs, with a name, metadata_file, dicom_root and (optional)
+            remote_root, and optionally an output file for the processed metadata.
+            acronym_dir (Union[str, Path]): The acronym directory of the LabelMapper. Defaults to 'acronyms' in the
+            current working directory.
+            operations (Optional[List[Dict[str, dict]]]): The MetaDataFrameHandler operations applied to every dataset,
+            as {method name: keyword arguments}. Defaults to None, meaning only the MR rows with a label are kept.
+            col_path (str): The column with the file paths. Defaults to 'File Location'.
+            col_label (str): The column with the labels. Defaults to 'Series Description'.
+            col_uid (str): The column with the series UIDs. Defaults to 'Series UID'.
+        """
+        for i, dataset in enumerate(datasets):
+            missing = {'metadata_file', 'dicom_root'}.difference(dataset)
+            if missing:
+                raise ValueError(f'Dataset {i} has no {", ".join(sorted(missing))}')
+            dataset.setdefault('name', Path(dataset['metadata_file']).parent.name or f'dataset_{i}')
+        self._datasets = datasets
+        self._operations = operations if operations is not None else [{'filter_by_key': {'col': 'Modality', 'key': 'MR'}},
+                                                                       {'remove_nan': {'cols': [col_label]}}]
+        self.col_path = col_path
+        self.col_label = col_label
+        self.col_uid = col_uid
+        #Handed to the workers, so they do not load the acronym files themselves (see the class docstring)
+        self._label_mapper = LabelMapper(acronym_dir=acronym_dir)
+        self._results = {}
+        self._summary = None
+
+    @classmethod
+    def from_config(cls, config: Union[str, Path, dict]) -> 'BatchProcessor':
+        """Create a BatchProcessor from a YAML or JSON config file (see the class docstring), or its dict"""
+        config = PipelineRunner.load_config(config) if isinstance(config, (str, Path)) else config
+        kwargs = {key: config[key] for key in ('acronym_dir', 'operations', 'col_path', 'col_label', 'col_uid') if key in config}
+        return cls(datasets=config['datasets'], **kwargs)
+
+    @staticmethod
+    def _process_dataset(dataset: Dict[str, str], operations: List[Dict[str, dict]], col_path: str, col_label: str, col_uid: str) -> tuple:
+        """Process the metadata of one dataset and map its labels, with the label mapper of the worker"""
+        with Instrumentation.span('batch.process_dataset', dataset=dataset['name']) as span:
+            metadata = MetaDataFrameHandler(source=dataset['metadata_file'], col_path=col_path, col_label=col_label,
+                                            col_uid=col_uid, lazy=True)
+            for operation in operations:
+                (name, kwargs), = operation.items()
+                getattr(metadata, name)(**(kwargs or {}))
+            metadata.add_root_to_path(root=dataset['dicom_root'])
+            df = metadata.collect()
+            labels = df[col_label]
+            mapped = _worker_label_mapper.map_labels(labels, save_unmapped=False)
+            #Rows per original label and the label it was mapped to (NaN if unmapped)
+            summary = (pd.DataFrame({'label': labels.to_numpy(), 'mapped_label': mapped.astype(object).to_numpy()})
+                       .groupby(['label', 'mapped_label'], dropna=False, sort=False).size().rename('rows').reset_index())
+            summary.insert(0, 'dataset', dataset['name'])
+            df[col_label] = mapped
+            span.set(rows=len(df))
+        return dataset['name'], df, summary
+
+    def run(self, max_workers: Optional[int] = None) -> Dict[str, pd.DataFrame]:
+        """
+        Process all datasets in a process pool.
+
+        Args:
+            max_workers (Optional[int]): Number of worker processes. Defaults to None, meaning one per dataset, up to
+            the number of CPUs.
+
+        Returns:
+            Dict[str, pd.DataFrame]: The processed metadata (with mapped labels) of every dataset, by name.
+        """
+        max_workers = max_workers or min(len(self._datasets), os.cpu_count() or 1)
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=(self._label_mapper,)) as executor:
+            #Only the dataset configs are sent with the tasks; the label mapper was handed to the workers once
+            process = partial(self._process_dataset, operations=self._operations, col_path=self.col_path,
+                              col_label=self.col_label, col_uid=self.col_uid)
+            results = list(executor.map(process, self._datasets))
+        self._results = {name: df for name, df, _ in results}
+        self._summary = pd.concat([summary for _, _, summary in results], ignore_index=True)
+        for dataset in self._datasets:
+            if dataset.get('output'):
+                MetaDataFrameHandler(source=self._results[dataset['name']]).save_metadata_csv(csv_path=dataset['output'], headers=True)
+        n_unmapped = self._summary['mapped_label'].isna().groupby(self._summary['dataset'], sort=False).sum()
+        for name, n in n_unmapped.items():
+            print(f'{name}: {len(self._results[name])} rows, {n} unmapped labels')
+        return self._results
+
+    def migrate(self,
+                ssh_handler: Optional[SSHClientHandler] = None,
+                max_workers: int = 4,
+                **migrate_kwargs) -> Dict[str, pd.DataFrame]:
+        """
+        Migrate the files of the datasets with a remote_root to the remote, over one connection pool for all datasets,
+        and update their file paths (see FileMover.migrate_files for the other keyword arguments).
+
+        Args:
+            ssh_handler (Optional[SSHClientHandler]): A connected handler. Defaults to None, meaning a new handler is
+            connected (asking for the credentials once for all datasets) and disconnected afterwards.
+            max_workers (int): Number of concurrent uploads, and the size of the connection pool. Defaults to 4.
+
+        Returns:
+            Dict[str, pd.DataFrame]: The processed metadata of every dataset, by name.
+        """
+        if not self._results:
+            raise Exception('Run the batch (run()) before migrating its files')
+        to_migrate = [dataset for dataset in self._datasets if dataset.get('remote_root')]
+        if not to_migrate:
+            return self._results
+        own_handler = ssh_handler is None
+        if own_handler:
+            ssh_handler = SSHClientHandler()
+            ssh_handler.connect_to_remote()
+        try:
+            with SSHConnectionPool(ssh_handler, size=max_workers) as pool:
+                for dataset in to_migrate:
+                    df = self._results[dataset['name']]
+                    file_mover = FileMover(df[self.col_path])
+                    df[self.col_path] = file_mover.migrate_files(dataset['remote_root'], max_workers=max_workers, ssh_handler=ssh_handler,
+                                                                 connection_pool=pool, **migrate_kwargs)
+        finally:
+            if own_handler:
+                ssh_handler.disconnect_from_remote()
+        return self._results
+
+    def save_summary(self, file_path: Union[str, Path] = 'batch_label_summary.csv') -> Union[str, Path]:
+        """Write the combined summary (dataset, label, mapped_label, rows) to a CSV file; unmapped labels have no mapped_label"""
+        self.summary.to_csv(file_path, index=False)
+        return file_path
+
+    @property
+    def summary(self) -> pd.DataFrame:
+        """The rows per dataset, original label and mapped label (NaN for unmapped labels) of the last run"""
+        if self._summary is None:
+            raise Exception('Run the batch (run()) first')
+        return self._summary
+
+    @property
+    def unmapped_labels(self) -> pd.DataFrame:
+        """The unmapped labels of all datasets, with the number of rows per dataset"""
+        return self.summary[self.summary['mapped_label'].isna()].reset_index(drop=True)
+
+    @property
+    def results(self) -> Dict[str, pd.DataFrame]:
+        return self._results
+
+
+# Example usage
+if __name__ == '__main__':
+    import sys
+    batch = BatchProcessor.from_config(sys.argv[1] if len(sys.argv) > 1 else 'batch.yaml')
+    batch.run()
+    batch.save_summary('batch_label_summary.csv')
+    batch.migrate()
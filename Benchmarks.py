@@ -0,0 +1,427 @@
+import argparse
+import datetime
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import string
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Union
+import numpy as np
+import pandas as pd
+from LabelMapper import LabelMapper
+from AcronymMatcher import AcronymMatcher
+from MetaDataFrameHandler import MetaDataFrameHandler
+from FileNamesToLabels import FileNamesToLabels
+from FileMover import FileMover
+from Utils import Utils
+import ReadDicomHeaders
+
+#Typical MR Series Descriptions; synthetic descriptions are variants of these
+SERIES_DESCRIPTIONS = ['t2_tse_tra', 't2_tse_sag', 't2_tse_cor', 'ep2d_diff_b50_400_800_tra', 'ep2d_diff_tra_ADC',
+                       'dwi_b1400', 'Apparent Diffusion Coefficient', 'ep2d_perf', 'PERFUSION', 'localizer',
+                       'AAHead_Scout', 't1_vibe_fs_tra', 'DCE_tra', 'SAG T2 FSE', 'AX DWI 1000']
+
+
+def _time_call(func: Callable, repeat: int = 3) -> float:
+    """Return the best wall-clock time in seconds of `repeat` calls of func"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def _loop_relative_mapping(mapping_dict: Dict[str, List[str]], label: str) -> str:
+    """The substring loop LabelMapper used before the compiled AcronymMatcher; kept as benchmark baseline"""
+    label_lower = label.lower()
+    for main_modality, substrings in mapping_dict.items():
+        if any(substring.lower() in label_lower for substring in substrings):
+            return main_modality
+    return None
+
+
+def _random_word(rng: random.Random, min_len: int = 3, max_len: int = 10) -> str:
+    return ''.join(rng.choices(string.ascii_letters + string.digits, k=rng.randint(min_len, max_len)))
+
+
+def synthetic_mapping_dict(n_modalities: int = 10, n_patterns: int = 1000, seed: int = 0) -> Dict[str, List[str]]:
+    """Random acronym lists, spread over n_modalities modalities with n_patterns substrings in total"""
+    rng = random.Random(seed)
+    mapping_dict = {f'modality_{i}': [] for i in range(n_modalities)}
+    for i in range(n_patterns):
+        mapping_dict[f'modality_{i % n_modalities}'].append(_random_word(rng))
+    return mapping_dict
+
+
+def synthetic_labels(mapping_dict: Dict[str, List[str]], n_labels: int = 10000, hit_rate: float = 0.8, seed: int = 0) -> List[str]:
+    """Series Description-like labels, of which a fraction hit_rate contains one of the substrings of mapping_dict"""
+    rng = random.Random(seed)
+    substrings = [s for values in mapping_dict.values() for s in values]
+    labels = []
+    for _ in range(n_labels):
+        words = [_random_word(rng) for _ in range(rng.randint(1, 4))]
+        if rng.random() < hit_rate:
+            words.insert(rng.randint(0, len(words)), rng.choice(substrings).upper() if rng.random() < 0.5 else rng.choice(substrings))
+        labels.append('_'.join(words))
+    return labels
+
+
+def benchmark_relative_mapping(n_patterns: int = 1000, n_labels: int = 10000, n_modalities: int = 10, seed: int = 0) -> dict:
+    """
+    Compare the compiled AcronymMatcher against the substring loop on synthetic acronyms and labels.
+    Also checks that both return the same modality for every label.
+
+    Returns:
+        dict: Timings in seconds of the loop, the matcher compilation and the matcher, and the speedup.
+    """
+    mapping_dict = synthetic_mapping_dict(n_modalities, n_patterns, seed)
+    labels = synthetic_labels(mapping_dict, n_labels, seed=seed)
+
+    compile_time = _time_call(lambda: AcronymMatcher(mapping_dict), repeat=1)
+    matcher = AcronymMatcher(mapping_dict)
+    loop_results = [_loop_relative_mapping(mapping_dict, label) for label in labels]
+    matcher_results = [matcher.match(label) for label in labels]
+    if loop_results != matcher_results:
+        raise AssertionError('AcronymMatcher and the substring loop disagree on the mapped modalities')
+
+    loop_time = _time_call(lambda: [_loop_relative_mapping(mapping_dict, label) for label in labels])
+    matcher_time = _time_call(lambda: [matcher.match(label) for label in labels])
+    return {'n_patterns': n_patterns,
+            'n_labels': n_labels,
+            'loop_s': loop_time,
+            'matcher_compile_s': compile_time,
+            'matcher_s': matcher_time,
+            'speedup': loop_time / matcher_time}
+
+
+def synthetic_metadata_csv(csv_path: Union[str, Path], n_rows: int = 100000, n_descriptions: int = 2000, seed: int = 0) -> Path:
+    """
+    Write a synthetic TCIA-style metadata.csv with n_rows series. The Series Descriptions are n_descriptions variants
+    of SERIES_DESCRIPTIONS with a Zipf-like frequency, so a few descriptions cover most rows, as in real collections.
+
+    Returns:
+        Path: The path of the csv
+    """
+    rng = np.random.default_rng(seed)
+    variants = [f'{SERIES_DESCRIPTIONS[i % len(SERIES_DESCRIPTIONS)]}{"" if i < len(SERIES_DESCRIPTIONS) else f"_{i}"}'
+                for i in range(n_descriptions)]
+    frequencies = 1 / np.arange(1, n_descriptions + 1) ** 1.1
+    descriptions = np.array(variants, dtype=object)[rng.choice(n_descriptions, size=n_rows, p=frequencies / frequencies.sum())]
+    descriptions[rng.random(n_rows) < 0.01] = None                          #Some series have no description
+    subjects = rng.integers(0, max(1, n_rows // 20), size=n_rows)
+    rows = np.arange(n_rows)
+    metadata = pd.DataFrame({
+        'Series UID': [f'1.3.6.1.4.1.14519.5.2.1.{i}' for i in rows],
+        'Collection': 'SYNTHETIC',
+        'Subject ID': [f'SYN-{s:06d}' for s in subjects],
+        'Study Description': 'MRI PROSTATE',
+        'Series Description': descriptions,
+        'Manufacturer': rng.choice(['SIEMENS', 'GE MEDICAL SYSTEMS', 'Philips'], size=n_rows),
+        'Modality': rng.choice(['MR', 'CT', 'SEG', 'SR'], size=n_rows, p=[0.7, 0.15, 0.1, 0.05]),
+        'Number of Images': rng.integers(1, 200, size=n_rows),
+        'File Location': [f'./SYNTHETIC/SYN-{s:06d}/study/{i}.000000-series' for s, i in zip(subjects, rows)],
+    })
+    metadata.to_csv(csv_path, index=False)
+    return Path(csv_path)
+
+
+def _run_main_pipeline(metadata_file: str, shallow_copies: bool) -> int:
+    """Run the main.py pipeline on a metadata file in a scratch directory and return the peak RSS in bytes"""
+    MetaDataFrameHandler.SHALLOW_COPIES = shallow_copies
+    acronym_dir = Path(__file__).resolve().parent / 'acronyms'
+    with tempfile.TemporaryDirectory() as scratch_dir:
+        os.chdir(scratch_dir)                           #map_labels writes its unmapped labels to the working directory
+        metadata = MetaDataFrameHandler(source=metadata_file)
+        metadata.filter_by_key(col='Modality', key='MR')
+        metadata.remove_nan(cols=['Series Description'])
+        metadata.add_root_to_path(root='/data/dicom_source')
+        metadata.save_metadata_csv(headers=True)
+        metadata_info = metadata.processed_metadata
+        labelMapper = LabelMapper(acronym_dir=acronym_dir)
+        metadata_info['Series Description'] = labelMapper.map_labels(metadata_info['Series Description'])
+    return _peak_rss()
+
+
+def _peak_rss() -> int:
+    """
+    Peak RSS of the current process in bytes. On Linux this is VmHWM, which (unlike ru_maxrss) is reset when a spawned
+    process executes, so it does not include the memory of the parent process.
+    """
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024          #ru_maxrss is in kilobytes on Linux
+
+
+def benchmark_pipeline_memory(n_rows: int = 1000000) -> dict:
+    """
+    Measure the peak RSS of the main.py pipeline on a synthetic metadata.csv, with deep copies of the metadata (as the
+    handler made before it used copy-on-write views) and with shallow copies. Every run uses a fresh process.
+
+    Returns:
+        dict: The peak RSS in MB of an idle worker process and of both pipeline runs.
+    """
+    context = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as data_dir:
+        metadata_file = str(synthetic_metadata_csv(Path(data_dir) / 'metadata.csv', n_rows))
+        results = {'n_rows': n_rows}
+        runs = {'baseline_mb': (_peak_rss,),
+                'deep_copies_mb': (_run_main_pipeline, metadata_file, False),
+                'copy_on_write_mb': (_run_main_pipeline, metadata_file, True)}
+        for name, (func, *args) in runs.items():
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                results[name] = executor.submit(func, *args).result() / 2 ** 20
+    return results
+
+
+def synthetic_dicom_tree(dicom_root: Union[str, Path], 
+                         n_series: int = 20, 
+                         n_slices: int = 10, 
+                         n_subjects: int = 5, 
+                         seed: int = 0) -> List[str]:
+    """
+    Write a synthetic TCIA-style DICOM tree (<subject>/<study>/<series>/1-<i>.dcm) of small MR images with pydicom.
+    The Series Descriptions are drawn from SERIES_DESCRIPTIONS.
+
+    Returns:
+        List[str]: The paths of the DICOM files
+    """
+    from pydicom.dataset import Dataset, FileMetaDataset
+    from pydicom.sequence import Sequence
+    from pydicom.uid import ExplicitVRLittleEndian, MRImageStorage, generate_uid
+    rng = random.Random(seed)
+    pixels = np.zeros((16, 16), dtype=np.uint16).tobytes()
+    dicom_files = []
+    for s in range(n_series):
+        subject = f'SYN-{s % n_subjects:04d}'
+        description = rng.choice(SERIES_DESCRIPTIONS)
+        series_dir = Path(dicom_root) / subject / '01-01-2000-NA-MRI PROSTATE-00001' / f'{s}.000000-{description}-{s:05d}'
+        series_dir.mkdir(parents=True, exist_ok=True)
+        series_uid, study_uid = generate_uid(), generate_uid()
+        for i in range(n_slices):
+            file_meta = FileMetaDataset()
+            file_meta.MediaStorageSOPClassUID = MRImageStorage
+            file_meta.MediaStorageSOPInstanceUID = generate_uid()
+            file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+            ds = Dataset()
+            ds.file_meta = file_meta
+            ds.SOPClassUID, ds.SOPInstanceUID = MRImageStorage, file_meta.MediaStorageSOPInstanceUID
+            ds.PatientID, ds.StudyInstanceUID, ds.SeriesInstanceUID = subject, study_uid, series_uid
+            ds.Modality, ds.Manufacturer, ds.StudyDescription = 'MR', 'SIEMENS', 'MRI PROSTATE'
+            ds.SeriesDescription, ds.InstanceNumber = description, i + 1
+            ds.SpecificCharacterSet, ds.SequenceName = 'ISO_IR 100', '*tse2d1_25'
+            #A nested sequence before the series tags, as in most scanner output
+            reference = Dataset()
+            reference.ReferencedSOPClassUID, reference.ReferencedSOPInstanceUID = MRImageStorage, generate_uid()
+            ds.ReferencedImageSequence = Sequence([reference])
+            ds['ReferencedImageSequence'].is_undefined_length = reference.is_undefined_length_sequence_item = True
+            ds.Rows = ds.Columns = 16
+            ds.BitsAllocated, ds.BitsStored, ds.HighBit, ds.PixelRepresentation = 16, 16, 15, 0
+            ds.SamplesPerPixel, ds.PhotometricInterpretation = 1, 'MONOCHROME2'
+            ds.PixelData = pixels
+            dicom_file = series_dir / f'1-{i + 1}.dcm'
+            ds.save_as(dicom_file, enforce_file_format=True)
+            dicom_files.append(str(dicom_file))
+    return dicom_files
+
+
+def benchmark_dicom_tag_reader(n_series: int = 20, n_slices: int = 20, n_implicit: int = 5) -> dict:
+    """
+    Compare ReadDicomHeaders.read_dicom_tags_fast against read_dicom_tags on a synthetic DICOM tree. n_implicit files
+    are rewritten with the implicit VR transfer syntax, so the cost of the pydicom fallback is included. The
+    equivalence of both readers is checked in tests/test_read_dicom_headers.py.
+
+    Returns:
+        dict: Timings in seconds of both readers (serially, one file at a time) and the speedup.
+    """
+    import pydicom
+    from pydicom.uid import ImplicitVRLittleEndian
+    tags = {**ReadDicomHeaders.METADATA_TAGS, 'Sequence Name': 'SequenceName', 'Instance Number': 'InstanceNumber'}
+    with tempfile.TemporaryDirectory() as scratch_dir:
+        dicom_files = synthetic_dicom_tree(scratch_dir, n_series, n_slices)
+        for dicom_file in dicom_files[:n_implicit]:
+            ds = pydicom.dcmread(dicom_file)
+            ds.file_meta.TransferSyntaxUID = ImplicitVRLittleEndian
+            ds.save_as(dicom_file, implicit_vr=True, little_endian=True, enforce_file_format=True)
+
+        pydicom_time = _time_call(lambda: [ReadDicomHeaders.read_dicom_tags(dicom_file, tags) for dicom_file in dicom_files])
+        fast_time = _time_call(lambda: [ReadDicomHeaders.read_dicom_tags_fast(dicom_file, tags) for dicom_file in dicom_files])
+    return {'n_files': len(dicom_files),
+            'n_implicit_vr': n_implicit,
+            'pydicom_s': pydicom_time,
+            'fast_s': fast_time,
+            'speedup': pydicom_time / fast_time}
+
+
+def synthetic_label_tree(root: Union[str, Path], n_cases: int = 1000, suffixes: List[str] = ['t2w', 'hbv', 'adc', 'cor', 'sag']) -> Path:
+    """Write an empty PI-CAI-style tree (<fold>/<case>/<case>_<study>_<suffix>.mha) for FileNamesToLabels"""
+    for case in range(n_cases):
+        case_dir = Path(root) / f'fold{case % 5}' / f'{10000 + case}'
+        case_dir.mkdir(parents=True, exist_ok=True)
+        for suffix in suffixes:
+            (case_dir / f'{10000 + case}_{1000000 + case}_{suffix}.mha').touch()
+    return Path(root)
+
+
+def _reset_peak_rss() -> bool:
+    """Reset the peak RSS (VmHWM) of the current process to the current RSS; only possible on Linux"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _rss() -> int:
+    """Current RSS of the process in bytes (0 if unknown)"""
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def _profile_stage(results: dict, name: str, func: Callable, items: Optional[int] = None):
+    """
+    Run one stage, record its wall-clock time, the growth of the peak RSS during the stage (None where the peak cannot
+    be reset) and the throughput in items per second, and return the result of the stage.
+    """
+    can_reset = _reset_peak_rss()
+    rss_before = _rss()
+    start = time.perf_counter()
+    result = func()
+    seconds = time.perf_counter() - start
+    results[name] = {'seconds': seconds,
+                     'peak_rss_increase_mb': (_peak_rss() - rss_before) / 2 ** 20 if can_reset else None,
+                     'items': items,
+                     'items_per_second': items / seconds if items and seconds > 0 else None}
+    print(f'{name}: {seconds:.3f} s')
+    return result
+
+
+def benchmark_pipeline_stages(n_rows: int = 100000,
+                              n_dicom_series: int = 50,
+                              n_slices: int = 20,
+                              n_label_cases: int = 2000,
+                              workers: Optional[int] = None) -> dict:
+    """
+    Time and memory-profile every stage of the pipeline on synthetic data in a scratch directory:
+    MetaDataFrameHandler loading and filtering, LabelMapper.map_labels, ReadDicomHeaders.scan_dicom_root (all headers
+    and one per series), FileNamesToLabels and FileMover.move_files_locally.
+
+    Args:
+        n_rows (int): Rows of the synthetic metadata.csv. Defaults to 100000.
+        n_dicom_series (int): Series in the synthetic DICOM tree. Defaults to 50.
+        n_slices (int): DICOM files per series. Defaults to 20.
+        n_label_cases (int): Cases (of 5 files each) in the synthetic FileNamesToLabels tree. Defaults to 2000.
+        workers (Optional[int]): Worker processes of scan_dicom_root. Defaults to None, meaning the number of CPUs.
+
+    Returns:
+        dict: Per stage the time in seconds, the peak RSS increase in MB, the number of items and the throughput.
+    """
+    acronym_dir = Path(__file__).resolve().parent / 'acronyms'
+    stages = {}
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as scratch_dir:
+        scratch_dir = Path(scratch_dir)
+        os.chdir(scratch_dir)                           #map_labels writes its unmapped labels to the working directory
+        try:
+            metadata_file = synthetic_metadata_csv(scratch_dir / 'metadata.csv', n_rows)
+            dicom_files = synthetic_dicom_tree(scratch_dir / 'dicom', n_dicom_series, n_slices)
+            synthetic_label_tree(scratch_dir / 'labels', n_label_cases)
+
+            metadata = _profile_stage(stages, 'metadata_load', lambda: MetaDataFrameHandler(source=metadata_file), n_rows)
+            def filter_metadata():
+                metadata.filter_by_key(col='Modality', key='MR')
+                metadata.remove_nan(cols=['Series Description'])
+                return metadata.add_root_to_path(root='/data/dicom_source')
+            metadata_info = _profile_stage(stages, 'metadata_filter', filter_metadata, n_rows)
+            label_mapper = LabelMapper(acronym_dir=acronym_dir)
+            _profile_stage(stages, 'map_labels', lambda: label_mapper.map_labels(metadata_info['Series Description']), len(metadata_info))
+            _profile_stage(stages, 'read_dicom_headers', 
+                           lambda: ReadDicomHeaders.scan_dicom_root(scratch_dir / 'dicom', workers=workers), len(dicom_files))
+            _profile_stage(stages, 'read_dicom_headers_fast',
+                           lambda: ReadDicomHeaders.scan_dicom_root(scratch_dir / 'dicom', workers=workers, fast=True), len(dicom_files))
+            _profile_stage(stages, 'read_dicom_headers_per_series',
+                           lambda: ReadDicomHeaders.scan_dicom_root(scratch_dir / 'dicom', workers=workers, sample_series='directory'), len(dicom_files))
+            _profile_stage(stages, 'file_names_to_labels',
+                           lambda: FileNamesToLabels(scratch_dir / 'labels', 'mha', {'t2w': 't2w', 'hbv': 'hbv', 'adc': 'adc'}).filenames_to_labels_df(),
+                           5 * n_label_cases)
+            _profile_stage(stages, 'file_mover_local',
+                           lambda: FileMover(dicom_files).move_files_locally(scratch_dir / 'moved', source_root=scratch_dir / 'dicom'),
+                           len(dicom_files))
+        finally:
+            os.chdir(cwd)
+    return stages
+
+
+def benchmark_environment() -> dict:
+    """The versions and hardware the benchmarks ran on, so results of different machines are not compared blindly"""
+    return {'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__}
+
+
+def run_benchmark_suite(rows: List[int] = [10000, 100000, 1000000],
+                        output_json: Union[str, Path] = 'benchmark_results.json',
+                        n_dicom_series: int = 50,
+                        n_slices: int = 20,
+                        n_label_cases: int = 2000,
+                        micro: bool = True) -> dict:
+    """
+    Run the pipeline stage benchmark for every metadata size in rows and (optionally) the relative mapping and
+    pipeline memory benchmarks, and write all results to a JSON file, so regressions can be tracked over time.
+
+    Args:
+        rows (List[int]): The sizes of the synthetic metadata.csv, e.g. 10k up to 10M rows.
+        output_json (Union[str, Path]): Path of the JSON file with the results. Defaults to 'benchmark_results.json'.
+        n_dicom_series (int): Series in the synthetic DICOM tree. Defaults to 50.
+        n_slices (int): DICOM files per series. Defaults to 20.
+        n_label_cases (int): Cases in the synthetic FileNamesToLabels tree. Defaults to 2000.
+        micro (bool): Whether to also run benchmark_relative_mapping, benchmark_pipeline_memory and
+        benchmark_dicom_tag_reader. Defaults to True.
+
+    Returns:
+        dict: The results, as written to output_json.
+    """
+    results = {'environment': benchmark_environment(), 'pipeline_stages': []}
+    for n_rows in rows:
+        print(f'Pipeline stages with {n_rows} metadata rows')
+        stages = benchmark_pipeline_stages(n_rows, n_dicom_series, n_slices, n_label_cases)
+        results['pipeline_stages'].append({'n_rows': n_rows, 'stages': stages})
+    if micro:
+        results['relative_mapping'] = [benchmark_relative_mapping(n_patterns=n_patterns) for n_patterns in [10, 100, 1000, 5000]]
+        results['pipeline_memory'] = benchmark_pipeline_memory(n_rows=max(rows))
+        results['dicom_tag_reader'] = benchmark_dicom_tag_reader(n_dicom_series, n_slices)
+    Utils.write_json(output_json, results)
+    print(f'Benchmark results written to {output_json}')
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the DataMapper pipeline on synthetic data')
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000, 1000000], help='sizes of the synthetic metadata.csv')
+    parser.add_argument('--dicom-series', type=int, default=50, help='series in the synthetic DICOM tree')
+    parser.add_argument('--slices', type=int, default=20, help='DICOM files per series')
+    parser.add_argument('--label-cases', type=int, default=2000, help='cases in the synthetic FileNamesToLabels tree')
+    parser.add_argument('--no-micro', action='store_true', help='skip the relative mapping, pipeline memory and DICOM tag reader benchmarks')
+    parser.add_argument('--output', default='benchmark_results.json', help='path of the JSON file with the results')
+    args = parser.parse_args()
+    run_benchmark_suite(args.rows, args.output, args.dicom_series, args.slices, args.label_cases, micro=not args.no_micro)
@@ -1,12 +1,20 @@
-from pathlib import Path
-from typing import List, Union
-from SSHClientHandler import SSHClientHandler
-from scp import SCPClient
+from pathlib import Path, PurePosixPath
+from typing import List, Optional, Union
+from concurrent.futures import ThreadPoolExecutor
+from SSHClientHandler import SSHClientHandler, SSHConnectionPool
+from TransferManifest import TransferManifest
+from Instrumentation import Instrumentation
+import errno
+import os
+import shlex
 import shutil
+import tarfile
+import time
 
 class FileMover:
     def __init__(self, filepaths: List[Union[str, Path]]):
         self._filepaths = filepaths
+        self._errors = [None] * len(filepaths)
         
     @staticmethod
     def _ensure_root(path):
@@ -19,67 +27,354 @@ class FileMover:
         path.mkdir(parents=True, exist_ok=True)
         return path
         
-    def move_files_locally(self, target_root: Union[str, Path] = Path.cwd() / 'moved_files') -> List[Path]:
+    def move_files_locally(self, 
+                           target_root: Union[str, Path] = Path.cwd() / 'moved_files',
+                           max_workers: int = 8,
+                           source_root: Optional[Union[str, Path]] = None,
+                           keep_tree: bool = True) -> List[Optional[Path]]:
         """
-        Locally move the files in the filepaths list to a target root directory. 
-        The target root directory is created if it does not exist.
+        Locally move the files in the filepaths list to a target root directory, with a pool of max_workers threads.
+        The target root directory is created if it does not exist. Files (or directories) are renamed when the target
+        is on the same filesystem, and copied and then removed when it is not. Existing files are never overwritten.
 
         Args:
             target_root (Union[str, Path]): The root directory to move the files to. 
             Defaults to a subdirectory 'moved_files' in the current working directory.
+            max_workers (int): Number of files moved concurrently. Defaults to 8.
+            source_root (Optional[Union[str, Path]]): Root of the directory structure that is kept under target_root.
+            Defaults to None, meaning the deepest common directory of all files.
+            keep_tree (bool): Whether to keep the directory structure relative to source_root, so files with the same
+            name in different directories (e.g. the 1-1.dcm of every series) do not collide. If False, all files
+            are moved directly into target_root, and files with the same name raise a ValueError before anything is
+            moved. Defaults to True.
 
         Returns:
-            List[Path]: A list of the new file paths after moving the files.
+            List[Optional[Path]]: The new file paths, in the order of the input; None for files that could not be moved.
+            The errors are available, in the same order, through the errors property.
         """        
+        filepaths = [Path(file) for file in self._filepaths]
+        if keep_tree and source_root is None:
+            source_root = self._common_root(filepaths)
+        if not isinstance(target_root, (str, Path)):
+            raise ValueError(f'target_root must be a string or a Path object, but is {type(target_root)}')
+        #Files that would end up at the same destination would overwrite each other, so nothing is moved then
+        destinations = [self._remote_path(file, target_root, source_root, keep_tree) for file in filepaths]
+        self._reject_collisions(filepaths, destinations)
         #Ensure we have a valied path to the root and create a dir if it does not exist yet
         target_root = self._ensure_root(target_root)
-        #Placeholder new filepaths
-        new_filepaths = []
-        #Move the files to the target root directory and update the filepaths
-        for file in self._filepaths:
-            try:
-                new_filepaths.append(shutil.move(file, target_root))
-            except Exception as e:
-                print(f'Error moving file: {e}')
+        
+        def move(item: tuple) -> Path:
+            file, destination = item
+            if destination is None:
+                raise ValueError(f'{file} is not inside the source root {source_root}')
+            return self._move_file(file, Path(destination))
+        
+        #Move the files to the target root directory; the results line up with the input filepaths
+        with Instrumentation.span('file_mover.move_files_locally', files=len(filepaths)):
+            new_filepaths, errors = self._run_concurrently(move, list(zip(filepaths, destinations)), max_workers)
+        Instrumentation.count('files_moved', sum(error is None for error in errors))
+        for file, error in zip(filepaths, errors):
+            if error is not None:
+                print(f'Error moving file {file}: {error}')
         #Update the filepaths
         self._filepaths = new_filepaths
+        self._errors = errors
         return new_filepaths
+
+    @staticmethod
+    def _common_root(filepaths: List[Path]) -> Optional[Path]:
+        """The deepest common directory of the files, or None if there are no files"""
+        return Path(os.path.commonpath([file.resolve().parent for file in filepaths])) if filepaths else None
+
+    @staticmethod
+    def _relative_path(file: Path, source_root: Optional[Path], keep_tree: bool) -> PurePosixPath:
+        """The path of a file relative to source_root, or just its name if the tree is not kept"""
+        if not keep_tree:
+            return PurePosixPath(file.name)
+        return PurePosixPath(file.resolve().relative_to(Path(source_root).resolve()).as_posix())
+
+    @staticmethod
+    def _reject_collisions(filepaths: List[Path], destinations: List[Optional[PurePosixPath]]) -> None:
+        """Raise a ValueError if different files would end up at the same destination, where they would overwrite each other"""
+        seen = {}
+        for file, destination in zip(filepaths, destinations):
+            if destination is not None and seen.setdefault(destination, file) != file:
+                raise ValueError(f'{seen[destination]} and {file} would both be moved to {destination}; use keep_tree=True')
+
+    @staticmethod
+    def _move_file(file: Path, destination: Path) -> Path:
+        """
+        Move a file (or directory) with os.rename, or with shutil.move (copy and remove) if the destination is on
+        another filesystem. The destinations of a batch are unique (see _reject_collisions), so the existence check
+        only guards against files that were already there.
+        """
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        if os.path.lexists(destination):
+            raise FileExistsError(f'Destination path {destination} already exists')
+        try:
+            os.rename(file, destination)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            shutil.move(str(file), str(destination))
+        return destination
+
+    @staticmethod
+    def _run_concurrently(func, items: list, max_workers: int) -> tuple:
+        """
+        Call func on every item with a thread pool.
+
+        Returns:
+            tuple: The list of results and the list of exceptions, both in the order of the items
+            (None as result for failed items, None as exception for the others).
+        """
+        def call(item):
+            try:
+                return func(item), None
+            except Exception as e:
+                return None, e
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            outcomes = list(executor.map(call, items))
+        return [result for result, _ in outcomes], [error for _, error in outcomes]
     
 
-    def migrate_files(self, target_root: Union[str, Path]):
+    def migrate_files(self, 
+                      target_root: Union[str, Path],
+                      max_workers: int = 4,
+                      ssh_handler: Optional[SSHClientHandler] = None,
+                      bulk: bool = False,
+                      compression: Optional[str] = None,
+                      source_root: Optional[Union[str, Path]] = None,
+                      keep_tree: bool = True,
+                      manifest: Optional[TransferManifest] = None,
+                      verify: str = 'size',
+                      connection_pool: Optional[SSHConnectionPool] = None) -> List[Optional[Path]]:
         '''
-        Migrate the files in the filepaths list to a remote server using the given credentials.
+        Migrate the files in the filepaths list to a remote server, uploading max_workers files concurrently over a pool
+        of SSH connections (see SSHConnectionPool). The credentials are only asked for once for the whole batch.
+        
+        In bulk mode, the files are instead streamed as a single tar archive over one SSH channel and extracted remotely
+        with `tar -x`, which avoids a round trip per file for series of many small DICOM files. The directory structure
+        relative to source_root is kept under target_root.
         
         Args:
             target_root (Union[str, Path]): root directory of the target folder on the remote server (Path object or string)
-            hostname (str): hostname of the remote server
-            username (str): username to connect to the remote server
-            password (str): password to connect to the remote server
+            max_workers (int): number of concurrent uploads, each over its own connection. Defaults to 4.
+            ssh_handler (Optional[SSHClientHandler]): a connected handler to use. Defaults to None, meaning a new handler
+            is connected (asking for the credentials) and disconnected afterwards.
+            bulk (bool): whether to stream the files as one tar archive. Defaults to False.
+            compression (Optional[str]): compression of the tar stream in bulk mode: None, 'gz' or 'zst' (needs the
+            zstandard package locally and zstd on the remote). Defaults to None.
+            source_root (Optional[Union[str, Path]]): root of the directory structure that is kept in bulk mode or with
+            keep_tree. Defaults to None, meaning the deepest common directory of all files.
+            keep_tree (bool): whether to keep the directory structure relative to source_root when uploading file by file
+            (bulk mode always keeps it). The remote directories are created with one batched remote command. Defaults to
+            True, like move_files_locally. If False, all files are uploaded directly into target_root, and files with the
+            same name raise a ValueError before anything is uploaded.
+            manifest (Optional[TransferManifest]): journal of transferred files. If given, files that are already
+            present on the remote (checked with one batched remote call) are skipped and every completed transfer is
+            recorded, so an interrupted migration resumes where it stopped. Defaults to None.
+            verify (str): how the manifest decides that a file is already present: 'size' or 'sha256'. Defaults to 'size'.
+            connection_pool (Optional[SSHConnectionPool]): a pool of connections of ssh_handler to upload over, e.g. one
+            that is shared by the migrations of several datasets. Defaults to None, meaning a pool is opened for this
+            migration and closed afterwards.
             
         Returns:
-            List[Path]: A list of the new file paths after moving the files.
+            List[Optional[Path]]: The new (remote) file paths, in the order of the input; None for files that could not be migrated.
         '''
-        ssh_handler = SSHClientHandler()
-        ssh_handler.connect_to_remote()
-        ssh_handler.ensure_remote_dir(target_root)
-        ssh_client = ssh_handler.ssh
-        #Placeholder new filepaths
-        new_filepaths = []
+        filepaths = [Path(file) for file in self._filepaths]
+        keep_tree = keep_tree or bulk
+        if keep_tree and source_root is None:
+            source_root = self._common_root(filepaths)
+        #Files that would end up at the same remote path would silently overwrite each other (concurrently)
+        remote_paths = [self._remote_path(file, target_root, source_root, keep_tree) for file in filepaths]
+        self._reject_collisions(filepaths, remote_paths)
+
+        own_handler = ssh_handler is None
+        if own_handler:
+            ssh_handler = SSHClientHandler()
+            ssh_handler.connect_to_remote()
+        ssh_handler.ensure_remote_dirs([str(target_root)])                 #Created without asking, so unattended runs do not block
+
+        #Skip the files that are already on the remote
+        present = [False] * len(filepaths)
+        if manifest is not None:
+            present = manifest.already_transferred(ssh_handler, filepaths, remote_paths, verify=verify)
+            print(f'{sum(present)} of {len(filepaths)} files are already present on the remote')
+        to_migrate = [file for file, p in zip(filepaths, present) if not p]
         
-        #Migrate the files to the target root directory and update the filepaths
-        with SCPClient(ssh_client.get_transport()) as scp:
-            for file in self._filepaths:
+        start = time.perf_counter()
+        with Instrumentation.span('file_mover.migrate_files', files=len(to_migrate), bulk=bulk, compression=compression) as span:
+            if bulk:
+                migrated, migrate_errors = self._migrate_tar_stream(ssh_handler, to_migrate, target_root, compression, source_root)
+                if manifest is not None:
+                    for file, remote_path in zip(to_migrate, migrated):
+                        if remote_path is not None:
+                            manifest.record(file, remote_path)
+            else:
+                def upload(file: Path) -> Path:
+                    remote_path = self._remote_path(file, target_root, source_root, keep_tree)
+                    if remote_path is None:
+                        raise ValueError(f'{file} is not inside the source root {source_root}')
+                    with pool.sftp() as sftp:
+                        sftp.put(str(file), str(remote_path))
+                    if manifest is not None:
+                        manifest.record(file, remote_path, manifest.local_sha256(file) if verify == 'sha256' else None)
+                    return Path(remote_path)
+            
+                if keep_tree:
+                    remote_paths = [self._remote_path(file, target_root, source_root, keep_tree) for file in to_migrate]
+                    created = ssh_handler.ensure_remote_dirs({path.parent for path in remote_paths if path is not None})
+                    print(f'Created {len(created)} remote directories')
+                #Migrate the files to the target root directory; the results line up with to_migrate
+                pool = connection_pool or SSHConnectionPool(ssh_handler, size=min(max_workers, max(1, len(to_migrate))))
                 try:
-                    scp.put(str(file), str(target_root))            #Convert paths to str to ensure SCP compatibility
-                    new_filepaths.append(Path(target_root) / Path(file.name))
-                except Exception as e:
-                    print(f'Error migrating file: {e}')
-                    new_filepaths.append(None)
+                    migrated, migrate_errors = self._run_concurrently(upload, to_migrate, max_workers)
+                finally:
+                    if connection_pool is None:
+                        pool.close()
+            if Instrumentation.enabled():
+                transferred = [file for file, remote_path in zip(to_migrate, migrated) if remote_path is not None]
+                n_bytes = sum(os.path.getsize(file) for file in transferred)
+                span.set(files_transferred=len(transferred), bytes_transferred=n_bytes)
+                Instrumentation.count('files_transferred', len(transferred))
+                Instrumentation.count('bytes_transferred', n_bytes)
+                Instrumentation.count('files_skipped', len(filepaths) - len(to_migrate))
+                Instrumentation.throughput('transfer_bytes_per_second', n_bytes, time.perf_counter() - start)
+
+        #Merge the migrated and the skipped files, in the order of the input filepaths
+        migrated, migrate_errors = iter(migrated), iter(migrate_errors)
+        new_filepaths, errors = [], []
+        for file, p in zip(filepaths, present):
+            new_filepaths.append(Path(self._remote_path(file, target_root, source_root, keep_tree)) if p else next(migrated))
+            errors.append(None if p else next(migrate_errors))
+        for file, error in zip(filepaths, errors):
+            if error is not None:
+                print(f'Error migrating file {file}: {error}')
         #Update the filepaths
         self._filepaths = new_filepaths
-        ssh_handler.disconnect_from_remote()
+        self._errors = errors
+        if own_handler:
+            ssh_handler.disconnect_from_remote()
         return new_filepaths
+
+    @classmethod
+    def _remote_path(cls, file: Path, target_root: Union[str, Path], source_root: Optional[Path], keep_tree: bool) -> Optional[PurePosixPath]:
+        """The path of a file under target_root (on the remote or locally), or None if it is outside source_root"""
+        try:
+            return PurePosixPath(target_root) / cls._relative_path(file, source_root, keep_tree)
+        except ValueError:
+            return None
+
+    #Remote commands that extract a tar stream from stdin, per compression
+    _TAR_EXTRACT_COMMANDS = {None: 'tar -xf -', 'gz': 'tar -xzf -', 'zst': 'zstd -dc | tar -xf -'}
+
+    def _migrate_tar_stream(self, 
+                            ssh_handler: SSHClientHandler, 
+                            filepaths: List[Path], 
+                            target_root: Union[str, Path],
+                            compression: Optional[str], 
+                            source_root: Optional[Union[str, Path]]) -> tuple:
+        """
+        Stream the files as a tar archive over one SSH channel into `tar -x` in target_root on the remote. Directories
+        are added with all files below them; symbolic links are followed, and anything that is not a regular file or
+        a directory (e.g. a FIFO or socket) is reported as an error of its path. If the channel breaks off, e.g.
+        because the remote tar died, the files that were not sent are reported as failed.
+
+        Returns:
+            tuple: The list of remote paths and the list of errors, both in the order of filepaths.
+        """
+        if compression not in self._TAR_EXTRACT_COMMANDS:
+            raise ValueError(f"compression must be None, 'gz' or 'zst', not {compression}")
+        if not filepaths:
+            return [], []
+        if source_root is None:
+            source_root = self._common_root(filepaths)
+        new_filepaths = [None] * len(filepaths)
+        errors = [None] * len(filepaths)
+        
+        channel = ssh_handler.ssh.get_transport().open_session()
+        channel.exec_command(f'cd {shlex.quote(str(target_root))} && {self._TAR_EXTRACT_COMMANDS[compression]}')
+        stream = _ChannelWriter(channel)
+        compressor = None
+        if compression == 'zst':
+            import zstandard
+            compressor = zstandard.ZstdCompressor().stream_writer(stream, closefd=False)
+        tar = tarfile.open(fileobj=compressor or stream, mode='w|gz' if compression == 'gz' else 'w|', dereference=True)
+        for i, file in enumerate(filepaths):
+            if stream.error is not None:
+                break
+            try:
+                relative_path = self._relative_path(file, source_root, keep_tree=True)
+                self._add_to_tar(tar, file, relative_path)
+                new_filepaths[i] = Path(PurePosixPath(target_root) / relative_path)
+            except Exception as e:
+                errors[i] = e
+        try:
+            tar.close()                                 #Writes the end of archive blocks
+            if compressor is not None:
+                compressor.close()
+        except Exception:
+            if stream.error is None:
+                raise
+        if stream.error is None:
+            channel.shutdown_write()                    #Signal the end of the archive to the remote tar
+        exit_status = channel.recv_exit_status()
+        if stream.error is not None or exit_status != 0:
+            #The remote extraction failed or the stream broke off, so none of the files can be assumed to have arrived
+            broke_off = f'The tar stream to the remote broke off ({stream.error}); ' if stream.error is not None else ''
+            stderr = channel.makefile_stderr().read().decode().strip()
+            error = RuntimeError(f'{broke_off}Remote tar exited with status {exit_status}: {stderr}')
+            errors = [e or error for e in errors]
+            new_filepaths = [None] * len(filepaths)
+        channel.close()
+        return new_filepaths, errors
+
+    @staticmethod
+    def _add_to_tar(tar: tarfile.TarFile, file: Path, arcname: PurePosixPath) -> None:
+        """Add a regular file, or a directory with the files below it, to a tar archive (following symbolic links)"""
+        if file.is_file():
+            tar.add(str(file), arcname=str(arcname), recursive=False)
+            return
+        if not file.is_dir():
+            raise ValueError(f'{file} is not a regular file or a directory')
+        #Check the whole directory first, so it is either sent completely or not at all
+        members = [(file, arcname)]
+        for dirpath, dirnames, filenames in os.walk(file, followlinks=True):
+            dirpath = Path(dirpath)
+            for name in sorted(dirnames) + sorted(filenames):
+                path = dirpath / name
+                if not (path.is_file() or path.is_dir()):
+                    raise ValueError(f'{path} is not a regular file or a directory')
+                members.append((path, arcname / path.relative_to(file).as_posix()))
+        for path, member_arcname in members:
+            tar.add(str(path), arcname=str(member_arcname), recursive=False)
     
     @property
     def filepaths(self):
         return self._filepaths
+
+    @property
+    def errors(self) -> List[Optional[Exception]]:
+        """The error of every file of the last move or migration, in the order of the filepaths (None if it succeeded)"""
+        return self._errors
+
+
+class _ChannelWriter:
+    """Minimal writable file object that sends everything written to it over an SSH channel"""
+    def __init__(self, channel) -> None:
+        self._channel = channel
+        #The exception of the first failed send, after which the channel is unusable
+        self.error = None
+
+    def write(self, data: bytes) -> int:
+        try:
+            self._channel.sendall(data)
+        except Exception as e:
+            self.error = self.error or e
+            raise
+        return len(data)
+
+    def flush(self) -> None:
+        pass
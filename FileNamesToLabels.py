@@ -1,44 +1,239 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
 from pathlib import Path
-from typing import Union, Dict, List
+from typing import Callable, Union, Dict, List, Optional
 from Utils import Utils
+from LabelEncoder import LabelEncoder
+from Instrumentation import Instrumentation
 
 class FileNamesToLabels:
     def __init__(self, 
                  root_dir: Union[Path, str], 
-                 file_extension: str,
+                 file_extension: Union[str, List[str]],
                  suffix_to_label_map: Dict[str,str],
                  suffix_sep: str = '_') -> None:
-        
+        """
+        Args:
+            root_dir (Union[Path, str]): The root of the directory structure with the files.
+            file_extension (Union[str, List[str]]): The extension of the files (without dot, e.g. 'mha'), or a list of
+            extensions that are all searched for in one pass.
+            suffix_to_label_map (Dict[str,str]): Maps the suffix of a filename (the last part before the extension) to its label.
+            suffix_sep (str): The separator before the suffix in the filename. Defaults to '_'.
+        """
         self.root_dir = Path(root_dir)
         self.file_extension = file_extension
         self.suffix_to_label_map = suffix_to_label_map
         self.suffix_sep = suffix_sep
         self._labeldf = None
+
+    @property
+    def file_extensions(self) -> tuple:
+        """The file extensions as a tuple of '.ext' strings"""
+        extensions = [self.file_extension] if isinstance(self.file_extension, str) else self.file_extension
+        return tuple(f'.{extension.lstrip(".")}' for extension in extensions)
+
+    @staticmethod
+    def _walk(directories: List[str], 
+              extensions: tuple, 
+              progress: Optional[Callable[[int], None]] = None,
+              snapshot: Optional[Dict[str, list]] = None,
+              max_directories: Optional[int] = None) -> tuple:
+        """
+        Walk directory trees with os.scandir and index the files with one of the extensions.
+
+        Returns:
+            tuple: The index, which maps every directory to [mtime_ns, names of the matching files, names of the
+            subdirectories], and the directories that were not walked yet when max_directories were indexed (an empty
+            list if max_directories is None). Directories whose mtime equals the one in the snapshot are not listed
+            again; their entry is reused.
+        """
+        index = {}
+        listed = 0
+        stack = list(directories)
+        while stack and (max_directories is None or len(index) < max_directories):
+            path = stack.pop()
+            try:
+                #The mtime is taken before listing, so a change during the listing is picked up by the next rescan
+                mtime = os.stat(path).st_mtime_ns
+                previous = snapshot.get(path) if snapshot is not None else None
+                if previous is not None and previous[0] == mtime:
+                    entry = previous
+                else:
+                    files, subdirs = [], []
+                    with os.scandir(path) as entries:
+                        for entry in entries:
+                            if entry.is_dir(follow_symlinks=False):
+                                subdirs.append(entry.name)
+                            elif entry.name.endswith(extensions) and entry.is_file():
+                                files.append(entry.name)
+                    entry = [mtime, files, subdirs]
+                    listed += 1
+            except OSError as e:
+                print(f'Could not scan {e.filename}: {e.strerror}')
+                continue
+            index[path] = entry
+            stack.extend(os.path.join(path, subdir) for subdir in entry[2])
+            if progress is not None:
+                progress(len(entry[1]))
+        Instrumentation.count('directories_listed', listed)
+        Instrumentation.count('directories_reused', len(index) - listed)
+        return index, stack
+
+    #Number of directories a scan task walks before it hands the rest of its stack back to be split over new tasks
+    _DIRECTORIES_PER_TASK = 256
+
+    def _scan_index(self, max_workers: int = 8, progress: bool = False, snapshot: Optional[Dict[str, list]] = None) -> Dict[str, list]:
+        """Index root_dir (see _walk), listing its directories concurrently"""
+        extensions = self.file_extensions
+        counter = None
+        if progress:
+            lock = threading.Lock()
+            found = [0, 0.0]                            #Files found, time of the last update of the counter
+            def counter(n: int) -> None:
+                with lock:
+                    found[0] += n
+                    #Update the counter at most a few times per second, so the terminal does not slow down the walk
+                    if time.monotonic() - found[1] > 0.2:
+                        found[1] = time.monotonic()
+                        print(f'\rFiles found: {found[0]}', end='', flush=True)
+
+        #Every task walks a bounded number of directories and hands back the directories it did not get to, which are
+        #split over new tasks; so the walk is spread over the workers at any depth (e.g. a root with a single
+        #collection folder), without a task per directory
+        root = str(self.root_dir)
+        with Instrumentation.span('file_names_to_labels.scan', root_dir=root, incremental=snapshot is not None) as span:
+            index = {}
+            walked = queue.SimpleQueue()
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                def submit(directories: List[str]) -> None:
+                    executor.submit(self._walk, directories, extensions, counter, snapshot, 
+                                    self._DIRECTORIES_PER_TASK).add_done_callback(walked.put)
+                submit([root])
+                outstanding = 1
+                while outstanding:
+                    task_index, remaining = walked.get().result()
+                    outstanding -= 1
+                    index.update(task_index)
+                    step = -(-len(remaining) // max_workers)
+                    for i in range(0, len(remaining), step or 1):
+                        submit(remaining[i:i + step])
+                        outstanding += 1
+            n_files = sum(len(entry[1]) for entry in index.values())
+            span.set(directories=len(index), files=n_files)
+        Instrumentation.count('files_found', n_files)
+        if progress:
+            print(f'\rFiles found: {found[0]}')
+        return index
+
+    @staticmethod
+    def _files_of_index(index: Dict[str, list]) -> List[str]:
+        """The sorted paths of the indexed files"""
+        return sorted(os.path.join(directory, file) for directory, entry in index.items() for file in entry[1])
+
+    def scan_files(self, max_workers: int = 8, progress: bool = False) -> List[str]:
+        """
+        Find all files with one of the file extensions under root_dir. The subdirectories of root_dir are walked
+        concurrently, with os.scandir (which gets the file types from the directory listing, without a stat per file).
+
+        Args:
+            max_workers (int): Number of subdirectories walked concurrently. Defaults to 8.
+            progress (bool): Whether to show a counter of the files found. Defaults to False.
+
+        Returns:
+            List[str]: The sorted file paths.
+        """
+        return self._files_of_index(self._scan_index(max_workers=max_workers, progress=progress))
+
+    def _labels_of_files(self, files: List[str]) -> pd.DataFrame:
+        """Derive the suffix and label of every file with vectorized string operations; drops files without a label"""
+        file_paths = np.empty(len(files), dtype=object)          #Preallocated column instead of appending per file
+        file_paths[:] = files
+        names = pd.Series(file_paths, dtype=object).map(os.path.basename)
+        #Strip the (matched) extension; the suffix is the last part of the remaining name
+        stems = names.copy()
+        for extension in sorted(self.file_extensions, key=len):      #Longest extension last, so it wins
+            has_extension = names.str.endswith(extension)
+            stems[has_extension] = names[has_extension].str.slice(stop=-len(extension))
+        suffixes = stems.str.rsplit('.', n=1).str[-1].str.rsplit(self.suffix_sep, n=1).str[-1]
+        mapped = suffixes.isin(list(self.suffix_to_label_map)).to_numpy()
+        return pd.DataFrame({'file_path': file_paths[mapped],
+                             'suffix': suffixes[mapped].to_numpy(),
+                             'label': suffixes[mapped].map(self.suffix_to_label_map).to_numpy()})
           
-    def filenames_to_labels_df(self) -> list:
+    def filenames_to_labels_df(self, max_workers: int = 8, progress: bool = False) -> pd.DataFrame:
         """
-        Gets all file paths with a specific file extension from a directory structure.
+        Gets all file paths with the file extension(s) from a directory structure, with their suffix and label.
+        Files whose suffix is not in suffix_to_label_map are left out.
         
+        Args:
+            max_workers (int): Number of subdirectories walked concurrently. Defaults to 8.
+            progress (bool): Whether to show a counter of the files found. Defaults to False.
+
         Returns:
-        pd.DataFrame: A DataFrame containing file paths.
+        pd.DataFrame: A DataFrame with the columns file_path, suffix and label, sorted by file path.
         """
-        # Initialize a list to store file paths
-        labeldict = {'file_path': [], 'suffix': [], 'label': []}
-        # Search for files with the specified file extension
-        for file_path in self.root_dir.rglob(f'*.{self.file_extension}'):
-            print(f'file_path: {file_path}')
-            suffix = file_path.name.split('.')[-2].split(self.suffix_sep)[-1]
-            print(f'suffix: {suffix}')
-            label = self.suffix_to_label_map.get(suffix, None)
-            print(f'label: {label}')
-            if label is not None:
-                labeldict['file_path'].append(str(file_path))
-                labeldict['suffix'].append(suffix)
-                labeldict['label'].append(label)       
-        self._labeldf = pd.DataFrame(labeldict)
+        self._labeldf = self._labels_of_files(self.scan_files(max_workers=max_workers, progress=progress))
         return self._labeldf
     
+    @staticmethod
+    def snapshot_path(output_csv: Union[str, Path] = 'labels.csv') -> Path:
+        """The path of the snapshot index that belongs to an output csv, e.g. labels.snapshot.json next to labels.csv"""
+        return Path(output_csv).with_suffix('.snapshot.json')
+
+    def update_labels_df(self, 
+                         output_csv: Union[str, Path] = 'labels.csv', 
+                         max_workers: int = 8, 
+                         progress: bool = False) -> pd.DataFrame:
+        """
+        Rescan root_dir incrementally, using the snapshot index next to output_csv (see snapshot_path), and merge the
+        new and removed files into labeldf. The snapshot holds the mtime, matching files and subdirectories of every
+        directory; only directories whose mtime changed (i.e. files or subdirectories were added, removed or renamed)
+        are listed again, the others are only checked with a stat. Without a (matching) snapshot the whole tree is
+        scanned. The new and removed files are those of the loaded labeldf if there is one (it may be newer than the
+        snapshot), and otherwise those of the snapshot. The updated snapshot is written afterwards.
+
+        Args:
+            output_csv (Union[str, Path]): The labels csv the snapshot is stored next to. Defaults to 'labels.csv'.
+            max_workers (int): Number of subdirectories walked concurrently. Defaults to 8.
+            progress (bool): Whether to show a counter of the files found. Defaults to False.
+
+        Returns:
+            pd.DataFrame: The updated labeldf
+        """
+        snapshot_path = self.snapshot_path(output_csv)
+        snapshot = Utils.load_json(snapshot_path) if snapshot_path.is_file() else None
+        if snapshot is not None and (snapshot['root_dir'] != str(self.root_dir) or snapshot['extensions'] != list(self.file_extensions)):
+            print(f'Snapshot {snapshot_path} is of another root directory or other extensions; scanning everything')
+            snapshot = None
+        previous_index = snapshot['directories'] if snapshot is not None else {}
+
+        index = self._scan_index(max_workers=max_workers, progress=progress, snapshot=previous_index)
+        files = self._files_of_index(index)
+        if self._labeldf is not None:
+            #Diff against the labeldf that is already loaded, which may be newer than the snapshot
+            labeldf = self._labeldf
+            known_files = set(labeldf['file_path'])
+        else:
+            labeldf = self._labels_of_files(self._files_of_index(previous_index))
+            known_files = set(self._files_of_index(previous_index))
+        added = sorted(set(files).difference(known_files))
+        removed = known_files.difference(files)
+
+        labeldf = labeldf[~labeldf['file_path'].isin(removed)]
+        new_labeldf = self._labels_of_files(added)                     #Files without a label are dropped again here
+        if len(new_labeldf):
+            labeldf = pd.concat([labeldf, new_labeldf], ignore_index=True) if len(labeldf) else new_labeldf
+        self._labeldf = labeldf.sort_values('file_path', ignore_index=True)
+        print(f'{len(new_labeldf)} new and {len(removed)} removed files')
+
+        Utils.write_json(snapshot_path, {'root_dir': str(self.root_dir), 'extensions': list(self.file_extensions), 'directories': index})
+        return self._labeldf
+
     def save_labels_csv(self, 
                         cols_to_save: List[str] = ['file_path', 'label'], 
                         output_csv: str = 'labels.csv') -> None:
@@ -61,12 +256,13 @@ class FileNamesToLabels:
 # Example usage
 if __name__ == '__main__':
     root = '/home/donpi-boxer/BME/Thesis/data/prostate/PI-CAI Challenge'
-    #TODO: write code snippet that automatically generate numeric labels from string labels and also returns the string_to_num labelmap
-    labelmap = {'t2w': 0, 'hbv': 1, 'adc': 2}
-    labeler = FileNamesToLabels(root_dir = root, file_extension='mha', suffix_to_label_map=labelmap)
-    labeldf = labeler.labeldf
-    out = labeler.save_labels_csv(output_csv='labels.csv')                                              #Get the label map
-    Utils.write_json('labelmap.json', labelmap)
+    suffix_to_label_map = {'t2w': 't2w', 'hbv': 'hbv', 'adc': 'adc'}
+    labeler = FileNamesToLabels(root_dir = root, file_extension='mha', suffix_to_label_map=suffix_to_label_map)
+    labeldf = labeler.update_labels_df(output_csv='labels.csv')
+    labelEncoder = LabelEncoder(label_map='labelmap.json')                                              #Numeric labels 0..N-1, stable over reruns
+    labeldf['label'] = labelEncoder.encode(labeldf['label'])
+    out = labeler.save_labels_csv(output_csv='labels.csv')
+    labelEncoder.save_label_map('labelmap.json')                                                        #Save the string -> numeric label map
     
     
     
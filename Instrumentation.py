@@ -0,0 +1,231 @@
+import atexit
+import json
+import multiprocessing.util
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Optional, Union
+
+
+class _Span:
+    """A timed section of the pipeline; arguments (e.g. the number of rows) can be added while it runs with set()"""
+    __slots__ = ('name', 'args', '_start')
+
+    def __init__(self, name: str, args: dict) -> None:
+        self.name = name
+        self.args = args
+        self._start = 0
+
+    def set(self, **args) -> None:
+        self.args.update(args)
+
+    def __enter__(self) -> '_Span':
+        self._start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        end = time.perf_counter_ns()
+        Instrumentation._record({'name': self.name, 'ph': 'X', 'ts': self._start // 1000, 'dur': (end - self._start) // 1000,
+                                 'pid': os.getpid(), 'tid': threading.get_ident(), 'args': self.args})
+
+
+class _NoSpan:
+    """The span that is returned while instrumentation is off; it does nothing"""
+    __slots__ = ()
+
+    def set(self, **args) -> None:
+        pass
+
+    def __enter__(self) -> '_NoSpan':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        pass
+
+
+_NO_SPAN = _NoSpan()
+
+
+class Instrumentation:
+    """
+    Process-wide, lightweight instrumentation of the pipeline: spans (timed sections), counters (e.g. rows filtered,
+    labels mapped, cache hits, files and bytes transferred) and gauges (e.g. throughput).
+
+    It is off by default; the hooks in the modules then only check a flag, so the overhead is negligible. When it is on,
+    the events are kept in memory and written on write() (or at exit) as a Chrome trace (a .json file that can be
+    opened in chrome://tracing or Perfetto) or as a structured log with one JSON event per line (.jsonl). Setting
+    DATAMAPPER_TRACE to a file path turns it on for a whole run.
+
+    Only the process that called enable() writes the output. Worker processes (of multiprocessing, e.g. the process
+    pool of BatchProcessor) write their events to a part file next to the output when they exit, and the parent merges
+    the part files into its trace when it writes it. Forked workers inherit the instrumentation; spawned workers are only
+    instrumented if DATAMAPPER_TRACE is set.
+
+    Example:
+        Instrumentation.enable('trace.json')
+        with Instrumentation.span('map_labels', rows=len(labels)):
+            ...
+        Instrumentation.count('labels_mapped', len(labels))
+    """
+    _enabled = False
+    _output: Optional[Path] = None
+    _events = []
+    _counters: Dict[str, float] = {}
+    _lock = threading.Lock()
+    _start = time.perf_counter_ns()
+    #The process that writes the output; None in worker processes, which write part files instead
+    _pid: Optional[int] = None
+
+    @classmethod
+    def enable(cls, output: Optional[Union[str, Path]] = None) -> None:
+        """
+        Turn the instrumentation on.
+
+        Args:
+            output (Optional[Union[str, Path]]): File the events are written to at exit: a Chrome trace, or a structured
+            log if the suffix is .jsonl. Defaults to None, meaning the events are only written by an explicit write().
+        """
+        cls._output = Path(output) if output is not None else None
+        cls._enabled = True
+        cls._pid = os.getpid()
+
+    @classmethod
+    def disable(cls) -> None:
+        """Turn the instrumentation off; the events recorded so far are kept until reset()"""
+        cls._enabled = False
+
+    @classmethod
+    def reset(cls) -> None:
+        """Discard all recorded events and counters"""
+        with cls._lock:
+            cls._events = []
+            cls._counters = {}
+
+    @classmethod
+    def enabled(cls) -> bool:
+        return cls._enabled
+
+    @classmethod
+    def span(cls, name: str, **args):
+        """A context manager that times a section of the pipeline, with optional arguments such as the number of rows"""
+        if not cls._enabled:
+            return _NO_SPAN
+        return _Span(name, args)
+
+    @classmethod
+    def count(cls, name: str, value: float = 1) -> None:
+        """Add value to the counter name"""
+        if not cls._enabled:
+            return
+        with cls._lock:
+            total = cls._counters[name] = cls._counters.get(name, 0) + value
+        cls._record({'name': name, 'ph': 'C', 'ts': time.perf_counter_ns() // 1000, 'pid': os.getpid(), 'args': {name: total}})
+
+    @classmethod
+    def gauge(cls, name: str, value: float) -> None:
+        """Record the current value of a gauge, e.g. a throughput"""
+        if not cls._enabled:
+            return
+        cls._record({'name': name, 'ph': 'C', 'ts': time.perf_counter_ns() // 1000, 'pid': os.getpid(), 'args': {name: value}})
+
+    @classmethod
+    def throughput(cls, name: str, amount: float, seconds: float) -> None:
+        """Record amount / seconds as the gauge name (e.g. bytes per second of a transfer)"""
+        if cls._enabled and seconds > 0:
+            cls.gauge(name, amount / seconds)
+
+    @classmethod
+    def _record(cls, event: dict) -> None:
+        with cls._lock:
+            cls._events.append(event)
+
+    @classmethod
+    def counters(cls) -> Dict[str, float]:
+        """The totals of all counters"""
+        with cls._lock:
+            return dict(cls._counters)
+
+    @classmethod
+    def events(cls) -> list:
+        with cls._lock:
+            return list(cls._events)
+
+    @classmethod
+    def write(cls, output: Optional[Union[str, Path]] = None) -> Optional[Path]:
+        """
+        Write the recorded events to a Chrome trace, or to a structured log if the suffix is .jsonl.
+
+        Args:
+            output (Optional[Union[str, Path]]): The file to write. Defaults to None, meaning the output of enable().
+
+        Returns:
+            Optional[Path]: The path of the written file, or None if there is no output.
+        """
+        output = Path(output) if output is not None else cls._output
+        if output is None:
+            return None
+        cls._merge_worker_parts()
+        events = cls.events()
+        with open(output, 'w') as file:
+            if output.suffix == '.jsonl':
+                for event in events:
+                    #Timestamps relative to the start of the process, in seconds
+                    event = dict(event, ts=(event['ts'] - cls._start // 1000) / 1e6)
+                    if 'dur' in event:
+                        event['dur'] = event['dur'] / 1e6
+                    file.write(json.dumps(event, default=str) + '\n')
+            else:
+                json.dump({'traceEvents': events, 'displayTimeUnit': 'ms', 'otherData': {'counters': cls.counters()}}, file, default=str)
+        return output
+
+    @classmethod
+    def _write_at_exit(cls) -> None:
+        #Forked processes inherit the handler; only the process that enabled the instrumentation writes the output
+        if cls._output is not None and cls._pid == os.getpid():
+            cls.write()
+
+    @staticmethod
+    def _part_path(output: Path, pid: int) -> Path:
+        return output.with_name(f'{output.name}.{pid}.part')
+
+    @classmethod
+    def _after_fork(cls) -> None:
+        """Turn a new multiprocessing worker (forked or spawned) into a worker that writes a part file at its exit"""
+        cls._lock = threading.Lock()                #The lock of the parent may have been held by another thread
+        cls._events = []                            #The events of the parent are written by the parent
+        cls._counters = {}
+        cls._pid = None
+        if cls._enabled and cls._output is not None:
+            #Workers exit with os._exit, which skips atexit, but the finalizers of multiprocessing do run
+            multiprocessing.util.Finalize(cls, cls._write_worker_part, exitpriority=0)
+
+    @classmethod
+    def _write_worker_part(cls) -> None:
+        if not cls._events:
+            return
+        with open(cls._part_path(cls._output, os.getpid()), 'w') as file:
+            json.dump({'events': cls.events(), 'counters': cls.counters()}, file, default=str)
+
+    @classmethod
+    def _merge_worker_parts(cls) -> None:
+        """Add the events and counters of the part files of the workers (see _after_fork) and remove the files"""
+        if cls._output is None:
+            return
+        for part_path in sorted(cls._output.parent.glob(f'{cls._output.name}.*.part')):
+            with open(part_path) as file:
+                part = json.load(file)
+            with cls._lock:
+                cls._events.extend(part['events'])
+                for name, value in part['counters'].items():
+                    cls._counters[name] = cls._counters.get(name, 0) + value
+            part_path.unlink()
+
+
+if os.getenv('DATAMAPPER_TRACE'):
+    Instrumentation.enable(os.getenv('DATAMAPPER_TRACE'))
+atexit.register(Instrumentation._write_at_exit)
+#Runs in every multiprocessing worker when it starts: inherited by forked workers, registered again on import in spawned ones
+multiprocessing.util.register_after_fork(Instrumentation, lambda cls: cls._after_fork())
+if multiprocessing.parent_process() is not None:
+    Instrumentation._after_fork()               #Imported in a spawned worker, possibly after the hook above has run
@@ -0,0 +1,91 @@
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from typing import Dict, Iterable, Optional, Union
+from Utils import Utils
+
+
+class LabelEncoder:
+    """
+    Encodes string labels (e.g. the output of LabelMapper.map_labels or the labels of FileNamesToLabels) as numeric
+    labels 0..N-1, stored as int8/int16 codes instead of Python strings.
+
+    The string -> numeric label map is stable: a map that was saved before is loaded and only extended, so the codes of
+    known labels never change between (incremental) runs, and new labels get the next free codes.
+    """
+    def __init__(self, label_map: Optional[Union[str, Path, Dict[str, int]]] = None) -> None:
+        """
+        Args:
+            label_map (Optional[Union[str, Path, Dict[str, int]]]): An existing label map, or the path of its JSON file.
+            A path that does not exist yet is fine; the map then starts empty. Defaults to None.
+        """
+        if isinstance(label_map, (str, Path)):
+            label_map = Utils.load_json(label_map) if Path(label_map).is_file() else {}
+        self._label_map = dict(label_map or {})
+        if sorted(self._label_map.values()) != list(range(len(self._label_map))):
+            raise ValueError('The numeric labels of label_map must be 0..N-1')
+
+    @staticmethod
+    def code_dtype(n_labels: int) -> np.dtype:
+        """The smallest signed integer type that holds the codes of n_labels labels and the -1 of missing labels"""
+        for dtype in (np.int8, np.int16, np.int32):
+            if n_labels - 1 <= np.iinfo(dtype).max:
+                return np.dtype(dtype)
+        return np.dtype(np.int64)
+
+    def fit(self, labels: Iterable) -> Dict[str, int]:
+        """
+        Add the labels that are not in the label map yet, with the next free codes (in sorted order, so the codes do
+        not depend on the row order). Missing labels (None/NaN) are skipped.
+
+        Args:
+            labels (Iterable): The string labels.
+
+        Returns:
+            Dict[str, int]: The updated label map
+        """
+        labels = labels if isinstance(labels, pd.Series) else pd.Series(list(labels), dtype=object)
+        uniques = labels.cat.categories if isinstance(labels.dtype, pd.CategoricalDtype) else labels.dropna().unique()
+        for label in sorted(set(uniques).difference(self._label_map)):
+            self._label_map[label] = len(self._label_map)
+        return self._label_map
+
+    def encode(self, labels: Union[pd.Series, Iterable], fit: bool = True) -> pd.Series:
+        """
+        Encode string labels as numeric labels of the smallest integer type (see code_dtype). Only the unique labels
+        are looked up; the codes are broadcast to the rows. Missing labels, and with fit=False unknown labels, get -1.
+
+        Args:
+            labels (Union[pd.Series, Iterable]): The string labels, e.g. the categorical Series of LabelMapper.map_labels.
+            fit (bool): Whether to add unknown labels to the label map first. Defaults to True.
+
+        Returns:
+            pd.Series: The numeric labels, with the index of labels if it is a Series.
+        """
+        labels = labels if isinstance(labels, pd.Series) else pd.Series(list(labels), dtype=object)
+        if fit:
+            self.fit(labels)
+        if isinstance(labels.dtype, pd.CategoricalDtype):
+            codes, uniques = labels.cat.codes.to_numpy(), labels.cat.categories
+        else:
+            codes, uniques = pd.factorize(labels)
+        dtype = self.code_dtype(len(self._label_map))
+        #Numeric label of every unique label, plus -1 at the end for the missing labels (code -1)
+        unique_numeric = np.append(pd.Index(uniques).map(lambda label: self._label_map.get(label, -1)).to_numpy(dtype=dtype), -1)
+        return pd.Series(unique_numeric.astype(dtype)[codes], index=labels.index, name=labels.name)
+
+    def decode(self, codes: Union[pd.Series, Iterable]) -> pd.Series:
+        """Decode numeric labels back to the string labels (missing for -1), as a categorical Series"""
+        codes = codes if isinstance(codes, pd.Series) else pd.Series(list(codes))
+        categories = sorted(self._label_map, key=self._label_map.get)
+        return pd.Series(pd.Categorical.from_codes(codes.to_numpy(dtype=np.int64), categories=categories),
+                         index=codes.index, name=codes.name)
+
+    def save_label_map(self, file_path: Union[str, Path] = 'labelmap.json') -> Union[str, Path]:
+        """Write the string -> numeric label map to a JSON file"""
+        Utils.write_json(file_path, self._label_map)
+        return file_path
+
+    @property
+    def label_map(self) -> Dict[str, int]:
+        return self._label_map
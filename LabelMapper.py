@@ -2,24 +2,36 @@ from pathlib import Path
 from typing import Union, List, Dict, Optional
 import pandas as pd
 from Utils import *
+from AcronymMatcher import AcronymMatcher
+from MappingCache import MappingCache
+from Instrumentation import Instrumentation
 
 
 class LabelMapper:
     def __init__(self,
-                 acronym_dir: Optional[Union[str, Path]] = Path.cwd() / 'acronyms') -> None:
+                 acronym_dir: Optional[Union[str, Path]] = Path.cwd() / 'acronyms',
+                 cache_path: Optional[Union[str, Path]] = None) -> None:
         """
         Initializes the DataMapper with the directory containing substring .txt files.
 
         Args:
-            labels_to_map (List[str]): The list of labels to map.
-            root_dir (str): The directory path where .txt files are stored.
+            acronym_dir (Union[str, Path]): The directory with the relative and absolute acronym directories.
+            cache_path (Optional[Union[str, Path]]): Path of a persistent mapping cache (e.g. 'label_mapping_cache.sqlite').
+            Labels found in the cache are not evaluated again; the cache is invalidated when the acronym files change.
+            Defaults to None, meaning no cache is used.
         """
         self._acronym_dir = Path(acronym_dir)
         self._relative_map = self.load_mapping_dict_from_root(self._acronym_dir / 'relative')
         self.absolute_map = self.load_mapping_dict_from_root(self._acronym_dir / 'absolute')
-        self._unmapped_labels = []
-        self._succesful_relative_maps = {}
-        self._ambigous_relative_maps = {}
+        #Compile the patterns once, so every label is matched in a single pass
+        self._relative_matcher = AcronymMatcher(self._relative_map)
+        self._absolute_lookup = {}
+        for main_modality, labels in self.absolute_map.items():
+            for label in labels:
+                self._absolute_lookup.setdefault(label.lower(), main_modality)      #First modality wins, as in the relative map
+        self._unmapped_labels = {}
+        self._succesful_mappings = {}
+        self._cache = MappingCache(cache_path, MappingCache.fingerprint_acronyms(self._acronym_dir)) if cache_path else None
         
         
     @staticmethod
@@ -32,7 +44,10 @@ class LabelMapper:
             dict: A dictionary with keys as modality names and values as lists of substrings.
         """
         substrings_dict = {}
-        for file_path in root_dir.iterdir():
+        root_dir = Path(root_dir)
+        if not root_dir.is_dir():
+            return substrings_dict
+        for file_path in sorted(root_dir.iterdir()):
             if file_path.suffix == '.txt':
                 modality = file_path.stem
                 with file_path.open('r') as file:
@@ -50,13 +65,7 @@ class LabelMapper:
         Returns:
             str: The mapped main MRI modality or None if no substrings match.
         """
-        label_lower = label.lower()                                                     #Convert the label to lowercase to ensure case-insensitive comparison
-        for main_modality, substrings in self._map_dict.items():
-            if any(substring.lower() in label_lower for substring in substrings):
-                self._record_succesful_mapping(main_modality) #Record the succesful mapping
-                return main_modality
-        self._record_unsuccesful_mapping(label)               #Record the unsuccesful mapping
-        return None  # Return None for unmapped labels
+        return self._relative_matcher.match(label)
 
     def _absolute_mapping(self, label:str) -> str:
         """
@@ -69,60 +78,121 @@ class LabelMapper:
         Returns:
             str: The mapped main MRI modality or None if no exact match found.
         """
-        label_lower = label.lower()                           #Convert the label to lowercase to ensure case-insensitive comparison
-        for main_modality, substrings in self._map_dict.items():
-            if label_lower in substrings:
-                return main_modality
-        self._record_unsuccesful_mapping(label)               #Record the unsuccesful mapping
-        return None  # Return None for unmapped labels
+        return self._absolute_lookup.get(label.lower())   #Lowercase the label to ensure case-insensitive comparison
+
+    def _map_label(self, label: str) -> str:
+        """
+        Maps a single label, first by exact match and otherwise by substrings, and records the result.
+
+        Args:
+            label (str): The original label from the dataset.
+
+        Returns:
+            str: The mapped main MRI modality or None if the label could not be mapped.
+        """
+        main_modality = None
+        if isinstance(label, str):
+            main_modality = self._absolute_mapping(label) or self._relative_mapping(label)
+        self._record_mapping(main_modality, label)
+        return main_modality
     
-    def map_labels(self, labels_to_map: List[str]) -> List[str]:
+    def map_labels(self, labels_to_map: Union[List[str], pd.Series], save_unmapped: bool = True) -> Union[List[str], pd.Series]:
         """
-        Maps a list of labels to main modalities based on substrings.
+        Maps a list or Series of labels to main modalities based on substrings.
+        The labels are factorized first, so every distinct label is mapped (and recorded) only once.
 
         Args:
-            labels (List[str]): The list of original labels from the dataset.
+            labels_to_map (Union[List[str], pd.Series]): The original labels from the dataset.
+            save_unmapped (bool): Whether to save the unmapped labels and the succesful mappings to the default files
+            in the current working directory if some labels could not be mapped. Defaults to True.
 
         Returns:
-            List[str]: The list of mapped main MRI modalities.
+            Union[List[str], pd.Series]: The mapped main MRI modalities. A Series is returned as a categorical Series
+            with the same index and name; unmapped labels are None (list) or NaN (Series).
         """
-        
         self._unmapped_labels.clear()
-        mapped_labels = [self._map_label(label) for label in labels_to_map]
+        labels = labels_to_map if isinstance(labels_to_map, pd.Series) else pd.Series(list(labels_to_map), dtype=object)
+        with Instrumentation.span('label_mapper.map_labels', rows=len(labels)) as span:
+            codes, uniques = pd.factorize(labels, use_na_sentinel=False)           #Keep NaN as a unique so it is recorded as unmapped
+            if self._cache is None:
+                mapped_uniques = [self._map_label(label) for label in uniques]
+            else:
+                mapped_uniques = self._map_uniques_with_cache(uniques)
+            span.set(unique_labels=len(uniques), unmapped_labels=len(self._unmapped_labels))
+        Instrumentation.count('labels_mapped', len(labels))
+        Instrumentation.count('unique_labels_mapped', len(uniques))
+        Instrumentation.count('labels_unmapped', len(self._unmapped_labels))
         if len(self._unmapped_labels) > 0:
-            print(f"WARNING: {len(self._unmapped_labels)} labels could not be mapped! See unmapped_labels.txt for details.")
-            self.save_unmapped_labels()
-            self.save_succesful_mapping_dict()
+            print(f"WARNING: {len(self._unmapped_labels)} labels could not be mapped!" + (" See unmapped_labels.txt for details." if save_unmapped else ''))
+            if save_unmapped:
+                self.save_unmapped_labels()
+                self.save_succesful_mapping_dict()
         else:
             print('All labels successfully mapped!')
-        return mapped_labels
         
-    def _record_succesful_mapping(self, main_modality: str, old_label: str) -> str:
-        if main_modality not in self._succesful_mappings:
-            self._succesful_mappings[main_modality] = []
-        if old_label not in self._succesful_mappings[main_modality]:
-            self._succesful_mappings[main_modality].append(old_label)
+        if isinstance(labels_to_map, pd.Series):
+            #Broadcast the mapped uniques back to the rows through the codes of a categorical
+            categories = pd.unique(pd.Series([m for m in mapped_uniques if m is not None], dtype=object))
+            category_codes = pd.Index(categories).get_indexer(pd.Series(mapped_uniques, dtype=object))   #-1 for unmapped labels
+            mapped_labels = pd.Categorical.from_codes(category_codes[codes], categories=categories)
+            return pd.Series(mapped_labels, index=labels_to_map.index, name=labels_to_map.name)
+        return [mapped_uniques[code] for code in codes]
         
-    def _record_unsuccesful_mapping(self, old_label: str) -> str:
-        if old_label not in self._unmapped_labels:
-            self._unmapped_labels.append(old_label)
+    def _map_uniques_with_cache(self, uniques: pd.Index) -> List[str]:
+        """Map the unique labels, only evaluating the labels that are not in the persistent cache"""
+        cached = self._cache.lookup(label for label in uniques if isinstance(label, str))
+        Instrumentation.count('mapping_cache_hits', len(cached))
+        Instrumentation.count('mapping_cache_misses', sum(isinstance(label, str) for label in uniques) - len(cached))
+        mapped_uniques = []
+        new_mappings = {}
+        for label in uniques:
+            if label in cached:
+                main_modality = cached[label]
+                self._record_mapping(main_modality, label)
+            else:
+                main_modality = self._map_label(label)
+                if isinstance(label, str):
+                    new_mappings[label] = main_modality
+            mapped_uniques.append(main_modality)
+        self._cache.store(new_mappings)
+        stats = self._cache.stats()
+        print(f"Mapping cache: {stats['hits']} hits, {stats['misses']} misses")
+        return mapped_uniques
+
+    def _record_mapping(self, main_modality: Optional[str], old_label: str) -> None:
+        if main_modality is None:
+            self._record_unsuccesful_mapping(old_label)           #Record the unsuccesful mapping
+        else:
+            self._record_succesful_mapping(main_modality, old_label)  #Record the succesful mapping
+
+    def _record_succesful_mapping(self, main_modality: str, old_label: str) -> None:
+        #Dicts are used as insertion ordered sets, so recording does not need an `in` check over a list
+        self._succesful_mappings.setdefault(main_modality, {})[old_label] = None
+        
+    def _record_unsuccesful_mapping(self, old_label: str) -> None:
+        self._unmapped_labels[old_label] = None
             
     def get_unique_mapped_labels(self):
         return list(self._succesful_mappings.keys()) 
               
     @property
-    def unmapped_labels(self):
-        return self._unmapped_labels
+    def unmapped_labels(self) -> List[str]:
+        return list(self._unmapped_labels)
+    
+    @property
+    def cache_stats(self) -> Optional[Dict[str, int]]:
+        """Hit and miss counts of the persistent mapping cache, or None if no cache is used"""
+        return self._cache.stats() if self._cache else None
     
     @property
-    def succesful_mappings(self):
-        return self._succesful_mappings
+    def succesful_mappings(self) -> Dict[str, List[str]]:
+        return {main_modality: list(labels) for main_modality, labels in self._succesful_mappings.items()}
     
     def save_unmapped_labels(self, file_path: Union[str, Path] = Path.cwd() / 'unmapped_labels.txt') -> str:
-        pd.Series(self._unmapped_labels).to_csv(file_path, index = False, header=False, sep=' ')
+        pd.Series(self.unmapped_labels, dtype=object).to_csv(file_path, index = False, header=False, sep=' ')
         return file_path
 
     def save_succesful_mapping_dict(self, file_path: Union[str, Path] = Path.cwd() / 'succesful_mappings.json') -> str:
-        Utils.write_json(file_path, self._succesful_mappings)
+        Utils.write_json(file_path, self.succesful_mappings)
         return file_path
 
@@ -0,0 +1,111 @@
+import hashlib
+import sqlite3
+from pathlib import Path
+from typing import Dict, Iterable, Optional, Union
+
+
+class MappingCache:
+    """
+    Persistent label -> modality cache, stored in a SQLite file.
+
+    The cache is keyed by a fingerprint of the acronym files, so every change to the files in acronyms/relative or
+    acronyms/absolute invalidates all cached mappings. Labels that could not be mapped are cached as well (as None),
+    since they are just as expensive to evaluate again.
+    """
+    def __init__(self, cache_path: Union[str, Path], fingerprint: str) -> None:
+        """
+        Open (or create) the cache file and load the mappings that belong to the fingerprint.
+
+        Args:
+            cache_path (Union[str, Path]): Path of the SQLite cache file.
+            fingerprint (str): Fingerprint of the acronym files, see fingerprint_acronyms.
+        """
+        self._cache_path = Path(cache_path)
+        self._fingerprint = fingerprint
+        self._hits = 0
+        self._misses = 0
+        self._connection = sqlite3.connect(self._cache_path)
+        self._connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        self._connection.execute('CREATE TABLE IF NOT EXISTS mappings (label TEXT PRIMARY KEY, modality TEXT)')
+
+        #Invalidate the cached mappings if the acronym files changed since they were written
+        row = self._connection.execute("SELECT value FROM meta WHERE key = 'fingerprint'").fetchone()
+        if row is None or row[0] != fingerprint:
+            with self._connection:
+                self._connection.execute('DELETE FROM mappings')
+                self._connection.execute("INSERT OR REPLACE INTO meta VALUES ('fingerprint', ?)", (fingerprint,))
+        #The cache holds one entry per distinct label, which is small enough to keep in memory
+        self._mappings = dict(self._connection.execute('SELECT label, modality FROM mappings'))
+
+    @staticmethod
+    def fingerprint_acronyms(acronym_dir: Union[str, Path]) -> str:
+        """
+        Content hash of the .txt files in the relative and absolute subdirectories of the acronym directory.
+
+        Args:
+            acronym_dir (Union[str, Path]): Directory containing the relative and absolute acronym directories.
+
+        Returns:
+            str: sha256 hex digest over the names and contents of the acronym files.
+        """
+        sha = hashlib.sha256()
+        for subdir in ['relative', 'absolute']:
+            root_dir = Path(acronym_dir) / subdir
+            if not root_dir.is_dir():
+                continue
+            for file_path in sorted(root_dir.glob('*.txt')):
+                sha.update(f'{subdir}/{file_path.name}\0'.encode())
+                sha.update(file_path.read_bytes())
+                sha.update(b'\0')
+        return sha.hexdigest()
+
+    def lookup(self, labels: Iterable[str]) -> Dict[str, Optional[str]]:
+        """
+        Look up the cached mappings of the labels and count the hits and misses.
+
+        Args:
+            labels (Iterable[str]): The labels to look up.
+
+        Returns:
+            Dict[str, Optional[str]]: The cached modality (None for known unmapped labels) of every label that was a hit.
+        """
+        found = {}
+        for label in labels:
+            if label in self._mappings:
+                found[label] = self._mappings[label]
+                self._hits += 1
+            else:
+                self._misses += 1
+        return found
+
+    def store(self, mappings: Dict[str, Optional[str]]) -> None:
+        """
+        Add newly evaluated mappings to the cache and write them to disk.
+
+        Args:
+            mappings (Dict[str, Optional[str]]): Dictionary of label -> modality (None if the label could not be mapped).
+        """
+        if not mappings:
+            return
+        self._mappings.update(mappings)
+        with self._connection:
+            self._connection.executemany('INSERT OR REPLACE INTO mappings VALUES (?, ?)', mappings.items())
+
+    def close(self) -> None:
+        self._connection.close()
+
+    def stats(self) -> Dict[str, int]:
+        """Return the hit and miss counts and the number of cached labels"""
+        return {'hits': self._hits, 'misses': self._misses, 'size': len(self._mappings)}
+
+    @property
+    def hits(self) -> int:
+        return self._hits
+
+    @property
+    def misses(self) -> int:
+        return self._misses
+
+    @property
+    def fingerprint(self) -> str:
+        return self._fingerprint
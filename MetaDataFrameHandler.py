@@ -1,51 +1,96 @@
+import numpy as np
 import pandas as pd
 from typing import Union, List, Optional
 from pathlib import Path
 from FileMover import FileMover
+from Utils import Utils
+from Instrumentation import Instrumentation
+
+#The handler shares data between the processed metadata and the frames it returns, which is only safe under
+#copy-on-write; it is always on from pandas 3, and opt-in in pandas 2
+if int(pd.__version__.split('.')[0]) < 3:
+    pd.set_option('mode.copy_on_write', True)
 
-###TODO: infer the new range of our classes (0, N-1) with N = #classes from the input !
 class MetaDataFrameHandler:
     """A class to manipulate and process metadata for datasets."""
     def __init__(self, 
                  source: Union[str, Path, pd.DataFrame], 
                  col_path: Union[str, Path]= 'File Location', 
                  col_label: Union[str, Path]= 'Series Description',
-                 col_uid: Union[str, Path]= 'Series UID'
+                 col_uid: Union[str, Path]= 'Series UID',
+                 chunksize: Optional[int] = None,
+                 lazy: bool = False
                  ) -> None:
         
         """
         Initialize the MetaData object with source data and relevant columns.
 
-        :param source: Either a path to a CSV file, a Path object, or a pandas DataFrame.
+        :param source: Either a path to a CSV, Parquet or Arrow IPC file, a Path object, or a pandas DataFrame.
         :param col_path: The name of the column with file paths.
         :param col_label: The name of the column with labels.
         :param col_uid: The name of the column with unique identifiers.
+        :param chunksize: If given, use streaming mode: the source file is not loaded, the operations are queued and
+                          applied chunk by chunk (of chunksize rows) when the metadata is saved or accessed.
+        :param lazy: If True, use lazy mode: the operations are recorded as a plan that is executed once, by collect(),
+                     when the processed metadata is needed. Only the columns the plan needs are read from the source,
+                     and consecutive row filters are combined into a single boolean mask.
         """
         
-        #Load the source data
-        self._source_metadata = self.load_source(source)
-        #Create copy of the source_df, which will be altered throughout the class; allows us to always revert back to the original source_df
-        self._processed_metadata = self._source_metadata.copy()
+        self._chunksize = chunksize
+        self._lazy = lazy
+        #Plan of the operations queued in streaming or lazy mode, as (operation name, kwargs) tuples
+        self._operations = []
+        if chunksize:
+            if not isinstance(source, (str, Path)):
+                raise ValueError(f'streaming mode needs a path to a file as source, not {type(source).__name__}')
+            self._source = Path(source)
+            self._source_metadata = None
+            self._processed_metadata = None
+        elif lazy:
+            #Keep the source as is; a file is only read (with the needed columns) when the plan is executed
+            self._source = Path(source) if isinstance(source, str) else source
+            self._source_metadata = source if isinstance(source, pd.DataFrame) else None
+            self._processed_metadata = None
+        else:
+            #Load the source data
+            self._source_metadata = self.load_source(source)
+            #Create copy of the source_df, which will be altered throughout the class; allows us to always revert back to the original source_df
+            self._processed_metadata = self._copy(self._source_metadata)
         #Define the, for our use, most relevant column in the metadata
         self.col_path = col_path
         self.col_label = col_label
         self.col_uid = col_uid
         
     @staticmethod 
-    def load_source(source):
+    def load_source(source, usecols: Optional[List[str]] = None):
         try:
-            # If we're given a path for the source, create the source dataframe
+            # If we're given a path for the source, create the source dataframe (from CSV, Parquet or Arrow IPC)
             if isinstance(source, (str, Path)):  
-                source_metadata = pd.read_csv(source)
+                with Instrumentation.span('metadata.load_source', source=str(source)) as span:
+                    source_metadata = Utils.read_table(source, columns=usecols)
+                    span.set(rows=len(source_metadata))
             # If we're given a DataFrame for the source, use that as source
             elif isinstance(source, pd.DataFrame):
-                source_metadata = source
+                source_metadata = source if usecols is None else source[[c for c in source.columns if c in usecols]]
             else:
                 raise ValueError(f'source must be a string, a Path object or a DataFrame, not {type(source).__name__}')
         except Exception as e:
             raise ValueError(f'Failed to load source with error: {str(e)}')
         return source_metadata
         
+    #Set to False to always make deep copies (e.g. as benchmark baseline); copies are never shallow without copy-on-write
+    SHALLOW_COPIES: bool = True
+
+    @classmethod
+    def _copy(cls, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Copy a DataFrame. Under copy-on-write (enabled when this module is imported) a shallow copy is enough: the data
+        is only copied when either frame is modified, so the copy costs no memory up front. If copy-on-write was
+        disabled afterwards, the copy is deep.
+        """
+        copy_on_write = int(pd.__version__.split('.')[0]) >= 3 or pd.options.mode.copy_on_write is True
+        return df.copy(deep=not (cls.SHALLOW_COPIES and copy_on_write))
+
     @staticmethod
     def _get_cols(df, cols_to_get: list = None) -> pd.DataFrame:
         """Retrieve specific columns from the DataFrame If cols_to_get is none, return the entire dataframe.
@@ -56,6 +101,197 @@ class MetaDataFrameHandler:
             """
         return df[cols_to_get] if cols_to_get else df
 
+    @property
+    def streaming(self) -> bool:
+        """Whether the handler is in streaming mode, see __init__"""
+        return bool(self._chunksize)
+
+    @property
+    def lazy(self) -> bool:
+        """Whether the handler is in lazy mode, see __init__"""
+        return self._lazy and not self.streaming
+
+    def _apply_operation(self, name: str, **kwargs) -> Optional[pd.DataFrame]:
+        """
+        Apply the operation `name` (the static method `_<name>`, a function of a DataFrame and kwargs that returns a
+        DataFrame) to the processed metadata. In streaming and lazy mode, the operation is added to the plan instead
+        and None is returned.
+        """
+        if self.streaming or self.lazy:
+            self._operations.append((name, kwargs))
+            self._processed_metadata = None         #Invalidate the result of a previous collect()
+            return None
+        rows_before = len(self._processed_metadata)
+        with Instrumentation.span(f'metadata.{name}', rows_in=rows_before) as span:
+            self._processed_metadata = getattr(self, f'_{name}')(self._processed_metadata, **kwargs)
+            span.set(rows_out=len(self._processed_metadata))
+        if name in self._ROW_FILTERS:
+            Instrumentation.count('rows_filtered', rows_before - len(self._processed_metadata))
+        return self._processed_metadata
+
+    #Row filter operations, which can be fused into a single mask, and the functions returning their boolean mask
+    _ROW_FILTERS = {'filter_by_key': '_mask_filter_by_key',
+                    'exclude_by_key': '_mask_exclude_by_key',
+                    'remove_nan': '_mask_remove_nan'}
+
+    def _optimized_plan(self) -> tuple:
+        """
+        Optimize the queued operations.
+
+        Returns:
+            tuple: The list of operations in which every run of consecutive row filters is replaced by one
+            'filter_by_masks' operation, and the list of source columns the plan needs (None if it needs all columns).
+        """
+        plan = []
+        for name, kwargs in self._operations:
+            if name in self._ROW_FILTERS:
+                if plan and plan[-1][0] == 'filter_by_masks':
+                    plan[-1][1]['filters'].append((name, kwargs))
+                else:
+                    plan.append(('filter_by_masks', {'filters': [(name, kwargs)]}))
+            else:
+                plan.append((name, kwargs))
+
+        #Walk the plan backwards to find the source columns that are needed; None means all columns
+        needed = None
+        for name, kwargs in reversed(self._operations):
+            if name == 'keep_columns' and kwargs['cols_to_get']:
+                needed = set(kwargs['cols_to_get'])
+            elif needed is None:
+                continue
+            elif name == 'rename_columns':
+                old_names = {new: old for old, new in kwargs['col_dict'].items()}
+                needed = {old_names.get(col, col) for col in needed}
+            elif name == 'remove_nan':
+                needed = needed | set(kwargs['cols']) if kwargs['cols'] else None
+            elif 'col' in kwargs:
+                needed = needed | {kwargs['col']}
+        return plan, None if needed is None else sorted(needed)
+
+    def _run_operations(self, df: pd.DataFrame, plan: List[tuple]) -> pd.DataFrame:
+        """Apply the operations of a plan to a DataFrame (the source or a chunk of the source CSV)"""
+        for name, kwargs in plan:
+            df = getattr(self, f'_{name}')(df, **kwargs)
+        return df
+
+    def _iter_processed_chunks(self):
+        """Stream the source file in chunks and yield each chunk after applying the queued operations"""
+        plan, usecols = self._optimized_plan()
+        for chunk in Utils.iter_table_chunks(self._source, self._chunksize, columns=usecols):
+            with Instrumentation.span('metadata.process_chunk', rows_in=len(chunk)) as span:
+                processed_chunk = self._run_operations(chunk, plan)
+                span.set(rows_out=len(processed_chunk))
+            Instrumentation.count('rows_filtered', len(chunk) - len(processed_chunk))     #Only row filters drop rows
+            yield processed_chunk
+
+    def collect(self) -> pd.DataFrame:
+        """
+        Execute the plan of a lazy handler, reading only the needed columns of the source, and return the result.
+        The result is kept until the plan changes. In eager mode, this returns the processed metadata.
+
+        Returns:
+            pd.DataFrame: The processed metadata
+        """
+        if self.streaming:
+            return pd.concat(self._iter_processed_chunks())
+        if self._processed_metadata is None:
+            plan, usecols = self._optimized_plan()
+            with Instrumentation.span('metadata.collect', operations=len(plan), columns=usecols) as span:
+                source_metadata = self.load_source(self._source, usecols=usecols)
+                self._processed_metadata = self._run_operations(source_metadata, plan)
+                span.set(rows_in=len(source_metadata), rows_out=len(self._processed_metadata))
+            Instrumentation.count('rows_filtered', len(source_metadata) - len(self._processed_metadata))
+        return self._processed_metadata
+
+    @property
+    def plan(self) -> List[tuple]:
+        """The optimized plan of the queued operations and the source columns it reads, see _optimized_plan"""
+        return self._optimized_plan()
+
+    def _require_materialized(self, action: str) -> None:
+        if self.streaming or self.lazy:
+            raise ValueError(f'Cannot {action} in streaming or lazy mode; create the MetaDataFrameHandler without chunksize and lazy')
+
+    @staticmethod
+    def _mask_exclude_by_key(df: pd.DataFrame, col: str, key: str) -> pd.Series:
+        return df[col] != key
+
+    @staticmethod
+    def _mask_filter_by_key(df: pd.DataFrame, col: str, key: str) -> pd.Series:
+        return df[col] == key
+
+    @staticmethod
+    def _mask_remove_nan(df: pd.DataFrame, cols: Optional[List[str]]) -> pd.Series:
+        return df[cols].notna().all(axis=1) if cols else df.notna().all(axis=1)
+
+    @classmethod
+    def _filter_by_masks(cls, df: pd.DataFrame, filters: List[tuple]) -> pd.DataFrame:
+        """Apply several row filters at once, by combining their masks and indexing the DataFrame once"""
+        mask = None
+        for name, kwargs in filters:
+            filter_mask = getattr(cls, cls._ROW_FILTERS[name])(df, **kwargs)
+            mask = filter_mask if mask is None else mask & filter_mask
+        return df[mask]
+
+    @classmethod
+    def _exclude_by_key(cls, df: pd.DataFrame, col: str, key: str) -> pd.DataFrame:
+        return df[cls._mask_exclude_by_key(df, col, key)]
+
+    @classmethod
+    def _filter_by_key(cls, df: pd.DataFrame, col: str, key: str) -> pd.DataFrame:
+        return df[cls._mask_filter_by_key(df, col, key)]
+
+    @staticmethod
+    def _remove_nan(df: pd.DataFrame, cols: Optional[List[str]]) -> pd.DataFrame:
+        return df.dropna(subset=cols) if cols else df.dropna()
+
+    @classmethod
+    def _keep_columns(cls, df: pd.DataFrame, cols_to_get: List[str]) -> pd.DataFrame:
+        return cls._get_cols(df, cols_to_get)
+
+    @staticmethod
+    def _rename_columns(df: pd.DataFrame, col_dict: dict[str,str]) -> pd.DataFrame:
+        return df.rename(columns=col_dict)
+
+    @staticmethod
+    def _join_root(paths: pd.Series, root: Path) -> pd.Series:
+        """
+        Join a root to a Series of relative paths with vectorized string operations, giving the same paths as
+        `root / path` (in posix form): separators are normalized, './' segments and trailing slashes are dropped
+        and absolute paths are kept as they are.
+        """
+        if paths.dtype == object:
+            paths = paths.astype('string')                      #Also converts Path objects; NaN stays missing
+        paths = paths.str.replace('\\', '/', regex=False)
+        paths = paths.str.replace(r'/{2,}', '/', regex=True)
+        paths = paths.str.replace(r'(^|/)(?:\./)+', r'\1', regex=True)
+        paths = paths.str.replace(r'(^|/)\.$', r'\1', regex=True)
+        is_absolute = paths.str.startswith('/', na=False).astype(bool)
+        paths = paths.str.rstrip('/').mask(is_absolute & paths.str.fullmatch('/+', na=False).astype(bool), '/')
+        root = root.as_posix()
+        prefix = '' if root == '.' else root if root.endswith('/') else root + '/'
+        joined = (prefix + paths).mask(is_absolute, paths)
+        return joined.mask(paths.eq('').fillna(False).astype(bool), root)
+
+    @classmethod
+    def _add_root_to_path(cls, df: pd.DataFrame, col: str, root: Path, path_type: str = 'str') -> pd.DataFrame:
+        paths = df[col]
+        if isinstance(paths.dtype, pd.CategoricalDtype):
+            #Only join the categories, and map the codes to the (possibly merged) joined categories
+            joined_codes, joined_categories = pd.factorize(cls._join_root(pd.Series(paths.cat.categories), root))
+            codes = paths.cat.codes.to_numpy()
+            joined = pd.Series(pd.Categorical.from_codes(np.where(codes >= 0, joined_codes[codes], -1), joined_categories),
+                               index=paths.index)
+        else:
+            joined = cls._join_root(paths, root)
+        if path_type == 'category':
+            joined = joined.astype('category')
+        elif path_type == 'path':
+            joined = joined.astype(object).map(Path, na_action='ignore')
+        elif path_type != 'str':
+            raise ValueError(f"path_type must be 'str', 'category' or 'path', not {path_type}")
+        return df.assign(**{col: joined})
+
     def exclude_by_key(self, col: str, key: str) -> pd.DataFrame:
         """
         Exclude rows where the column matches the key
@@ -64,8 +300,7 @@ class MetaDataFrameHandler:
         :param key: key to exclude
         """
         
-        self._processed_metadata = self._processed_metadata[~self._processed_metadata[col] == key]
-        return self._processed_metadata
+        return self._apply_operation('exclude_by_key', col=col, key=key)
 
     def filter_by_key(self, col: str,key: str):
         """
@@ -75,8 +310,7 @@ class MetaDataFrameHandler:
         :param key: key to filter
         """
         
-        self._processed_metadata = self._processed_metadata[self._processed_metadata[col] == key]
-        return self._processed_metadata
+        return self._apply_operation('filter_by_key', col=col, key=key)
                          
     def remove_nan(self, cols: Optional[List[str]]= None) -> pd.DataFrame:
         """
@@ -89,11 +323,7 @@ class MetaDataFrameHandler:
         Returns:
             pd.DataFrame: The processed metadata DataFrame with rows containing NaNs in specified columns or any column removed.
         """
-        if cols:
-             self._processed_metadata.dropna(subset=cols, inplace=True)
-        else:
-            self._processed_metadata.dropna(inplace=True) 
-        return self._processed_metadata
+        return self._apply_operation('remove_nan', cols=cols)
         
     def keep_columns(self, cols: List[str]) -> pd.DataFrame:
         """Keep only the specified column in the processed metadata
@@ -104,8 +334,7 @@ class MetaDataFrameHandler:
         Returns:
             pd.DataFrame: Altered state of _processed_metadata with only the specified columns
         """
-        self._processed_metadata = self._get_cols(self._processed_metadata, cols)
-        return self._processed_metadata
+        return self._apply_operation('keep_columns', cols_to_get=cols)
     
     def rename_columns(self, col_dict: dict[str,str]) -> pd.DataFrame:
         """Rename the column headers of the processed metadata according to the provided dictionary
@@ -117,17 +346,19 @@ class MetaDataFrameHandler:
         Returns:
             pd.DataFrame: Altered state of _processed_metadata with the new column names
         """
-        self._processed_metadata.rename(columns=col_dict, inplace=True)
-        return self._processed_metadata
+        return self._apply_operation('rename_columns', col_dict=col_dict)
     
-    def add_root_to_path(self, root: Optional[Union[str, Path]] = Path.cwd()) -> pd.DataFrame:
+    def add_root_to_path(self, root: Optional[Union[str, Path]] = Path.cwd(), path_type: str = 'str') -> pd.DataFrame:
         """
         Add the root path to each file path in the corresponding column of the processed metadata.
-        Default is the current directory.
+        Default is the current directory. The paths are joined with vectorized string operations; Path objects are only
+        created if path_type is 'path' (see also get_file_paths).
 
         Args:
             root (Union[str, Path, None]): The base path to prepend to each path in the column.
                                             If None, uses the current directory.
+            path_type (str): Type of the resulting paths: 'str' (default) for a string column, 'category' for a
+                             categorical column, or 'path' for a column of Path objects.
 
         Raises:
             ValueError: If root is neither a string, a Path object, nor None.
@@ -140,59 +371,92 @@ class MetaDataFrameHandler:
         if not isinstance(root, Path):
             raise ValueError(f'root must be a string or a Path object, but is {type(root)}')
         
-        self._processed_metadata[self.col_path] = self._processed_metadata[self.col_path].apply(lambda x: root /  x)
-        return self._processed_metadata
+        return self._apply_operation('add_root_to_path', col=self.col_path, root=root, path_type=path_type)
+
+    def get_file_paths(self, as_path: bool = True) -> List[Union[str, Path]]:
+        """
+        Return the file paths of the processed metadata as a list.
 
+        Args:
+            as_path (bool): Whether to return Path objects (default) or strings.
 
-    def move_processed_metadata_files(self, new_root: Optional[Union[str, Path]] = Path.cwd()/ 'chosen_files') -> pd.DataFrame:
+        Returns:
+            List[Union[str, Path]]: The file paths
+        """
+        paths = self.view_processed_metadata_columns([self.col_path])[self.col_path]
+        return [Path(p) if as_path else str(p) for p in paths]
+
+
+    def move_processed_metadata_files(self, 
+                                      new_root: Optional[Union[str, Path]] = Path.cwd()/ 'chosen_files',
+                                      max_workers: int = 8) -> pd.DataFrame:
         '''
         Locally moves the files in the processed metadata to a new location, which defaults to a (new) subdir chosen_files in the current working directory.
+        The directory structure of the files is kept under the new root (see FileMover.move_files_locally).
         Updates the filepaths in the processed metedata to the new location.
         
         Args:
             new_root: root directory of the target folder. Defaults to (new) subdir 'chosen_files' in the current working directory
-        
+            max_workers: number of files moved concurrently. Defaults to 8.
+
         Returns:
             Pd.DataFrame: dataframe with the file paths updated to the new location. Also perform the move operation self
         '''
+        self._require_materialized('move files')
         #Move the files to the new root directory and update the file paths in the metadata
         file_mover = FileMover(self._processed_metadata[self.col_path])
-        self._processed_metadata[self.col_path] = file_mover.move_files_locally(new_root)
+        self._processed_metadata[self.col_path] = file_mover.move_files_locally(new_root, max_workers=max_workers)
         return self._processed_metadata
      
-    def migrate_processed_metadata_files(self, new_root: Union[Path, str]) -> pd.DataFrame:
+    def migrate_processed_metadata_files(self, new_root: Union[Path, str], max_workers: int = 4) -> pd.DataFrame:
         '''
         Migrate the files in the processed metadata to a remote server. Host of the remote server can be provided as 
-        SSH_HOSTNAME in a .env file; user will be prompted for remote server if SSH_HOSTNAME is not specified in a .env file.
-        Username and password will be prompted for.
+        REMOTE_HOSTNAME in a .env file; user will be prompted for remote server if REMOTE_HOSTNAME is not specified in a .env file.
+        Authentication uses a key (REMOTE_KEY_FILENAME) or the SSH agent if available, and otherwise prompts for the password
+        once (see SSHClientHandler.connect_to_remote); all files are migrated in one batch (see FileMover.migrate_files).
+        The remote root is created if it does not exist.
         
         Args:
             new_root (Union[Path, str]): root directory of the target folder on the remote server (Path object or string)
+            max_workers (int): number of concurrent uploads. Defaults to 4.
 
         Returns:
             Pd.DataFrame: dataframe with the file paths updated to the new location. Also perform the move operation self
         '''
-        self.processed_metadata[self.col_path] = self.processed_metadata[self.col_path].apply(lambda x: FileMover.migrate_files(x, new_root))
+        self._require_materialized('migrate files')
+        file_mover = FileMover(self._processed_metadata[self.col_path])
+        self._processed_metadata[self.col_path] = file_mover.migrate_files(new_root, max_workers=max_workers)
+        return self._processed_metadata
     
-    def view_processed_metadata_columns(self, cols_to_keep: List[str]) -> pd.DataFrame:
+    def view_processed_metadata_columns(self, cols_to_keep: Optional[List[str]] = None) -> pd.DataFrame:
         """Return only the specified columns of the processed metadata; does not change the processed metadata.
+        The result shares its data with the processed metadata under copy-on-write, and a column is only copied when it
+        is modified in either frame, so changes to the result never reach the processed metadata. Without copy-on-write
+        (if it was disabled after importing this module) the result is a copy.
 
         Args:
-            cols_to_keep: (list[str]): list of the column headers to keep
+            cols_to_keep: (Optional[list[str]]): list of the column headers to keep. Defaults to None, meaning all columns.
 
         Returns:
             pd.DataFrame: processed metadata with only the specified columns
         """
-        return self._get_cols(self._processed_metadata.copy(), cols_to_get=cols_to_keep)
+        processed_metadata = self.collect()
+        if cols_to_keep or self.streaming:
+            #Selecting columns already gives a new frame (a lazy copy under copy-on-write), as does streaming
+            return self._get_cols(processed_metadata, cols_to_get=cols_to_keep)
+        return self._copy(processed_metadata)
     
     @property
     def processed_metadata(self) -> pd.DataFrame:
-        """Return the current state of the processed metadata
+        """Return the current state of the processed metadata.
+        In streaming mode, the source CSV is streamed through the queued operations and only the result is kept;
+        in lazy mode, the plan is executed (once) by collect(). The result shares its data with the processed metadata
+        until either is modified, see view_processed_metadata_columns.
 
         Returns:
             pd.DataFrame: The current state of the processed metadata
         """
-        return self._processed_metadata.copy() 
+        return self.view_processed_metadata_columns()
         
     def save_metadata_csv(self, 
                           csv_path: Optional[Union[Path, str]] = 'metadata_processed.csv', 
@@ -202,7 +466,9 @@ class MetaDataFrameHandler:
                           index: Optional[bool] = False) -> str:
         
         """
-        Saves specified columns of the processed metadata to a CSV file.
+        Saves specified columns of the processed metadata to a CSV file, or to a Parquet or Arrow IPC file if csv_path
+        has a .parquet or .arrow suffix (repetitive string columns are then stored dictionary-encoded; sep and headers are ignored).
+        In streaming mode, the source is processed and written chunk by chunk, so memory use does not depend on its size.
 
         Args:
         csv_path (Optional[Union[str, Path]]): The file path where the CSV will be saved. Defaults to 'metadata_processed.csv'.
@@ -220,39 +486,136 @@ class MetaDataFrameHandler:
         if not isinstance(csv_path, Path):
             raise ValueError(f'csv_path must be a string or a Path object, but is {type(csv_path)}')
         
-        to_save = self._get_cols(self._processed_metadata.copy(), cols_to_get=cols_to_keep)
+        if Utils.table_format(csv_path) != 'csv':
+            if self.streaming:
+                chunks = (self._get_cols(chunk, cols_to_get=cols_to_keep) for chunk in self._iter_processed_chunks())
+                return Utils.write_table(chunks, csv_path, index=index)
+            return Utils.write_table(self._get_cols(self.collect(), cols_to_get=cols_to_keep), csv_path, index=index)
+
+        if self.streaming:
+            for i, chunk in enumerate(self._iter_processed_chunks()):
+                to_save = self._get_cols(chunk, cols_to_get=cols_to_keep)
+                #Only the first chunk creates the file and writes the headers
+                to_save.to_csv(csv_path, sep=sep, header=headers and i == 0, index=index, mode='w' if i == 0 else 'a')
+            return csv_path
+
+        to_save = self._get_cols(self.collect(), cols_to_get=cols_to_keep)
         to_save.to_csv(csv_path, sep=sep, header=headers, index=index)
         return csv_path
     
     def revert_to_original_metadata(self) -> pd.DataFrame:
-        """Revert the processed metadata to the original metadata
+        """Revert the processed metadata to the original metadata. In streaming and lazy mode, the plan is discarded.
 
         Returns:
-            pd.DataFrame: The original metadata
+            pd.DataFrame: The original metadata (None in streaming and lazy mode)
         """
-        self._processed_metadata = self._source_metadata.copy()
+        self._operations.clear()
+        if self.streaming or self.lazy:
+            self._processed_metadata = None
+            return None
+        self._processed_metadata = self._copy(self._source_metadata)
         return self._processed_metadata
     
-    # def pick_random_test_files(self, N: int):
-    #     '''
-    #     Takes a (random) subsset of the metdata, where each present subset is of size N
-    #     '''
-    #     # Grouping the DataFrame based on the specified column
-    #     grouped_df = self.metadata.copy().groupby(self.label_col)
-        
-    #     # Initialize an empty list to store the randomized DFGroupByObjects
-    #     random_dfs = []
-        
-    #     # Loop through each group
-    #     for group_name, group_data in grouped_df:
-    #         # Randomly select N rows from each group
-    #         random_indices = np.random.choice(group_data.index, size=min(N, len(group_data)), replace=False)
-    #         random_dfs.append(group_data.loc[random_indices])
-        
-    #     #Concatenate the list of dataframes
-    #     self.metadata = pd.concat(random_dfs)
-    #     # Shuffle the rows in the new DataFrame
-    #     self.metadata = self.metadata.sample(frac=1).reset_index(drop=True)
-        
-    #     return self.metadata
-            
+    @staticmethod
+    def _per_label_values(labels: pd.Index, value: Union[None, float, dict], default: float) -> np.ndarray:
+        """A cap or ratio per label, in the order of labels, from a single value or a dict of label -> value"""
+        if isinstance(value, dict):
+            return pd.Series(labels).map(value).fillna(default).to_numpy(dtype=float)
+        return np.full(len(labels), default if value is None else value, dtype=float)
+
+    def _stratified_ranks(self, df: pd.DataFrame, seed: Optional[int], by_series: bool) -> tuple:
+        """
+        Shuffle the sampling units (the series if by_series, otherwise the rows) of every label at once.
+
+        Returns:
+            tuple: Per row, the code of its label (-1 for a missing label) and the random rank of its unit within the
+            label (all rows of a series share it); the labels; and the number of units per label.
+        """
+        if by_series:
+            unit_codes, _ = pd.factorize(df[self.col_uid])
+            #A series has one label; rows without a series UID are their own unit
+            no_uid = unit_codes < 0
+            unit_codes[no_uid] = unit_codes.max(initial=-1) + 1 + np.arange(no_uid.sum())
+        else:
+            unit_codes = np.arange(len(df))
+        n_units = unit_codes.max(initial=-1) + 1
+        #Label of every unit: the label of its first row
+        first_rows = np.full(n_units, len(df))
+        np.minimum.at(first_rows, unit_codes, np.arange(len(df)))
+        unit_label_codes, labels = pd.factorize(df[self.col_label].to_numpy()[first_rows])
+
+        #Sort the units by label and then by a random key; the position within the label is the rank
+        keys = np.random.default_rng(seed).random(n_units)
+        order = np.lexsort((keys, unit_label_codes))
+        sorted_codes = unit_label_codes[order]
+        unit_ranks = np.empty(n_units, dtype=np.int64)
+        unit_ranks[order] = np.arange(n_units) - np.searchsorted(sorted_codes, sorted_codes)
+        counts = np.bincount(unit_label_codes[unit_label_codes >= 0], minlength=len(labels))
+        return unit_label_codes[unit_codes], unit_ranks[unit_codes], pd.Index(labels), counts
+
+    def stratified_split(self, 
+                         test_ratio: Union[float, dict] = 0.2, 
+                         test_cap: Union[None, int, dict] = None,
+                         train_cap: Union[None, int, dict] = None,
+                         seed: Optional[int] = None,
+                         by_series: bool = True,
+                         col_split: Optional[str] = None) -> tuple:
+        """
+        Split the processed metadata into a train and a test set per label (col_label), with whole-column operations
+        instead of a loop over the labels. The units that are sampled are the series (col_uid) if by_series, so all
+        files of a series end up in the same set. Rows without a label are in neither set.
+
+        Args:
+            test_ratio (Union[float, dict]): Fraction of the units of every label that goes to the test set; a dict of
+            label -> fraction sets it per label (labels that are not in it get 0.2). Defaults to 0.2.
+            test_cap (Union[None, int, dict]): Maximum number of test units per label (or a dict per label). Defaults to None.
+            train_cap (Union[None, int, dict]): Maximum number of train units per label (or a dict per label); the
+            units above the caps are in neither set. Defaults to None.
+            seed (Optional[int]): Seed of the random generator, for a reproducible split. Defaults to None.
+            by_series (bool): Whether to keep the rows of a series together. Defaults to True.
+            col_split (Optional[str]): If given, a column with 'train', 'test' or None is also added to the processed
+            metadata (eager mode only). Defaults to None.
+
+        Returns:
+            tuple: The train and test DataFrames
+        """
+        df = self.collect()
+        label_codes, ranks, labels, counts = self._stratified_ranks(df, seed, by_series)
+        n_test = np.minimum(np.floor(self._per_label_values(labels, test_ratio, 0.2) * counts + 0.5),
+                            self._per_label_values(labels, test_cap, np.inf))
+        n_train = np.minimum(counts - n_test, self._per_label_values(labels, train_cap, np.inf))
+
+        #Broadcast the numbers per label to the rows; rows without a label (code -1) get the appended 0
+        row_n_test = np.append(n_test, 0)[label_codes]
+        is_test = ranks < row_n_test
+        is_train = ~is_test & (ranks < row_n_test + np.append(n_train, 0)[label_codes])
+        if col_split is not None:
+            self._require_materialized('add a split column')
+            self._processed_metadata = self._processed_metadata.assign(
+                **{col_split: np.select([is_train, is_test], ['train', 'test'], default=None)})
+            df = self._processed_metadata
+        return df[is_train], df[is_test]
+
+    def sample_per_label(self, 
+                         n: Union[int, dict], 
+                         seed: Optional[int] = None, 
+                         by_series: bool = True) -> pd.DataFrame:
+        """
+        Keep a random subset of (at most) n units per label (col_label) of the processed metadata, e.g. to pick test
+        files. The units are the series (col_uid) if by_series, so all files of a series are kept or dropped together.
+
+        Args:
+            n (Union[int, dict]): Number of units to keep per label, or a dict of label -> number (labels that are not
+            in it are dropped).
+            seed (Optional[int]): Seed of the random generator. Defaults to None.
+            by_series (bool): Whether to keep the rows of a series together. Defaults to True.
+
+        Returns:
+            pd.DataFrame: The sampled processed metadata, in the original row order
+        """
+        self._require_materialized('sample per label')
+        label_codes, ranks, labels, _ = self._stratified_ranks(self._processed_metadata, seed, by_series)
+        #Rows without a label (code -1) get the appended cap of 0
+        keep = ranks < np.append(self._per_label_values(labels, n, 0), 0)[label_codes]
+        self._processed_metadata = self._processed_metadata[keep]
+        return self._processed_metadata
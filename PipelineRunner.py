@@ -0,0 +1,203 @@
+import hashlib
+import json
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+import pandas as pd
+from MetaDataFrameHandler import MetaDataFrameHandler
+from LabelMapper import LabelMapper
+from LabelEncoder import LabelEncoder
+from MappingCache import MappingCache
+from Instrumentation import Instrumentation
+from Utils import Utils
+
+
+class PipelineRunner:
+    """
+    Runs the metadata pipeline (the flow of main.py) from a declarative YAML or JSON config, with a checkpoint per stage.
+
+    Every stage gets a key: a hash of its type and parameters, the key of the previous stage and the contents of its
+    input files (the metadata file for 'metadata', the acronym files for 'map_labels', the label map for 'encode_labels').
+    The output of a stage is stored
+    as a Parquet checkpoint named after its key, so a rerun skips all stages up to the last one whose key did not change
+    and only reruns the stages after it. Changing an acronym file, for example, only reruns 'map_labels' and later stages.
+
+    Example config (YAML):
+        checkpoint_dir: .pipeline_checkpoints
+        stages:
+          - type: metadata
+            source: files/prostate/metadata.csv
+            operations:
+              - filter_by_key: {col: Modality, key: MR}
+              - remove_nan: {cols: [Series Description]}
+              - add_root_to_path: {root: /data/dicom_source}
+          - type: save
+            path: metadata_processed.csv
+          - type: map_labels
+            acronym_dir: acronyms
+          - type: encode_labels
+            label_map: labelmap.json
+    """
+    #Stage type -> name of the method that runs it, a function of (DataFrame or None, parameters) returning a DataFrame
+    STAGES = {'metadata': '_run_metadata',
+              'map_labels': '_run_map_labels',
+              'encode_labels': '_run_encode_labels',
+              'split': '_run_split',
+              'save': '_run_save'}
+
+    def __init__(self, config: Union[str, Path, dict]) -> None:
+        """
+        Args:
+            config (Union[str, Path, dict]): The config, or the path of a YAML (.yaml/.yml) or JSON config file.
+        """
+        self._config = self.load_config(config) if isinstance(config, (str, Path)) else config
+        self._checkpoint_dir = Path(self._config.get('checkpoint_dir', '.pipeline_checkpoints'))
+        self._stages = self._config['stages']
+        for i, stage in enumerate(self._stages):
+            if stage.get('type') not in self.STAGES:
+                raise ValueError(f"Stage {i} has unknown type {stage.get('type')}; the types are {list(self.STAGES)}")
+            stage.setdefault('name', stage['type'] if [s['type'] for s in self._stages].count(stage['type']) == 1 else f"{stage['type']}_{i}")
+
+    @staticmethod
+    def load_config(config_path: Union[str, Path]) -> dict:
+        """Load a YAML (.yaml/.yml, needs PyYAML) or JSON config file"""
+        if Path(config_path).suffix.lower() in ('.yaml', '.yml'):
+            import yaml
+            with open(config_path) as f:
+                return yaml.safe_load(f)
+        return Utils.load_json(config_path)
+
+    @staticmethod
+    def _file_hash(file_path: Union[str, Path]) -> str:
+        sha = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+        return sha.hexdigest()
+
+    def _input_fingerprint(self, stage: dict) -> Optional[str]:
+        """Fingerprint of the files a stage reads, besides the output of the previous stage"""
+        if stage['type'] == 'metadata':
+            return self._file_hash(stage['source'])
+        if stage['type'] == 'map_labels':
+            return MappingCache.fingerprint_acronyms(stage.get('acronym_dir', 'acronyms'))
+        if stage['type'] == 'encode_labels':
+            label_map = Path(stage.get('label_map', 'labelmap.json'))
+            return self._file_hash(label_map) if label_map.is_file() else None
+        return None
+
+    def _stage_key(self, stage: dict, previous_key: Optional[str]) -> str:
+        key_data = {'stage': stage, 'previous': previous_key, 'inputs': self._input_fingerprint(stage)}
+        return hashlib.sha256(json.dumps(key_data, sort_keys=True, default=str).encode()).hexdigest()
+
+    def stage_keys(self) -> List[str]:
+        """The key of every stage: a hash of its parameters, input files and the key of the previous stage"""
+        keys = []
+        previous_key = None
+        for stage in self._stages:
+            previous_key = self._stage_key(stage, previous_key)
+            keys.append(previous_key)
+        return keys
+
+    def _checkpoint_path(self, stage: dict, key: str) -> Path:
+        return self._checkpoint_dir / f"{stage['name']}-{key[:16]}.parquet"
+
+    def _is_done(self, stage: dict, key: str) -> bool:
+        """Whether the checkpoint of a stage exists, and the file it writes (the output file, the unmapped labels or the
+        label map) as well"""
+        if stage['type'] == 'save' and not Path(stage['path']).is_file():
+            return False
+        if stage['type'] == 'map_labels' and not Path(stage.get('unmapped_labels', 'unmapped_labels.txt')).is_file():
+            return False
+        if stage['type'] == 'encode_labels' and not Path(stage.get('label_map', 'labelmap.json')).is_file():
+            return False
+        return self._checkpoint_path(stage, key).is_file()
+
+    def run(self, force: bool = False) -> pd.DataFrame:
+        """
+        Run the pipeline, skipping the stages whose checkpoint is up to date.
+
+        Args:
+            force (bool): Whether to rerun all stages. Defaults to False.
+
+        Returns:
+            pd.DataFrame: The output of the last stage
+        """
+        self._checkpoint_dir.mkdir(parents=True, exist_ok=True)
+        keys = self.stage_keys()
+        #Resume after the last stage of the longest prefix of stages that is up to date
+        first_to_run = 0
+        while not force and first_to_run < len(self._stages) and self._is_done(self._stages[first_to_run], keys[first_to_run]):
+            print(f"Stage {self._stages[first_to_run]['name']} is up to date")
+            first_to_run += 1
+        if first_to_run == len(self._stages):
+            return Utils.read_table(self._checkpoint_path(self._stages[-1], keys[-1]))
+        df = Utils.read_table(self._checkpoint_path(self._stages[first_to_run - 1], keys[first_to_run - 1])) if first_to_run else None
+
+        previous_key = keys[first_to_run - 1] if first_to_run else None
+        for stage in self._stages[first_to_run:]:
+            key = self._stage_key(stage, previous_key)
+            print(f"Running stage {stage['name']}")
+            params = {k: v for k, v in stage.items() if k not in ('type', 'name')}
+            with Instrumentation.span(f"pipeline.{stage['name']}", key=key[:16]):
+                df = getattr(self, self.STAGES[stage['type']])(df, **params)
+            if stage['type'] == 'encode_labels':
+                #The label map is read and extended by the stage, so the key is that of the label map it leaves behind
+                key = self._stage_key(stage, previous_key)
+            previous_key = key
+            #Remove the outdated checkpoints of the stage and store the new one
+            for outdated in self._checkpoint_dir.glob(f"{stage['name']}-*.parquet"):
+                outdated.unlink()
+            Utils.write_table(df, self._checkpoint_path(stage, key))
+        return df
+
+    @staticmethod
+    def _run_metadata(df: Optional[pd.DataFrame],
+                      source: str,
+                      operations: List[Dict[str, dict]] = [],
+                      col_path: str = 'File Location',
+                      col_label: str = 'Series Description',
+                      col_uid: str = 'Series UID') -> pd.DataFrame:
+        """Load the metadata file and apply the operations (MetaDataFrameHandler methods with their keyword arguments) lazily"""
+        metadata = MetaDataFrameHandler(source=source, col_path=col_path, col_label=col_label, col_uid=col_uid, lazy=True)
+        for operation in operations:
+            (name, kwargs), = operation.items()
+            getattr(metadata, name)(**(kwargs or {}))
+        return metadata.collect()
+
+    @staticmethod
+    def _run_map_labels(df: pd.DataFrame,
+                        acronym_dir: str = 'acronyms',
+                        cache_path: Optional[str] = None,
+                        column: str = 'Series Description',
+                        output_column: Optional[str] = None,
+                        unmapped_labels: str = 'unmapped_labels.txt') -> pd.DataFrame:
+        """Map the labels of a column with LabelMapper (into output_column, by default the column itself)"""
+        label_mapper = LabelMapper(acronym_dir=Path(acronym_dir), cache_path=cache_path)
+        df = df.assign(**{output_column or column: label_mapper.map_labels(df[column], save_unmapped=False)})
+        label_mapper.save_unmapped_labels(unmapped_labels)
+        return df
+
+    @staticmethod
+    def _run_encode_labels(df: pd.DataFrame,
+                           label_map: str = 'labelmap.json',
+                           column: str = 'Series Description',
+                           output_column: str = 'Label') -> pd.DataFrame:
+        """Add the numeric labels of a column (see LabelEncoder) and save the label map"""
+        label_encoder = LabelEncoder(label_map=label_map)
+        df = df.assign(**{output_column: label_encoder.encode(df[column])})
+        label_encoder.save_label_map(label_map)
+        return df
+
+    @staticmethod
+    def _run_split(df: pd.DataFrame, col_split: str = 'Split', col_label: str = 'Series Description',
+                   col_uid: str = 'Series UID', **split_kwargs) -> pd.DataFrame:
+        """Add a train/test column with MetaDataFrameHandler.stratified_split"""
+        metadata = MetaDataFrameHandler(source=df, col_label=col_label, col_uid=col_uid)
+        metadata.stratified_split(col_split=col_split, **split_kwargs)
+        return metadata.processed_metadata
+
+    @staticmethod
+    def _run_save(df: pd.DataFrame, path: str = 'metadata_processed.csv', **save_kwargs) -> pd.DataFrame:
+        """Save the metadata with MetaDataFrameHandler.save_metadata_csv (CSV, Parquet or Arrow IPC, by suffix)"""
+        MetaDataFrameHandler(source=df).save_metadata_csv(csv_path=path, **save_kwargs)
+        return df
@@ -1,6 +1,28 @@
+import mmap
+import os
+import struct
 import pydicom
-from pydicom.datadict import  dictionary_description
+from pydicom.datadict import  dictionary_description, tag_for_keyword
+from pydicom.dataelem import RawDataElement, convert_raw_data_element
+from pydicom.charset import convert_encodings
+from pydicom.uid import UID
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+
+#Columns of the metadata.csv (as used by MetaDataFrameHandler) and the DICOM keywords they are read from
+METADATA_TAGS = {
+    'Series UID': 'SeriesInstanceUID',
+    'Study UID': 'StudyInstanceUID',
+    'Subject ID': 'PatientID',
+    'Study Description': 'StudyDescription',
+    'Series Description': 'SeriesDescription',
+    'Manufacturer': 'Manufacturer',
+    'Modality': 'Modality',
+    'SOP Class UID': 'SOPClassUID',
+}
 
 def read_all_dicom_headers(dicom_file_path: str) -> list:
     """
@@ -38,8 +60,6 @@ def read_all_dicom_headers(dicom_file_path: str) -> list:
         print(f"Error reading DICOM file: {e}")
         return []
 
-# Example usage
-
 
 def read_scan_type(dicom_file_path: str) -> str:
     """
@@ -52,9 +72,6 @@ def read_scan_type(dicom_file_path: str) -> str:
         str: A string describing the scan type if identified, otherwise 'Unknown'.
     """
     try:
-        # Load the DICOM file
-        dicom_data = pydicom.dcmread(dicom_file_path)
-
         # Potential DICOM tags that might contain scan type information
         tags_to_check = {
             'StudyDescription': (0x0008, 0x1030),
@@ -64,6 +81,9 @@ def read_scan_type(dicom_file_path: str) -> str:
             'SequenceVariant': (0x0018, 0x0021)
         }
 
+        # Load only the tags we check from the DICOM file, never the pixel data
+        dicom_data = pydicom.dcmread(dicom_file_path, stop_before_pixels=True, specific_tags=list(tags_to_check.values()))
+
         # Check each tag and return the value if it exists
         for name, tag in tags_to_check.items():
             if tag in dicom_data:
@@ -76,11 +96,330 @@ def read_scan_type(dicom_file_path: str) -> str:
     except Exception as e:
         return f"Error reading DICOM file: {e}"
 
+
+def read_dicom_tags(dicom_file_path: Union[str, Path], tags: Dict[str, str] = METADATA_TAGS) -> Optional[dict]:
+    """
+    Reads a subset of the tags from a DICOM file, without reading the pixel data or any other element.
+
+    Args:
+        dicom_file_path (Union[str, Path]): Path to the DICOM file.
+        tags (Dict[str, str]): Dictionary of output column name -> DICOM keyword of the tags to read.
+
+    Returns:
+        dict: Dictionary of column name -> value as string (None if the tag is not present),
+        or None if the file could not be read.
+    """
+    try:
+        dicom_data = pydicom.dcmread(dicom_file_path, stop_before_pixels=True, specific_tags=list(tags.values()))
+    except Exception as e:
+        print(f"Error reading DICOM file {dicom_file_path}: {e}")
+        return None
+    row = {}
+    for column, keyword in tags.items():
+        value = dicom_data.get(keyword)
+        row[column] = None if value is None else str(value)
+    return row
+
+
+#Explicit VRs whose length is 4 bytes (after 2 reserved bytes) instead of 2
+_LONG_LENGTH_VRS = {b'OB', b'OD', b'OF', b'OL', b'OV', b'OW', b'SQ', b'SV', b'UC', b'UN', b'UR', b'UT', b'UV'}
+_UNDEFINED_LENGTH = 0xFFFFFFFF
+_ITEM, _ITEM_DELIMITER, _SEQUENCE_DELIMITER = 0xFFFEE000, 0xFFFEE00D, 0xFFFEE0DD
+_SPECIFIC_CHARACTER_SET = 0x00080005
+_TRANSFER_SYNTAX_UID = 0x00020010
+
+
+def _skip_items(buffer, offset: int) -> int:
+    """The offset after the sequence delimiter of the items (of an undefined length sequence) that start at offset"""
+    while True:
+        tag, length = struct.unpack_from('<LL', buffer, offset)
+        tag = (tag & 0xFFFF) << 16 | tag >> 16                 #(group, element) are stored as two little-endian uint16
+        offset += 8
+        if tag == _SEQUENCE_DELIMITER:
+            return offset
+        if tag != _ITEM:
+            raise ValueError(f'unexpected tag {tag:08X} in a sequence')
+        offset = _scan_explicit_vr_le(buffer, offset, (), 0xFFFFFFFF)[1] if length == _UNDEFINED_LENGTH else offset + length
+
+
+def _scan_explicit_vr_le(buffer, offset: int, wanted, stop_tag: int) -> tuple:
+    """
+    Scan explicit VR little endian elements from offset, up to (and including) stop_tag, the end of the buffer, or the
+    item delimiter of an undefined length item. Nested sequences are skipped.
+
+    Returns:
+        tuple: Dictionary of tag -> (VR, value offset, value bytes) of the wanted tags, and the offset where the scan stopped.
+    """
+    elements = {}
+    end = len(buffer)
+    while offset + 8 <= end:
+        group, element = struct.unpack_from('<HH', buffer, offset)
+        tag = group << 16 | element
+        if tag == _ITEM_DELIMITER:
+            return elements, offset + 8
+        if tag > stop_tag:
+            break
+        vr = buffer[offset + 4:offset + 6]
+        if not vr.isalpha() or not vr.isupper():
+            raise ValueError(f'no explicit VR for tag {tag:08X}')
+        if vr in _LONG_LENGTH_VRS:
+            length, = struct.unpack_from('<L', buffer, offset + 8)
+            offset += 12
+        else:
+            length, = struct.unpack_from('<H', buffer, offset + 6)
+            offset += 8
+        if tag in wanted and (length == _UNDEFINED_LENGTH or vr == b'SQ'):
+            #The value of a sequence (or of any undefined length element) is left to pydicom
+            raise ValueError(f'requested tag {tag:08X} is a sequence')
+        if length == _UNDEFINED_LENGTH:
+            #Items of sequences and encapsulated pixel data; the items of undefined length UN elements are implicit VR
+            if vr == b'UN':
+                raise ValueError(f'undefined length UN element {tag:08X}')
+            offset = _skip_items(buffer, offset)
+            continue
+        if tag in wanted:
+            elements[tag] = (vr.decode('ascii'), offset, buffer[offset:offset + length])
+        offset += length
+    return elements, offset
+
+
+def read_dicom_tags_fast(dicom_file_path: Union[str, Path], 
+                         tags: Dict[str, str] = METADATA_TAGS,
+                         stop_tag: Optional[int] = None) -> Optional[dict]:
+    """
+    Reads a subset of the tags from a DICOM file like read_dicom_tags, but without pydicom parsing the file into a
+    Dataset: the file is memory-mapped and the explicit VR little endian elements are scanned only up to the stop tag,
+    so the pages beyond it (e.g. the pixel data) are never read. Only the values of the requested tags are converted,
+    with pydicom, so they are identical to those of read_dicom_tags.
+    Files without a DICM preamble, with an implicit VR, big endian or deflated transfer syntax, or in which a requested
+    tag is a sequence (or has an undefined length), are read with read_dicom_tags instead.
+
+    Args:
+        dicom_file_path (Union[str, Path]): Path to the DICOM file.
+        tags (Dict[str, str]): Dictionary of output column name -> DICOM keyword of the tags to read.
+        stop_tag (Optional[int]): The last tag that is scanned, e.g. 0x0020000E. Defaults to None, meaning the largest
+        of the requested tags.
+
+    Returns:
+        dict: Dictionary of column name -> value as string (None if the tag is not present),
+        or None if the file could not be read.
+    """
+    tag_of_column = {column: tag_for_keyword(keyword) for column, keyword in tags.items()}
+    unknown = [tags[column] for column, tag in tag_of_column.items() if tag is None]
+    if unknown:
+        raise ValueError(f'Unknown DICOM keywords: {unknown}')
+    stop_tag = stop_tag if stop_tag is not None else max(tag_of_column.values(), default=0)
+    try:
+        with open(dicom_file_path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            if buffer[128:132] != b'DICM':
+                raise ValueError('no DICM preamble')
+            #The file meta information (group 0002) is always explicit VR little endian
+            meta, offset = _scan_explicit_vr_le(buffer, 132, {_TRANSFER_SYNTAX_UID}, 0x0002FFFF)
+            transfer_syntax = UID(meta[_TRANSFER_SYNTAX_UID][2].rstrip(b'\0 ').decode('ascii'))
+            if transfer_syntax.is_implicit_VR or not transfer_syntax.is_little_endian or transfer_syntax.is_deflated:
+                raise ValueError(f'transfer syntax {transfer_syntax}')
+            elements, _ = _scan_explicit_vr_le(buffer, offset, set(tag_of_column.values()) | {_SPECIFIC_CHARACTER_SET}, 
+                                               max(stop_tag, _SPECIFIC_CHARACTER_SET))
+    except (OSError, ValueError, KeyError, struct.error):
+        #Unusual files (and unreadable ones, which read_dicom_tags reports) are read with pydicom
+        return read_dicom_tags(dicom_file_path, tags)
+
+    def value_of(tag: int, encoding=None):
+        vr, value_tell, value = elements[tag]
+        raw = RawDataElement(tag, vr, len(value), value, value_tell, False, True)
+        return convert_raw_data_element(raw, encoding=encoding).value
+
+    encoding = convert_encodings(value_of(_SPECIFIC_CHARACTER_SET)) if _SPECIFIC_CHARACTER_SET in elements else None
+    row = {}
+    for column, tag in tag_of_column.items():
+        row[column] = str(value_of(tag, encoding)) if tag in elements else None
+    return row
+
+
+def find_dicom_files(dicom_root: Union[str, Path], extension: Optional[str] = '.dcm') -> List[str]:
+    """
+    Recursively finds all DICOM files under a root directory.
+
+    Args:
+        dicom_root (Union[str, Path]): Root directory of the DICOM files.
+        extension (Optional[str]): Extension of the DICOM files. If None, every file is returned.
+
+    Returns:
+        List[str]: Sorted list of the paths of the DICOM files.
+    """
+    dicom_files = []
+    for dirpath, _, filenames in os.walk(dicom_root):
+        dicom_files.extend(os.path.join(dirpath, filename) for filename in filenames
+                           if extension is None or filename.endswith(extension))
+    return sorted(dicom_files)
+
+
+def _read_tags_of_files(dicom_files: List[str], tags: Dict[str, str], workers: Optional[int], chunksize: int, 
+                        fast: bool = False) -> List[Optional[dict]]:
+    """Read the tags of the files (with read_dicom_tags_fast if fast), with a process pool unless there are few files or workers is 1"""
+    read_tags = partial(read_dicom_tags_fast if fast else read_dicom_tags, tags=tags)
+    if workers == 1 or len(dicom_files) <= chunksize:
+        return [read_tags(dicom_file) for dicom_file in dicom_files]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(read_tags, dicom_files, chunksize=chunksize))
+
+
+def _read_first_readable(file_lists: List[List[str]], tags: Dict[str, str], workers: Optional[int], chunksize: int,
+                         fast: bool = False) -> tuple:
+    """
+    Read the tags of the first file of every file list, and of the next file of the lists whose file could not be read.
+
+    Returns:
+        tuple: The row of every file list (None if none of its files could be read) and the number of headers that were read.
+    """
+    rows = [None] * len(file_lists)
+    pending = list(range(len(file_lists)))
+    reads = 0
+    position = 0
+    while pending:
+        pending = [i for i in pending if position < len(file_lists[i])]
+        read = _read_tags_of_files([file_lists[i][position] for i in pending], tags, workers, chunksize, fast)
+        reads += len(read)
+        for i, row in zip(pending, read):
+            rows[i] = row
+        pending = [i for i, row in zip(pending, read) if row is None]
+        position += 1
+    return rows, reads
+
+
+def _sample_series(dicom_files: List[str], tags: Dict[str, str], sample_series: str,
+                   workers: Optional[int], chunksize: int, fast: bool = False) -> tuple:
+    """
+    Group the files per series and read one representative header per series.
+
+    With sample_series='directory' every directory is assumed to hold one series, and the first readable file of the
+    directory is read. With sample_series='uid' the Series Instance UID of every file is read, the files are grouped
+    per directory and UID, and the other tags are only read from the first readable file of every group. A series
+    in any position of a directory is found this way, at the cost of a UID read per file.
+
+    Returns:
+        tuple: List of (row, files) per series, where row is None if none of the files could be read,
+        and the number of headers that were read (not counting the UID reads).
+    """
+    directories = {}
+    for dicom_file in dicom_files:
+        directories.setdefault(os.path.dirname(dicom_file), []).append(dicom_file)
+
+    if sample_series == 'directory':
+        groups = list(directories.values())
+    elif sample_series == 'uid':
+        groups = {}
+        uids = _read_tags_of_files(dicom_files, {'_uid': 'SeriesInstanceUID'}, workers, chunksize, fast)
+        for dicom_file, row in zip(dicom_files, uids):
+            if row is not None:
+                groups.setdefault((os.path.dirname(dicom_file), row['_uid']), []).append(dicom_file)
+        unreadable = sum(row is None for row in uids)
+        if unreadable:
+            print(f"WARNING: skipping {unreadable} unreadable DICOM files")
+        groups = list(groups.values())
+    else:
+        raise ValueError(f"sample_series must be None, 'directory' or 'uid', not {sample_series}")
+    rows, reads = _read_first_readable(groups, tags, workers, chunksize, fast)
+    return list(zip(rows, groups)), reads
+
+
+def scan_dicom_root(dicom_root: Union[str, Path],
+                    tags: Dict[str, str] = METADATA_TAGS,
+                    extension: Optional[str] = '.dcm',
+                    workers: Optional[int] = None,
+                    chunksize: int = 64,
+                    col_path: str = 'File Location',
+                    sample_series: Optional[str] = None,
+                    expand: bool = False,
+                    fast: bool = False) -> pd.DataFrame:
+    """
+    Reads a subset of the tags of all DICOM files under a root directory with a process pool.
+    The file paths are relative to the root (like the 'File Location' column of a metadata.csv), so the result can
+    be used as source of MetaDataFrameHandler and completed with add_root_to_path.
+
+    Series-level tags are identical for every slice of a series, so with sample_series only one representative
+    header is read per series (see _sample_series). The result then has one row per series, with the series
+    directory as path and the number of files in 'Number of Images', unless expand is True.
+
+    Args:
+        dicom_root (Union[str, Path]): Root directory of the DICOM files.
+        tags (Dict[str, str]): Dictionary of output column name -> DICOM keyword of the tags to read.
+        extension (Optional[str]): Extension of the DICOM files. If None, every file is read.
+        workers (Optional[int]): Number of worker processes. Defaults to the number of CPUs; 1 reads serially.
+        chunksize (int): Number of files sent to a worker at once.
+        col_path (str): Name of the column with the relative file paths.
+        sample_series (Optional[str]): None to read every file, 'directory' to read one file per directory, or 'uid'
+            to read one file per directory and Series Instance UID. With 'uid' the Series Instance UID is added as
+            'Series UID' column if it is not among the tags, since several series can share a directory. Defaults to None.
+        expand (bool): With sample_series, expand the series rows back to one row per file. Defaults to False.
+        fast (bool): Whether to read the headers with read_dicom_tags_fast, which only scans the elements up to the
+            requested tags instead of parsing the file with pydicom. Defaults to False.
+
+    Returns:
+        pd.DataFrame: DataFrame with the file path column and one column per tag. Unreadable files are left out.
+        The number of header reads that were skipped is stored in metadata.attrs['skipped_reads'].
+    """
+    dicom_files = find_dicom_files(dicom_root, extension)
+    relative_path = lambda path: './' + Path(os.path.relpath(path, dicom_root)).as_posix()
+    
+    if sample_series is None:
+        rows = _read_tags_of_files(dicom_files, tags, workers, chunksize, fast)
+        readable = [i for i, row in enumerate(rows) if row is not None]
+        if len(readable) < len(rows):
+            print(f"WARNING: {len(rows) - len(readable)} of {len(rows)} DICOM files could not be read")
+        metadata = pd.DataFrame([rows[i] for i in readable], columns=list(tags.keys()))
+        metadata.insert(0, col_path, [relative_path(dicom_files[i]) for i in readable])
+        metadata.attrs['skipped_reads'] = 0
+        return metadata
+
+    if sample_series == 'uid' and 'SeriesInstanceUID' not in tags.values():
+        #The series of a directory would otherwise have the same path and nothing to tell them apart
+        tags = {**tags, 'Series UID': 'SeriesInstanceUID'}
+    series, reads = _sample_series(dicom_files, tags, sample_series, workers, chunksize, fast)
+    unreadable = [files[0] for row, files in series if row is None]
+    if unreadable:
+        print(f"WARNING: {len(unreadable)} series could not be read, e.g. {unreadable[0]}")
+    series = [(row, files) for row, files in series if row is not None]
+    skipped_reads = len(dicom_files) - reads
+    uid_reads = ' (and the Series Instance UID of every file)' if sample_series == 'uid' else ''
+    print(f"Read {reads} headers{uid_reads} for {len(dicom_files)} DICOM files in {len(series)} series; skipped {skipped_reads} reads")
+
+    if expand:
+        metadata = pd.DataFrame([row for row, files in series for _ in files], columns=list(tags.keys()))
+        metadata.insert(0, col_path, [relative_path(dicom_file) for _, files in series for dicom_file in files])
+    else:
+        metadata = pd.DataFrame([row for row, _ in series], columns=list(tags.keys()))
+        metadata.insert(0, col_path, [relative_path(os.path.dirname(files[0])) for _, files in series])
+        metadata['Number of Images'] = [len(files) for _, files in series]
+    metadata.attrs['skipped_reads'] = skipped_reads
+    return metadata
+
+
+def build_metadata_csv(dicom_root: Union[str, Path],
+                       csv_path: Union[str, Path] = 'metadata.csv',
+                       **scan_kwargs) -> Path:
+    """
+    Scans a DICOM root (see scan_dicom_root) and writes the result as a metadata.csv with headers.
+
+    Args:
+        dicom_root (Union[str, Path]): Root directory of the DICOM files.
+        csv_path (Union[str, Path]): Path of the metadata csv to write. Defaults to 'metadata.csv'.
+        scan_kwargs: Keyword arguments passed on to scan_dicom_root.
+
+    Returns:
+        Path: The path to the saved CSV file.
+    """
+    metadata = scan_dicom_root(dicom_root, **scan_kwargs)
+    metadata.to_csv(csv_path, index=False, header=True)
+    return Path(csv_path)
+
+
 # Example usage
-path = '/home/donpi-boxer/BME/Thesis/data/kidney/manifest-xxn3N2Qq630907925598003437/TCGA-KIRC/TCGA-B0-4698/11-22-1985-NA-CT ABDOMEN-45292/1.000000-SCOUT APLAT-41044/1-1.dcm'
-scan_type = read_scan_type(path)
-#print(scan_type)
-all_headers = read_all_dicom_headers(path)
-print(all_headers)
-header_df = pd.DataFrame(all_headers)
-header_df.to_csv('header_info.csv', index=False, header=True)
\ No newline at end of file
+if __name__ == '__main__':
+    path = '/home/donpi-boxer/BME/Thesis/data/kidney/manifest-xxn3N2Qq630907925598003437/TCGA-KIRC/TCGA-B0-4698/11-22-1985-NA-CT ABDOMEN-45292/1.000000-SCOUT APLAT-41044/1-1.dcm'
+    scan_type = read_scan_type(path)
+    #print(scan_type)
+    all_headers = read_all_dicom_headers(path)
+    print(all_headers)
+    header_df = pd.DataFrame(all_headers)
+    header_df.to_csv('header_info.csv', index=False, header=True)
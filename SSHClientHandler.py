@@ -1,15 +1,46 @@
 import os
-from paramiko import SSHClient, RejectPolicy
+import queue
+import re
+import shlex
+import threading
+import atexit
+from contextlib import contextmanager
+from paramiko import Agent, AuthenticationException, SSHClient, SSHException, RejectPolicy, MissingHostKeyPolicy
 import getpass
 from dotenv import load_dotenv
 import sys
+from typing import Dict, Iterable, List, Optional
+from Instrumentation import Instrumentation
+
+
+#Process-wide cache of connected sessions: (hostname, port) -> (credentials, client), so repeated connections in one
+#job (e.g. several migrations) reuse the same transport and ask for the credentials only once
+_SESSIONS: Dict[tuple, tuple] = {}
+_SESSIONS_LOCK = threading.Lock()
 
 
 #TODO: create new class with these three functions beneath ?
 class SSHClientHandler(SSHClient):
-    def __init__(self) -> None:
+    def __init__(self, 
+                 missing_host_key_policy: Optional[MissingHostKeyPolicy] = None,
+                 reuse_session: bool = True,
+                 keepalive: Optional[int] = None) -> None:
+        """
+        Args:
+            missing_host_key_policy (Optional[MissingHostKeyPolicy]): Policy for hosts that are not in the system known
+            hosts. Defaults to None, meaning unknown hosts are rejected.
+            reuse_session (bool): Whether to use (and share) the process-wide cached session of the host. Disconnecting
+            then only releases the session; close_sessions closes it. Defaults to True.
+            keepalive (Optional[int]): Interval in seconds of the keepalive packets. Defaults to None, meaning
+            REMOTE_KEEPALIVE from the .env file or 30.
+        """
         super().__init__()      #Initialize the SSHClient
         self._ssh = None        #Initialize the SSH connection as None
+        self._credentials = None    #Connection arguments, asked for once and reused by open_client
+        #Policy for hosts that are not in the system known hosts; rejects them by default
+        self._missing_host_key_policy = missing_host_key_policy or RejectPolicy()
+        self._reuse_session = reuse_session
+        self._keepalive = keepalive
         
         #TODO /#FIXME : not sure if we want to connect on initialization ? Maybe just let the user connect when he wants to ?
         #We make a connection on initialization of this class
@@ -30,31 +61,136 @@ class SSHClientHandler(SSHClient):
     
     @staticmethod
     def _get_username() -> str:
-        """Prompts the user for the username"""
-        return input('Username: ')                
+        """Retrieves the username from a .env file or prompts the user if not available."""
+        return os.getenv('REMOTE_USERNAME') or input('Username: ')
         
     @staticmethod
     def _get_password() -> str:
         """Prompts the user for the password. Password not visible during input."""
         return getpass.getpass('Password: ')
+
+    @staticmethod
+    def _agent_has_keys() -> bool:
+        """Whether an SSH agent with at least one key is available"""
+        try:
+            return len(Agent().get_keys()) > 0
+        except SSHException:
+            return False
+        
+    def _new_client(self) -> SSHClient:
+        """Create an SSHClient that knows the system host keys and uses the missing host key policy"""
+        client = SSHClient()
+        client.load_system_host_keys()
+        client.set_missing_host_key_policy(self._missing_host_key_policy)    # Reject unknown host keys unless configured otherwise
+        return client
+
+    def _connect_client(self, client: SSHClient) -> SSHClient:
+        """Connect a client with the credentials (falling back to a password prompt if key authentication is refused
+        in an interactive session) and enable the keepalive"""
+        try:
+            with Instrumentation.span('ssh.connect', hostname=self._credentials['hostname']):
+                client.connect(**self._credentials)
+        except AuthenticationException:
+            if self._credentials['password'] is not None or not sys.stdin.isatty():
+                raise
+            print('Key authentication failed')
+            self._credentials.update(password=self._get_password(), allow_agent=False, look_for_keys=False)
+            client.connect(**self._credentials)
+        Instrumentation.count('ssh_connections')
+        keepalive = self._keepalive if self._keepalive is not None else int(os.getenv('REMOTE_KEEPALIVE', 30))
+        client.get_transport().set_keepalive(keepalive)
+        return client
+
+    @staticmethod
+    def _is_active(client: Optional[SSHClient]) -> bool:
+        transport = client.get_transport() if client is not None else None
+        return transport is not None and transport.is_active()
+        
+    def connect_to_remote(self, 
+                          hostname: Optional[str] = None, 
+                          username: Optional[str] = None, 
+                          password: Optional[str] = None,
+                          port: Optional[int] = None,
+                          key_filename: Optional[str] = None):
+        """
+        Connect to the remote server using the SSH credentials. Credentials that are not given are read from the .env
+        file (REMOTE_HOSTNAME, REMOTE_PORT, REMOTE_USERNAME, REMOTE_KEY_FILENAME, REMOTE_KEY_PASSPHRASE) or prompted
+        for. A password is only asked for if there is no key file and no SSH agent with keys, so runs with key or agent
+        authentication are unattended. The credentials are asked for once and reused by open_client.
         
-    def connect_to_remote(self):
-        """Connect to the remote server using the SSH credentials"""
-        if not self._ssh:
-            self._ssh = SSHClient()
-            self._ssh.load_system_host_keys()
-            self._ssh.set_missing_host_key_policy(RejectPolicy())    # Set policy to reject if the host key is unknown
+        With reuse_session, a connected session to the same host in this process is reused (including its credentials),
+        instead of opening a new connection.
+        """
+        load_dotenv()                              #Load the .env file
+        if self._credentials is None:
+            hostname = hostname or self._get_hostname()
+            port = int(port or os.getenv('REMOTE_PORT', 22))
+            with _SESSIONS_LOCK:
+                cached = _SESSIONS.get((hostname, port)) if self._reuse_session else None
+            if cached is not None and (username is None or username == cached[0]['username']):
+                self._credentials = dict(cached[0])
+            else:
+                key_filename = key_filename or os.getenv('REMOTE_KEY_FILENAME')
+                use_keys = password is None and (key_filename is not None or self._agent_has_keys())
+                self._credentials = {'hostname': hostname,
+                                     'port': port,
+                                     'username': username or self._get_username(),
+                                     'password': password or (None if use_keys else self._get_password()),
+                                     'key_filename': key_filename,
+                                     'passphrase': os.getenv('REMOTE_KEY_PASSPHRASE'),
+                                     'allow_agent': use_keys,
+                                     'look_for_keys': use_keys}
         try:
-            self._ssh.connect(self._get_hostname(), username=self._get_username(), password=self._get_password())
+            self._ssh = self._session()
             print("Succesfuly connected to remote")
         except Exception as e:
             print(f'Error connecting to remote server: {e}')
 
+    def _session(self) -> SSHClient:
+        """The connected client of this handler: the cached session of the host (reconnected if it dropped) or, without
+        reuse_session, its own client"""
+        if not self._reuse_session:
+            return self._ssh if self._is_active(self._ssh) else self._connect_client(self._new_client())
+        key = (self._credentials['hostname'], self._credentials['port'])
+        usable = lambda cached: cached is not None and cached[0]['username'] == self._credentials['username'] and self._is_active(cached[1])
+        with _SESSIONS_LOCK:
+            cached = _SESSIONS.get(key)
+            if usable(cached):
+                return cached[1]
+        #Connect without holding the lock, so a slow connection (or password prompt) does not block other hosts
+        client = self._connect_client(self._new_client())
+        with _SESSIONS_LOCK:
+            cached = _SESSIONS.get(key)
+            if usable(cached):
+                #Another thread connected in the meantime; use its session
+                client.close()
+                return cached[1]
+            _SESSIONS[key] = (dict(self._credentials), client)
+        if cached is not None:
+            cached[1].close()
+        return client
+            
+    def open_client(self) -> SSHClient:
+        """Open an additional connection to the remote, with the credentials of connect_to_remote (no new prompt)"""
+        if self._credentials is None:
+            raise ValueError("No SSH credentials available. Please connect first.")
+        return self._connect_client(self._new_client())
+
     def disconnect_from_remote(self):
-        """Disconnect from the remote server"""
+        """Disconnect from the remote server. A shared session (see reuse_session) stays open for reuse."""
         if self._ssh:
-            self._ssh.close()
+            if not self._reuse_session:
+                self._ssh.close()
+            self._ssh = None
             print("Disconnected from remote")
+
+    @staticmethod
+    def close_sessions() -> None:
+        """Close all cached sessions of the process"""
+        with _SESSIONS_LOCK:
+            for _, client in _SESSIONS.values():
+                client.close()
+            _SESSIONS.clear()
             
     def ensure_remote_dir(self, directory: str):
         #NOTE: fully chatgpt generated....
@@ -84,9 +220,183 @@ class SSHClientHandler(SSHClient):
                 print("Operation aborted by user.")
                 sys.exit(1)  # Exit the program if the user decides not to create the directory
                 
+    def _run_on_paths(self, command: str, paths: List[str], check: bool = False) -> List[str]:
+        """
+        Run a command once with xargs on all paths (sent NUL-separated over stdin) and return its stdout lines.
+        Errors are ignored unless check is True, in which case an exception with the error output is raised.
+        The paths are written on a separate thread while stdout is read, and stderr is drained on another, since the
+        remote stops reading its stdin once the window of an unread output stream is full.
+        """
+        with Instrumentation.span('ssh.run_on_paths', command=command.split()[0], paths=len(paths)):
+            stdin, stdout, stderr = self.ssh.exec_command(f'xargs -0 -r {command}' + ('' if check else ' 2>/dev/null'))
+            write_errors, error_output = [], []
+
+            def write_paths() -> None:
+                try:
+                    stdin.write(b'\0'.join(str(path).encode() for path in paths))
+                    stdin.channel.shutdown_write()
+                except (OSError, EOFError, SSHException) as e:
+                    write_errors.append(e)
+
+            threads = [threading.Thread(target=write_paths, daemon=True),
+                       threading.Thread(target=lambda: error_output.append(stderr.read()), daemon=True)]
+            for thread in threads:
+                thread.start()
+            output = stdout.read().decode()
+            for thread in threads:
+                thread.join()
+            exit_status = stdout.channel.recv_exit_status()      #Missing files make xargs exit non-zero; they are simply not in the output
+        Instrumentation.count('ssh_remote_commands')
+        if write_errors:
+            raise Exception(f"Failed to send the paths to the remote command: {write_errors[0]}")
+        if check and exit_status != 0:
+            raise Exception(f"Remote command failed: {b''.join(error_output).decode().strip()}")
+        return output.splitlines()
+
+    def ensure_remote_dirs(self, directories: Iterable[str]) -> List[str]:
+        """
+        Ensure that all directories exist on the remote server, checking and creating them with a single remote command
+        (instead of a round trip per directory, like ensure_remote_dir). Missing directories are created without asking.
+
+        Args:
+            directories (Iterable[str]): The paths of the directories on the remote server.
+
+        Returns:
+            List[str]: The directories that did not exist and were created.
+        """
+        #Sorted, so parents are checked (and reported as created) before their subdirectories
+        directories = sorted({str(directory) for directory in directories})
+        if not directories:
+            return []
+        script = 'for d; do [ -d "$d" ] || { mkdir -p -- "$d" && printf "%s\\n" "$d"; }; done'
+        return self._run_on_paths(f"sh -c {shlex.quote(script)} sh", directories, check=True)
+
+    def remote_file_sizes(self, paths: List[str]) -> Dict[str, int]:
+        """
+        Sizes of files on the remote server, with a single remote `stat` call for all paths. Symbolic links are
+        followed; directories and other paths that are not regular files are left out.
+
+        Args:
+            paths (List[str]): The paths of the files on the remote server.
+
+        Returns:
+            Dict[str, int]: The size in bytes of every path that is a regular file on the remote.
+        """
+        if not paths:
+            return {}
+        sizes = {}
+        #LC_ALL=C, since the file type (%F) is translated
+        for line in self._run_on_paths("env LC_ALL=C stat -L -c '%s:%F:%n' --", paths):
+            size, _, line = line.partition(':')
+            file_type, _, path = line.partition(':')
+            if file_type in ('regular file', 'regular empty file'):
+                sizes[path] = int(size)
+        return sizes
+
+    def remote_sha256(self, paths: List[str]) -> Dict[str, str]:
+        """
+        sha256 checksums of files on the remote server, with a single remote `sha256sum` call for all paths.
+
+        Args:
+            paths (List[str]): The paths of the files on the remote server.
+
+        Returns:
+            Dict[str, str]: The sha256 hex digest of every path that exists on the remote.
+        """
+        if not paths:
+            return {}
+        checksums = {}
+        for line in self._run_on_paths('sha256sum --', paths):
+            checksum, _, path = line.partition('  ')
+            if checksum.startswith('\\'):
+                #sha256sum escapes file names that contain a backslash or newline
+                checksum, path = checksum[1:], re.sub(r'\\(.)', lambda m: '\n' if m.group(1) == 'n' else m.group(1), path)
+            checksums[path] = checksum
+        return checksums
+
     @property
     def ssh(self) -> SSHClient:
-        """Provides the SSH client instance for use with operations like SCP"""
+        """Provides the SSH client instance for use with operations like SCP; reconnects if the connection dropped"""
         if self._ssh is None:
             raise ValueError("No SSH connection established. Please connect first.")
-        return self._ssh
\ No newline at end of file
+        if not self._is_active(self._ssh):
+            print("Connection to remote lost, reconnecting")
+            self._ssh = self._session()
+        return self._ssh
+
+
+class SSHConnectionPool:
+    """
+    Pool of authenticated connections to the remote of a connected SSHClientHandler, for concurrent transfers.
+    The connection of the handler is the first connection of the pool; the others are opened with its credentials.
+    Every connection gets its own SFTP session, which is opened on first use. A connection that dropped is replaced
+    (with its SFTP session) when it is borrowed, so a long migration survives a lost connection.
+    """
+    def __init__(self, ssh_handler: SSHClientHandler, size: int = 4) -> None:
+        """
+        Args:
+            ssh_handler (SSHClientHandler): A handler that is connected to the remote.
+            size (int): Number of connections in the pool. Defaults to 4.
+        """
+        self._ssh_handler = ssh_handler
+        self._own_clients = [ssh_handler.open_client() for _ in range(max(1, size) - 1)]
+        self._lock = threading.Lock()
+        self._idle = queue.Queue()
+        for client in [ssh_handler.ssh] + self._own_clients:
+            self._idle.put(client)
+        self._sftp_sessions = {}
+        
+    def _replace(self, client: SSHClient) -> SSHClient:
+        """Replace a dropped connection of the pool, and its SFTP session, by a new connection"""
+        print("Connection of the pool lost, reconnecting")
+        sftp = self._sftp_sessions.pop(client, None)
+        if sftp is not None:
+            sftp.close()
+        with self._lock:
+            if client in self._own_clients:
+                self._own_clients.remove(client)
+                client.close()
+        new_client = self._ssh_handler.open_client()
+        with self._lock:
+            self._own_clients.append(new_client)
+        return new_client
+
+    @contextmanager
+    def client(self):
+        """Borrow a connection from the pool; blocks until one is idle"""
+        client = self._idle.get()
+        try:
+            if not SSHClientHandler._is_active(client):
+                client = self._replace(client)
+            yield client
+        finally:
+            #If reconnecting failed, the dropped connection is put back, so the next borrower tries again
+            self._idle.put(client)
+            
+    @contextmanager
+    def sftp(self):
+        """Borrow the SFTP session of a connection from the pool; blocks until one is idle"""
+        with self.client() as client:
+            sftp = self._sftp_sessions.get(client)
+            if sftp is None or sftp.sock.closed:
+                sftp = self._sftp_sessions[client] = client.open_sftp()
+            yield sftp
+            
+    def close(self) -> None:
+        """Close the SFTP sessions and the connections opened by the pool (not the connection of the handler)"""
+        for sftp in self._sftp_sessions.values():
+            sftp.close()
+        self._sftp_sessions.clear()
+        with self._lock:
+            for client in self._own_clients:
+                client.close()
+            self._own_clients.clear()
+            
+    def __enter__(self) -> 'SSHConnectionPool':
+        return self
+    
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+atexit.register(SSHClientHandler.close_sessions)
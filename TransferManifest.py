@@ -0,0 +1,126 @@
+import hashlib
+import os
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+from SSHClientHandler import SSHClientHandler
+
+
+class TransferManifest:
+    """
+    Local journal of migrated files, stored in a SQLite file.
+
+    Every file is recorded (with its size, modification time, sha256 hash if computed, and remote path) as soon as its
+    transfer completes, so the journal tells what already arrived, also when a migration was interrupted. A rerun
+    checks the remote paths of all files with one batched remote stat (and sha256sum) call and skips the files that
+    are already present with the same size (or checksum), so it resumes where the previous run stopped.
+    """
+    def __init__(self, manifest_path: Union[str, Path]) -> None:
+        """
+        Open (or create) the journal file.
+
+        Args:
+            manifest_path (Union[str, Path]): Path of the SQLite journal file.
+        """
+        self._manifest_path = Path(manifest_path)
+        self._lock = threading.Lock()               #Files are recorded from the upload threads of FileMover
+        self._connection = sqlite3.connect(self._manifest_path, check_same_thread=False)
+        self._connection.execute('CREATE TABLE IF NOT EXISTS transfers '
+                                 '(file TEXT PRIMARY KEY, size INTEGER, mtime REAL, sha256 TEXT, remote_path TEXT)')
+        self._entries = {row[0]: row[1:] for row in self._connection.execute('SELECT * FROM transfers')}
+        self._skipped = 0
+
+    @staticmethod
+    def _key(file: Union[str, Path]) -> str:
+        return str(Path(file).resolve())
+
+    @staticmethod
+    def file_sha256(file: Union[str, Path], block_size: int = 1 << 20) -> str:
+        """sha256 hex digest of the contents of a local file"""
+        sha = hashlib.sha256()
+        with open(file, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                sha.update(block)
+        return sha.hexdigest()
+
+    def local_sha256(self, file: Union[str, Path]) -> str:
+        """The sha256 of a local file, taken from the journal if the file did not change (same size and mtime) since"""
+        stat = os.stat(file)
+        entry = self._entries.get(self._key(file))
+        if entry is not None and entry[2] is not None and entry[:2] == (stat.st_size, stat.st_mtime):
+            return entry[2]
+        return self.file_sha256(file)
+
+    def record(self, file: Union[str, Path], remote_path: Union[str, Path], sha256: Optional[str] = None) -> None:
+        """
+        Record a completed transfer and write it to disk immediately.
+
+        Args:
+            file (Union[str, Path]): The local file.
+            remote_path (Union[str, Path]): The path of the file on the remote.
+            sha256 (Optional[str]): The sha256 of the file, if it was computed. Defaults to None.
+        """
+        stat = os.stat(file)
+        entry = (stat.st_size, stat.st_mtime, sha256, str(remote_path))
+        with self._lock, self._connection:
+            self._entries[self._key(file)] = entry
+            self._connection.execute('INSERT OR REPLACE INTO transfers VALUES (?, ?, ?, ?, ?)', (self._key(file), *entry))
+
+    def already_transferred(self,
+                            ssh_handler: SSHClientHandler,
+                            files: List[Path],
+                            remote_paths: List[Optional[str]],
+                            verify: str = 'size') -> List[bool]:
+        """
+        Check which files are already present on the remote, with one batched remote call per check.
+
+        Args:
+            ssh_handler (SSHClientHandler): A handler that is connected to the remote.
+            files (List[Path]): The local files.
+            remote_paths (List[Optional[str]]): The remote path of every file (None if there is none).
+            verify (str): 'size' to skip files with the same size on the remote, or 'sha256' to also compare the checksums.
+            Defaults to 'size'.
+
+        Returns:
+            List[bool]: For every file, whether it is already present on the remote.
+        """
+        if verify not in ('size', 'sha256'):
+            raise ValueError(f"verify must be 'size' or 'sha256', not {verify}")
+        remote_sizes = ssh_handler.remote_file_sizes([path for path in remote_paths if path is not None])
+        present = []
+        for file, remote_path in zip(files, remote_paths):
+            try:
+                present.append(remote_path is not None and remote_sizes.get(str(remote_path)) == os.stat(file).st_size)
+            except OSError:
+                present.append(False)
+
+        if verify == 'sha256' and any(present):
+            remote_hashes = ssh_handler.remote_sha256([str(path) for path, p in zip(remote_paths, present) if p])
+            for i, (file, remote_path) in enumerate(zip(files, remote_paths)):
+                if present[i]:
+                    sha256 = self.local_sha256(file)
+                    present[i] = remote_hashes.get(str(remote_path)) == sha256
+                    if present[i]:
+                        self.record(file, remote_path, sha256)
+        for file, remote_path, p in zip(files, remote_paths, present):
+            #Files that arrived before the journal was used (or before an interruption) are added to the journal
+            if p and verify == 'size' and self._entries.get(self._key(file), (None,) * 4)[3] != str(remote_path):
+                self.record(file, remote_path)
+        self._skipped += sum(present)
+        return present
+
+    def remote_path(self, file: Union[str, Path]) -> Optional[str]:
+        """The remote path of a file that was transferred, or None"""
+        entry = self._entries.get(self._key(file))
+        return None if entry is None else entry[3]
+
+    def close(self) -> None:
+        self._connection.close()
+
+    def stats(self) -> Dict[str, int]:
+        """Return the number of journaled transfers and the number of files skipped because they were already present"""
+        return {'transferred': len(self._entries), 'skipped': self._skipped}
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -1,8 +1,13 @@
 import json
 from dotenv import load_dotenv
 import os
+import numpy as np
 import pandas as pd
-from typing import List
+from pathlib import Path, PurePath
+from typing import Iterable, Iterator, List, Optional, Union
+
+#File suffixes of the supported columnar formats; every other suffix is read and written as CSV
+COLUMNAR_SUFFIXES = {'.parquet': 'parquet', '.pq': 'parquet', '.arrow': 'arrow', '.feather': 'arrow', '.ipc': 'arrow'}
 
 class Utils:
     
@@ -32,5 +37,163 @@ class Utils:
         cols_to_save (list): The columns to save to the CSV file.
         output_csv (str): The path to the output CSV file.
         """
+        if Utils.table_format(output_csv) != 'csv':
+            Utils.write_table(labeldf[cols_to_save], output_csv)
+            return output_csv
         labeldf[cols_to_save].to_csv(output_csv, index=False, sep='\t', lineterminator='\n', header=False)
-        return output_csv
\ No newline at end of file
+        return output_csv
+
+    @staticmethod
+    def table_format(file_path: Union[str, Path]) -> str:
+        """Return the table format of a file based on its suffix: 'parquet', 'arrow' (Arrow IPC / Feather) or 'csv'"""
+        return COLUMNAR_SUFFIXES.get(Path(file_path).suffix.lower(), 'csv')
+
+    @staticmethod
+    def read_table(file_path: Union[str, Path], columns: Optional[List[str]] = None, sep: str = ',') -> pd.DataFrame:
+        """
+        Read a CSV, Parquet or Arrow IPC file into a DataFrame, reading only the given columns.
+        Arrow IPC files are memory-mapped. Dictionary-encoded columns are returned as categoricals.
+
+        Args:
+            file_path (Union[str, Path]): Path of the file; the format follows from the suffix, see table_format.
+            columns (Optional[List[str]]): The columns to read. Defaults to None, meaning all columns.
+            sep (str): Delimiter of a CSV file. Defaults to ','.
+
+        Returns:
+            pd.DataFrame: The table
+        """
+        table_format = Utils.table_format(file_path)
+        if table_format == 'csv':
+            return pd.read_csv(file_path, usecols=columns, sep=sep)
+        import pyarrow as pa
+        if table_format == 'parquet':
+            import pyarrow.parquet as pq
+            return pq.read_table(file_path, columns=columns).to_pandas()
+        with pa.memory_map(str(file_path)) as source:
+            table = pa.ipc.open_file(source).read_all()
+            return (table.select(columns) if columns else table).to_pandas()
+
+    @staticmethod
+    def iter_table_chunks(file_path: Union[str, Path], chunksize: int, columns: Optional[List[str]] = None) -> Iterator[pd.DataFrame]:
+        """
+        Read a CSV, Parquet or Arrow IPC file in chunks of (at most) chunksize rows, reading only the given columns.
+
+        Args:
+            file_path (Union[str, Path]): Path of the file; the format follows from the suffix, see table_format.
+            chunksize (int): Number of rows per chunk. For Arrow IPC files, the record batches of the file are used.
+            columns (Optional[List[str]]): The columns to read. Defaults to None, meaning all columns.
+
+        Yields:
+            pd.DataFrame: The chunks of the table
+        """
+        table_format = Utils.table_format(file_path)
+        if table_format == 'csv':
+            yield from pd.read_csv(file_path, chunksize=chunksize, usecols=columns)
+            return
+        import pyarrow as pa
+        rows = 0
+        if table_format == 'parquet':
+            import pyarrow.parquet as pq
+            batches = pq.ParquetFile(file_path).iter_batches(batch_size=chunksize, columns=columns)
+            for batch in batches:
+                chunk = batch.to_pandas()
+                chunk.index += rows                 #Continue the row index over the chunks, like read_csv does
+                rows += len(chunk)
+                yield chunk
+            return
+        with pa.memory_map(str(file_path)) as source:
+            reader = pa.ipc.open_file(source)
+            for i in range(reader.num_record_batches):
+                batch = reader.get_batch(i)
+                chunk = (batch.select(columns) if columns else batch).to_pandas()
+                chunk.index += rows
+                rows += len(chunk)
+                yield chunk
+
+    @staticmethod
+    def _dictionary_columns(df: pd.DataFrame, max_unique_ratio: float = 0.5) -> List[str]:
+        """String and categorical columns that are repetitive enough to store dictionary-encoded"""
+        columns = []
+        for col in df.columns:
+            if isinstance(df[col].dtype, pd.CategoricalDtype):
+                columns.append(col)
+            elif (pd.api.types.is_string_dtype(df[col]) or df[col].dtype == object) and len(df) > 0:
+                if df[col].nunique() <= max_unique_ratio * len(df):
+                    columns.append(col)
+        return columns
+
+    @staticmethod
+    def _arrow_compatible(df: pd.DataFrame) -> pd.DataFrame:
+        """Decode categoricals (so every chunk is dictionary-encoded the same way) and convert Path objects to strings"""
+        converted = {}
+        for col in df.columns:
+            if isinstance(df[col].dtype, pd.CategoricalDtype):
+                converted[col] = df[col].astype(object)
+            elif df[col].dtype == object and isinstance(df[col].dropna().head(1).tolist()[0] if df[col].notna().any() else None, PurePath):
+                converted[col] = df[col].map(lambda x: x if pd.isna(x) else str(x))
+        return df.assign(**converted) if converted else df
+
+    @staticmethod
+    def write_table(tables: Union[pd.DataFrame, Iterable[pd.DataFrame]],
+                    file_path: Union[str, Path],
+                    index: bool = False,
+                    dictionary_columns: Optional[List[str]] = None) -> Union[str, Path]:
+        """
+        Write a DataFrame, or the chunks of a DataFrame one by one, to a Parquet or Arrow IPC file.
+        Repetitive string columns (e.g. Modality, Series Description) are stored dictionary-encoded.
+
+        Args:
+            tables (Union[pd.DataFrame, Iterable[pd.DataFrame]]): The DataFrame, or an iterable of chunks with the same columns.
+            An empty iterable gives an empty table without columns.
+            file_path (Union[str, Path]): Path of the file; the format follows from the suffix, see table_format.
+            index (bool): Whether to store the index. Defaults to False.
+            dictionary_columns (Optional[List[str]]): The columns to dictionary-encode. Defaults to None, meaning the
+                string columns with at most half as many unique values as rows (in the first chunk).
+
+        Returns:
+            Union[str, Path]: The path to the saved file.
+        """
+        table_format = Utils.table_format(file_path)
+        if table_format == 'csv':
+            raise ValueError(f'write_table writes Parquet or Arrow IPC files, not {file_path}')
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        if isinstance(tables, pd.DataFrame):
+            tables = [tables]
+
+        writer, schema = None, None
+        #Dictionary per dictionary-encoded column, which only grows over the chunks: Arrow IPC files do not allow
+        #replacing a dictionary between record batches, only extending it (delta dictionaries)
+        vocabularies = {}
+        try:
+            for df in tables:
+                if writer is None and dictionary_columns is None:
+                    dictionary_columns = Utils._dictionary_columns(df)
+                df = Utils._arrow_compatible(df)
+                table = pa.Table.from_pandas(df, preserve_index=index)
+                if writer is None:
+                    #Columns that are empty in the first chunk are typed as strings, so later chunks can be cast to the schema
+                    base_schema = pa.schema([field.with_type(pa.string()) if pa.types.is_null(field.type) else field
+                                             for field in table.schema], metadata=table.schema.metadata)
+                table = table.cast(base_schema)
+                for col in dictionary_columns:
+                    vocabulary = vocabularies.setdefault(col, {})
+                    codes, uniques = pd.factorize(df[col])
+                    unique_indices = np.array([vocabulary.setdefault(str(value), len(vocabulary)) for value in uniques], dtype=np.int32)
+                    indices = pa.array(unique_indices[codes] if len(unique_indices) else np.zeros(len(codes), dtype=np.int32), mask=codes < 0)
+                    dictionary = pa.DictionaryArray.from_arrays(indices, pa.array(list(vocabulary), type=pa.string()))
+                    table = table.set_column(table.schema.get_field_index(col), col, dictionary)
+                if writer is None:
+                    schema = table.schema
+                    if table_format == 'parquet':
+                        writer = pq.ParquetWriter(file_path, schema)
+                    else:
+                        writer = pa.ipc.new_file(str(file_path), schema, options=pa.ipc.IpcWriteOptions(emit_dictionary_deltas=True))
+                writer.write_table(table.replace_schema_metadata(schema.metadata))
+        finally:
+            if writer is not None:
+                writer.close()
+        if writer is None:
+            #No chunks at all: still write a (column-less) empty table, so the file can be read back
+            return Utils.write_table(pd.DataFrame(), file_path, index=index, dictionary_columns=[])
+        return file_path
\ No newline at end of file
@@ -1,25 +1,12 @@
-import pandas as pd
-from MetaDataFrameHandler import *
-from Utils import *
-from LabelMapper import *
+import sys
+from PipelineRunner import PipelineRunner
 ###User input
-##Define relevant paths
-metadata_file =  'files/prostate/metadata.csv'    #Csv containig the metadata
-root_source_dicom = '/data/scratch/r393017/data/prostate/dicom_source'    #Root of the dicoms locally   
-root_gpu_cluster = '/data/scratch/r393017/data_for_dds/prostate/test_data'                                      #Remote root we will move the data to 
+##The pipeline (metadata file, filters, local DICOM root, label mapping and encoding) is defined in a YAML/JSON config
+config_file = sys.argv[1] if len(sys.argv) > 1 else 'pipeline.yaml'
 
-metadata = MetaDataFrameHandler(source= metadata_file)              #Initialize an instance of the MetaDataHandler class
-metadata.filter_by_key(col='Modality', key='MR')                    #Only keep the MR modalities 
-metadata.remove_nan(cols=['Series Description'])                    #Remove rows where the series description is NaN
-metadata.add_root_to_path(root=root_source_dicom)                   #Add the (local) root to the file paths so we can access the files
-metadata.save_metadata_csv(headers=True)
-metadata_info = metadata.processed_metadata
-#metadata.move_processed_metadata_files()                           #Move the files to the remote cluster
-
-
-labelMapper = LabelMapper(acronym_dir=Path.cwd() / 'acronyms')                                          #Initialize an instance of the DataLabeler class
-metadata_info['Series Description'] = labelMapper.map_labels(metadata_info['Series Description'])       #Map the labels to our defined labels
-labelMapper.save_unmapped_labels('unmapped_labels.txt')                                                 #Save the unmapped labels to a txt file
+if __name__ == '__main__':
+    metadata_info = PipelineRunner(config_file).run()                   #Only reruns the stages whose inputs or parameters changed
+    #metadata.move_processed_metadata_files()                           #Move the files to the remote cluster
 
 
 
@@ -52,8 +39,7 @@ labelMapper.save_unmapped_labels('unmapped_labels.txt')
 
 # #TODO: add function below to the class, and make this rewrite_label_map a function within that class
 # # So we also feed the class both source_to_str_metadata and target_to_num_metadata
-# #TODO: remove the import of source_to_str_metadata. Instead, read of our result after mapping source_labels to string_labels. Get #of unique labels, 
-# # and create a JSON yourself, containng only the relevant string labels and their corresponding numeric labels
+# #NOTE: the numeric label map is now inferred from the mapped string labels by LabelEncoder (see above)
 
 # labelmetadata = rewrite_label_map(Utils.load_json(source_to_str_metadata), 
 #                                 Utils.load_json(target_to_num_metadata))
@@ -0,0 +1,245 @@
+import os
+import socket
+import subprocess
+import threading
+import paramiko
+from paramiko import SFTPAttributes, SFTPHandle, SFTPServer, SFTPServerInterface, SFTP_OK
+from typing import Optional
+
+
+class _LocalSFTPHandle(SFTPHandle):
+    """SFTP file handle on a local file"""
+    def stat(self):
+        try:
+            return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def chattr(self, attr):
+        return SFTP_OK
+
+
+class _LocalSFTPInterface(SFTPServerInterface):
+    """SFTP server interface that serves the local filesystem (with absolute paths, like a real remote)"""
+    def _path(self, path: str) -> str:
+        return os.path.realpath(self.canonicalize(path))
+
+    def list_folder(self, path):
+        path = self._path(path)
+        try:
+            attributes = []
+            for filename in os.listdir(path):
+                attr = SFTPAttributes.from_stat(os.lstat(os.path.join(path, filename)))
+                attr.filename = filename
+                attributes.append(attr)
+            return attributes
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.stat(self._path(path)))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def lstat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.lstat(self._path(path)))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def open(self, path, flags, attr):
+        path = self._path(path)
+        try:
+            fd = os.open(path, flags | getattr(os, 'O_BINARY', 0), 0o666)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        if flags & os.O_WRONLY:
+            mode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            mode = 'rb'
+        handle = _LocalSFTPHandle(flags)
+        handle.filename = path
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    def remove(self, path):
+        try:
+            os.remove(self._path(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        try:
+            os.rename(self._path(oldpath), self._path(newpath))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def posix_rename(self, oldpath, newpath):
+        return self.rename(oldpath, newpath)
+
+    def mkdir(self, path, attr):
+        try:
+            os.mkdir(self._path(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def rmdir(self, path):
+        try:
+            os.rmdir(self._path(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def chattr(self, path, attr):
+        return SFTP_OK
+
+
+class _LocalServerInterface(paramiko.ServerInterface):
+    """Accepts one username with a password or public key, sessions, the sftp subsystem and exec requests (run with the local shell)"""
+    def __init__(self, username: str, password: str, authorized_key: Optional[paramiko.PKey] = None) -> None:
+        self._username = username
+        self._password = password
+        self._authorized_key = authorized_key
+
+    def get_allowed_auths(self, username):
+        return 'password' if self._authorized_key is None else 'publickey,password'
+
+    def check_auth_publickey(self, username, key):
+        if username == self._username and self._authorized_key is not None and key == self._authorized_key:
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_auth_password(self, username, password):
+        if (username, password) == (self._username, self._password):
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED if kind == 'session' else paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=self._exec, args=(channel, command.decode()), daemon=True).start()
+        return True
+
+    @staticmethod
+    def _exec(channel, command: str) -> None:
+        """Run a command with the local shell, connecting its stdin, stdout and stderr to the channel"""
+        process = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+        def pump_stdin():
+            try:
+                while True:
+                    data = channel.recv(32768)
+                    if not data:
+                        break
+                    process.stdin.write(data)
+            except (OSError, EOFError):
+                pass
+            finally:
+                try:
+                    process.stdin.close()
+                except OSError:
+                    pass
+
+        def pump(stream, send):
+            for data in iter(lambda: stream.read1(32768), b''):
+                send(data)
+
+        threads = [threading.Thread(target=pump_stdin, daemon=True),
+                   threading.Thread(target=pump, args=(process.stdout, channel.sendall), daemon=True),
+                   threading.Thread(target=pump, args=(process.stderr, channel.sendall_stderr), daemon=True)]
+        for thread in threads:
+            thread.start()
+        for thread in threads[1:]:
+            thread.join()
+        channel.send_exit_status(process.wait())
+        channel.close()
+
+
+class LocalSSHServer:
+    """
+    Minimal paramiko-based SSH server on localhost, as a stand-in for the remote server in the tests of the migrations
+    (see FileMover.migrate_files). It serves SFTP and exec requests on the local filesystem, so the "remote" paths are
+    local paths. Exec requests run arbitrary commands with the local shell, so it is only meant for tests.
+
+    Example:
+        with LocalSSHServer() as server:
+            handler = SSHClientHandler(missing_host_key_policy=paramiko.AutoAddPolicy())
+            handler.connect_to_remote(**server.credentials)
+    """
+    def __init__(self, 
+                 username: str = 'user', 
+                 password: str = 'password', 
+                 host: str = '127.0.0.1', 
+                 port: int = 0,
+                 authorized_key: Optional[paramiko.PKey] = None) -> None:
+        """
+        Args:
+            username (str): The username that is accepted.
+            password (str): The password that is accepted.
+            authorized_key (Optional[paramiko.PKey]): A public key that is accepted as well. Defaults to None.
+            host (str): The address to listen on. Defaults to localhost.
+            port (int): The port to listen on. Defaults to 0, meaning a free port.
+        """
+        self._username = username
+        self._password = password
+        self._authorized_key = authorized_key
+        self._host_key = paramiko.RSAKey.generate(2048)
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind((host, port))
+        self._host, self._port = self._socket.getsockname()
+        self._transports = []
+        self._thread: Optional[threading.Thread] = None
+        self._running = False
+
+    def start(self) -> 'LocalSSHServer':
+        """Start accepting connections in a background thread"""
+        self._socket.listen(100)
+        self._running = True
+        self._thread = threading.Thread(target=self._accept, daemon=True)
+        self._thread.start()
+        return self
+
+    def _accept(self) -> None:
+        while self._running:
+            try:
+                connection, _ = self._socket.accept()
+            except OSError:
+                break
+            transport = paramiko.Transport(connection)
+            transport.add_server_key(self._host_key)
+            transport.set_subsystem_handler('sftp', SFTPServer, _LocalSFTPInterface)
+            self._transports.append(transport)
+            try:
+                transport.start_server(server=_LocalServerInterface(self._username, self._password, self._authorized_key))
+            except (paramiko.SSHException, EOFError):
+                continue
+
+    def stop(self) -> None:
+        """Stop accepting connections and close all connections"""
+        self._running = False
+        self._socket.close()
+        for transport in self._transports:
+            transport.close()
+
+    def __enter__(self) -> 'LocalSSHServer':
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+    @property
+    def credentials(self) -> dict:
+        """Keyword arguments for SSHClientHandler.connect_to_remote"""
+        return {'hostname': self._host, 'port': self._port, 'username': self._username, 'password': self._password}
+
+    @property
+    def host_key(self) -> paramiko.PKey:
+        return self._host_key
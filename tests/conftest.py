@@ -0,0 +1,24 @@
+import sys
+from pathlib import Path
+import paramiko
+import pytest
+
+#The modules live flat in the repository root
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from LocalSSHServer import LocalSSHServer
+from SSHClientHandler import SSHClientHandler
+
+
+@pytest.fixture(scope='session')
+def server():
+    with LocalSSHServer() as server:
+        yield server
+
+
+@pytest.fixture
+def ssh_handler(server):
+    handler = SSHClientHandler(missing_host_key_policy=paramiko.AutoAddPolicy(), reuse_session=False)
+    handler.connect_to_remote(**server.credentials)
+    yield handler
+    handler.disconnect_from_remote()
@@ -0,0 +1,183 @@
+import errno
+import os
+import shutil
+import threading
+import pytest
+from FileMover import FileMover
+from TransferManifest import TransferManifest
+
+
+@pytest.fixture
+def series(tmp_path):
+    """Two series directories with files of the same names, like the 1-1.dcm of every TCIA series"""
+    files = []
+    for s in ('s1', 's2'):
+        (tmp_path / 'source' / s).mkdir(parents=True)
+        for i in (1, 2, 3):
+            file = tmp_path / 'source' / s / f'{i}.dcm'
+            file.write_bytes(f'{s}-{i}'.encode() * (100 * i))
+            files.append(file)
+    return files
+
+
+@pytest.fixture
+def target_root(tmp_path):
+    (tmp_path / 'remote').mkdir()
+    return tmp_path / 'remote'
+
+
+def assert_migrated(files, remote_paths, source_root, target_root):
+    assert len(set(remote_paths)) == len(files)
+    for file, remote_path in zip(files, remote_paths):
+        assert str(remote_path) == str(target_root / file.relative_to(source_root))
+        assert remote_path is not None and open(remote_path, 'rb').read() == file.read_bytes()
+
+
+def test_migrate_files_keeps_the_tree(ssh_handler, series, tmp_path, target_root):
+    remote_paths = FileMover(series).migrate_files(target_root, ssh_handler=ssh_handler)
+    assert_migrated(series, remote_paths, tmp_path / 'source', target_root)
+
+
+
+def test_migrate_files_creates_the_remote_root_without_asking(ssh_handler, series, tmp_path, monkeypatch):
+    monkeypatch.setattr('builtins.input', lambda *args: pytest.fail('migrate_files asked for input'))
+    target_root = tmp_path / 'new' / 'remote'
+    remote_paths = FileMover(series).migrate_files(target_root, ssh_handler=ssh_handler)
+    assert_migrated(series, remote_paths, tmp_path / 'source', target_root)
+
+def test_migrate_files_refuses_colliding_remote_paths(ssh_handler, series, target_root):
+    with pytest.raises(ValueError):
+        FileMover(series).migrate_files(target_root, ssh_handler=ssh_handler, keep_tree=False)
+    assert not any(target_root.iterdir())
+
+
+@pytest.mark.parametrize('compression', [None, 'gz', 'zst'])
+def test_migrate_files_bulk(ssh_handler, series, tmp_path, target_root, compression):
+    if compression == 'zst':
+        pytest.importorskip('zstandard')
+        if shutil.which('zstd') is None:
+            pytest.skip('zstd is not installed')
+    remote_paths = FileMover(series).migrate_files(target_root, ssh_handler=ssh_handler, bulk=True, compression=compression)
+    assert_migrated(series, remote_paths, tmp_path / 'source', target_root)
+
+
+@pytest.mark.parametrize('verify', ['size', 'sha256'])
+def test_migrate_files_resumes_with_manifest(ssh_handler, series, tmp_path, target_root, verify):
+    manifest = TransferManifest(tmp_path / 'manifest.sqlite')
+    remote_paths = FileMover(series).migrate_files(target_root, ssh_handler=ssh_handler, manifest=manifest, verify=verify)
+    assert len(manifest) == len(series)
+
+    #An interrupted migration: one file never arrived, and (for sha256) one arrived corrupted with the right size
+    os.remove(remote_paths[0])
+    if verify == 'sha256':
+        with open(remote_paths[1], 'r+b') as file:
+            file.write(b'X')
+    untouched = {path: os.stat(path).st_mtime_ns for path in remote_paths[2:]}
+    resumed_paths = FileMover(series).migrate_files(target_root, ssh_handler=ssh_handler, manifest=manifest, verify=verify)
+    assert_migrated(series, resumed_paths, tmp_path / 'source', target_root)
+    assert {path: os.stat(path).st_mtime_ns for path in untouched} == untouched
+    manifest.close()
+
+
+def run_with_timeout(func, timeout: float):
+    """Run func on a daemon thread, so a deadlock fails the test instead of hanging it"""
+    result = []
+    thread = threading.Thread(target=lambda: result.append(func()), daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), f'no result after {timeout} s'
+    return result[0]
+
+
+def test_remote_commands_on_many_paths(ssh_handler, tmp_path):
+    files = []
+    for i in range(50):
+        files.append(tmp_path / f'{i}.dcm')
+        files[-1].write_bytes(b'x' * i)
+    #Far more output than fits in the channel window, which deadlocked when all paths were written before reading
+    paths = [str(file) for file in files] * 2000 + [str(tmp_path / 'missing' / f'{i:07d}.dcm') for i in range(50000)]
+    sizes = run_with_timeout(lambda: ssh_handler.remote_file_sizes(paths), timeout=60)
+    assert sizes == {str(file): file.stat().st_size for file in files}
+    checksums = run_with_timeout(lambda: ssh_handler.remote_sha256(paths), timeout=60)
+    assert set(checksums) == {str(file) for file in files}
+
+
+def test_ensure_remote_dirs_on_many_directories(ssh_handler, tmp_path):
+    directories = [str(tmp_path / 'created' / str(i)) for i in range(2000)]
+    assert run_with_timeout(lambda: ssh_handler.ensure_remote_dirs(directories), timeout=60) == sorted(directories)
+    assert all(os.path.isdir(directory) for directory in directories)
+
+
+def test_move_files_locally_refuses_colliding_destinations(series, tmp_path):
+    with pytest.raises(ValueError):
+        FileMover(series).move_files_locally(tmp_path / 'moved', keep_tree=False)
+    assert all(file.exists() for file in series) and not (tmp_path / 'moved').exists()
+
+
+def test_move_files_locally_does_not_overwrite(series, tmp_path):
+    (tmp_path / 'moved' / 's1').mkdir(parents=True)
+    (tmp_path / 'moved' / 's1' / '1.dcm').write_bytes(b'existing')
+    file_mover = FileMover(series)
+    new_paths = file_mover.move_files_locally(tmp_path / 'moved', source_root=tmp_path / 'source')
+    assert new_paths[0] is None and isinstance(file_mover.errors[0], FileExistsError)
+    assert (tmp_path / 'moved' / 's1' / '1.dcm').read_bytes() == b'existing' and series[0].exists()
+    assert all(path.exists() for path in new_paths[1:])
+
+
+def test_move_files_locally_across_filesystems(series, tmp_path, monkeypatch):
+    contents = {str(file.relative_to(tmp_path / 'source')): file.read_bytes() for file in series}
+    def rename(*args):
+        raise OSError(errno.EXDEV, 'Invalid cross-device link')
+    monkeypatch.setattr(os, 'rename', rename)
+    #Directories (the series) as well as files
+    sources = [tmp_path / 'source' / 's1', *series[3:]]
+    new_paths = FileMover(sources).move_files_locally(tmp_path / 'moved', source_root=tmp_path / 'source')
+    assert new_paths == [tmp_path / 'moved' / 's1', *(tmp_path / 'moved' / file.relative_to(tmp_path / 'source') for file in series[3:])]
+    assert {str(file.relative_to(tmp_path / 'moved')): file.read_bytes() for file in (tmp_path / 'moved').rglob('*.dcm')} == contents
+    assert not any(source.exists() for source in sources)
+
+
+def test_migrate_files_bulk_sends_directories_and_reports_other_files(ssh_handler, series, tmp_path, target_root):
+    source = tmp_path / 'source'
+    os.mkfifo(source / 'fifo')
+    (source / 's3').mkdir()
+    (source / 's3' / '1.dcm').write_bytes(b's3-1')
+    os.mkfifo(source / 's3' / 'fifo')
+    file_mover = FileMover([source / 's1', source / 'fifo', source / 's3', series[3]])
+    remote_paths = file_mover.migrate_files(target_root, ssh_handler=ssh_handler, bulk=True, source_root=source)
+    assert remote_paths == [target_root / 's1', None, None, target_root / 's2' / '1.dcm']
+    assert [error is None for error in file_mover.errors] == [True, False, False, True]
+    assert sorted(path.relative_to(target_root).as_posix() for path in target_root.rglob('*')) == [
+        's1', 's1/1.dcm', 's1/2.dcm', 's1/3.dcm', 's2', 's2/1.dcm']
+
+
+def test_migrate_files_bulk_survives_a_remote_tar_that_dies(ssh_handler, tmp_path, target_root, monkeypatch):
+    #More than fits in the channel window, so the stream breaks off while the archive is written
+    files = []
+    for i in range(4):
+        files.append(tmp_path / 'source' / f'{i}.dcm')
+        files[-1].parent.mkdir(exist_ok=True)
+        files[-1].write_bytes(os.urandom(4 << 20))
+    monkeypatch.setattr(FileMover, '_TAR_EXTRACT_COMMANDS', {None: 'head -c 100000 > /dev/null; echo died >&2; exit 3'})
+    file_mover = FileMover(files)
+    remote_paths = run_with_timeout(lambda: file_mover.migrate_files(target_root, ssh_handler=ssh_handler, bulk=True), timeout=60)
+    assert remote_paths == [None] * len(files)
+    assert all(isinstance(error, Exception) for error in file_mover.errors)
+    assert 'broke off' in str(file_mover.errors[-1]) and 'died' in str(file_mover.errors[-1])
+
+
+def test_only_regular_files_count_as_transferred(ssh_handler, tmp_path, target_root):
+    files = [tmp_path / 'empty.dcm', tmp_path / 'series']
+    files[0].write_bytes(b'')
+    files[1].mkdir()
+    (target_root / 'empty.dcm').write_bytes(b'')
+    os.mkfifo(target_root / 'fifo.dcm')
+    (target_root / 'series').mkdir()
+    sizes = ssh_handler.remote_file_sizes([str(target_root / name) for name in ('empty.dcm', 'fifo.dcm', 'series')])
+    assert sizes == {str(target_root / 'empty.dcm'): 0}
+
+    manifest = TransferManifest(tmp_path / 'manifest.sqlite')
+    remote_paths = [target_root / 'fifo.dcm', target_root / 'series']
+    assert manifest.already_transferred(ssh_handler, [files[0], files[0]], [target_root / 'empty.dcm', remote_paths[0]]) == [True, False]
+    assert manifest.already_transferred(ssh_handler, files[1:], remote_paths[1:]) == [False]
+    manifest.close()
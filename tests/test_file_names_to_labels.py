@@ -0,0 +1,19 @@
+import pytest
+from Benchmarks import synthetic_label_tree
+from FileNamesToLabels import FileNamesToLabels
+
+
+@pytest.mark.parametrize('directories_per_task', [1, 3, 256])
+def test_scan_matches_a_serial_walk(tmp_path, monkeypatch, directories_per_task):
+    #A single collection folder at the top, as in most downloads
+    synthetic_label_tree(tmp_path / 'collection', n_cases=50)
+    monkeypatch.setattr(FileNamesToLabels, '_DIRECTORIES_PER_TASK', directories_per_task)
+    file_names_to_labels = FileNamesToLabels(tmp_path, 'mha', {'t2w': 't2w', 'adc': 'adc'})
+    index = file_names_to_labels._scan_index(max_workers=4)
+    serial_index, remaining = FileNamesToLabels._walk([str(tmp_path)], file_names_to_labels.file_extensions)
+    assert index == serial_index and remaining == []
+    assert len(index) == 1 + 1 + 5 + 50 and sum(len(entry[1]) for entry in index.values()) == 250
+
+    #A rescan lists only the changed directories, and finds the new files
+    (tmp_path / 'collection' / 'fold0' / '10000' / '10000_1000000_new.mha').touch()
+    assert file_names_to_labels._scan_index(max_workers=4, snapshot=index) == FileNamesToLabels._walk([str(tmp_path)], file_names_to_labels.file_extensions)[0]
@@ -0,0 +1,75 @@
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+import pytest
+from Instrumentation import Instrumentation
+from MetaDataFrameHandler import MetaDataFrameHandler
+
+
+def traced_task(i: int) -> int:
+    with Instrumentation.span('task', i=i):
+        Instrumentation.count('tasks')
+    return os.getpid()
+
+
+@pytest.fixture
+def trace(tmp_path):
+    output = tmp_path / 'trace.json'
+    Instrumentation.reset()
+    Instrumentation.enable(output)
+    yield output
+    Instrumentation.disable()
+    Instrumentation.reset()
+    Instrumentation._output = Instrumentation._pid = None
+
+
+def read_trace(output):
+    with open(output) as file:
+        return json.load(file)
+
+
+@pytest.mark.parametrize('start_method', ['fork', 'spawn'])
+def test_worker_events_are_merged_into_the_trace(trace, start_method, monkeypatch):
+    #Spawned workers import the modules again and are only instrumented through the environment
+    monkeypatch.setenv('DATAMAPPER_TRACE', str(trace))
+    with Instrumentation.span('parent'):
+        context = multiprocessing.get_context(start_method)
+        with ProcessPoolExecutor(max_workers=2, mp_context=context) as executor:
+            worker_pids = set(executor.map(traced_task, range(4)))
+    assert os.getpid() not in worker_pids
+    #The workers left part files and did not write the trace themselves
+    assert not trace.exists() and len(list(trace.parent.glob('trace.json.*.part'))) == len(worker_pids)
+
+    Instrumentation._write_at_exit()
+    events = read_trace(trace)
+    spans = [event for event in events['traceEvents'] if event['ph'] == 'X']
+    assert sorted(event['args']['i'] for event in spans if event['name'] == 'task') == [0, 1, 2, 3]
+    assert {event['pid'] for event in spans if event['name'] == 'task'} == worker_pids
+    assert [event['pid'] for event in spans if event['name'] == 'parent'] == [os.getpid()]
+    assert events['otherData']['counters'] == {'tasks': 4}
+    assert not list(trace.parent.glob('trace.json.*.part'))
+
+
+def test_only_the_enabling_process_writes_at_exit(trace):
+    with Instrumentation.span('parent'):
+        pass
+    Instrumentation._pid = os.getpid() + 1            #As seen from a forked child
+    Instrumentation._write_at_exit()
+    assert not trace.exists()
+    Instrumentation._pid = os.getpid()
+    Instrumentation._write_at_exit()
+    assert trace.exists()
+
+
+def test_rows_filtered_counts_only_row_filters(trace):
+    metadata = MetaDataFrameHandler(source=pd.DataFrame({'path': ['a', 'b', 'c'], 'label': ['t2', 'adc', None]}),
+                                    col_path='path', col_label='label')
+    metadata.add_root_to_path(root='/data')
+    metadata.keep_columns(['path', 'label'])
+    assert 'rows_filtered' not in Instrumentation.counters()
+    metadata.remove_nan()
+    metadata.exclude_by_key(col='label', key='adc')
+    assert Instrumentation.counters()['rows_filtered'] == 2
+    assert sum(event['name'] == 'rows_filtered' for event in Instrumentation.events()) == 2
@@ -0,0 +1,42 @@
+import numpy as np
+import pandas as pd
+import pytest
+from LabelEncoder import LabelEncoder
+
+
+@pytest.mark.parametrize('n_labels, dtype', [(1, np.int8), (128, np.int8), (129, np.int16), (32768, np.int16), (32769, np.int32)])
+def test_code_width(n_labels, dtype):
+    assert LabelEncoder.code_dtype(n_labels) == dtype
+    labels = [f'label_{i:05d}' for i in range(n_labels)]
+    codes = LabelEncoder().encode(labels + [None])
+    assert codes.dtype == dtype and codes.iloc[-1] == -1 and codes.iloc[:-1].tolist() == list(range(n_labels))
+
+
+@pytest.mark.parametrize('categorical', [False, True])
+def test_encode_matches_a_lookup_per_row(categorical):
+    rng = np.random.default_rng(0)
+    labels = pd.Series(rng.choice(['t2', 'adc', 'dwi', None], 1000), index=rng.permutation(1000), name='Series Description')
+    if categorical:
+        labels = labels.astype('category')
+    label_encoder = LabelEncoder()
+    codes = label_encoder.encode(labels)
+    assert label_encoder.label_map == {'adc': 0, 'dwi': 1, 't2': 2}
+    expected = [label_encoder.label_map[label] if isinstance(label, str) else -1 for label in labels]
+    assert codes.tolist() == expected and codes.index.equals(labels.index) and codes.name == labels.name
+    as_list = lambda series: [label if isinstance(label, str) else None for label in series]
+    assert as_list(label_encoder.decode(codes)) == as_list(labels)
+
+
+def test_label_map_is_stable_across_runs(tmp_path):
+    label_map = tmp_path / 'labelmap.json'
+    first = LabelEncoder(label_map)
+    first_codes = first.encode(['t2', 'dwi', 't2'])
+    first.save_label_map(label_map)
+
+    #New labels get the next free codes, whatever their order; known labels keep theirs
+    second = LabelEncoder(label_map)
+    assert second.encode(['adc', 'zoom', 't2', 'dwi']).tolist() == [2, 3, 1, 0]
+    assert first_codes.tolist() == [1, 0, 1]
+    assert LabelEncoder(label_map).encode(['adc'], fit=False).tolist() == [-1]
+    with pytest.raises(ValueError):
+        LabelEncoder({'t2': 0, 'dwi': 2})
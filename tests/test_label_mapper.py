@@ -0,0 +1,64 @@
+import pytest
+from AcronymMatcher import AcronymMatcher
+from Benchmarks import _loop_relative_mapping, synthetic_labels, synthetic_mapping_dict
+from LabelMapper import LabelMapper
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_matcher_matches_substring_loop(seed):
+    mapping_dict = synthetic_mapping_dict(n_modalities=5, n_patterns=300, seed=seed)
+    matcher = AcronymMatcher(mapping_dict)
+    for label in synthetic_labels(mapping_dict, n_labels=2000, seed=seed):
+        assert matcher.match(label) == _loop_relative_mapping(mapping_dict, label)
+
+
+def test_matcher_keeps_the_priority_of_the_substring_loop():
+    #Shared prefixes, a substring of another substring, regex metacharacters and an empty modality
+    mapping_dict = {'t2': ['T2', 't2w'], 
+                    'empty': [], 
+                    'adc': ['ADC', 'apparent diff'], 
+                    'dwi': ['diff', 'dwi', 'b+800'], 
+                    'pwi': ['dce', 'dc.']}
+    matcher = AcronymMatcher(mapping_dict)
+    labels = ['DWI_ADC', 'ep2d_diff_ADC', 'apparent diffusion', 'Diffusion', 'b+800 t2w', 'b800', 'DC.E', 'dcxe',
+              'dc', 'T2_dce', '', 'no match']
+    for label in labels:
+        assert matcher.match(label) == _loop_relative_mapping(mapping_dict, label), label
+
+
+@pytest.fixture
+def acronym_dir(tmp_path):
+    (tmp_path / 'acronyms' / 'relative').mkdir(parents=True)
+    (tmp_path / 'acronyms' / 'relative' / 't2.txt').write_text('t2\n')
+    (tmp_path / 'acronyms' / 'relative' / 'dwi.txt').write_text('diff\n')
+    return tmp_path / 'acronyms'
+
+
+def test_cache_is_reused_while_the_acronyms_are_unchanged(acronym_dir, tmp_path):
+    cache_path = tmp_path / 'cache.sqlite'
+    labels = ['T2 tra', 'ep2d_diff', 'localizer', 'T2 tra']
+    assert LabelMapper(acronym_dir, cache_path).map_labels(labels, save_unmapped=False) == ['t2', 'dwi', None, 't2']
+
+    label_mapper = LabelMapper(acronym_dir, cache_path)
+    assert label_mapper.map_labels(labels, save_unmapped=False) == ['t2', 'dwi', None, 't2']
+    assert label_mapper.cache_stats == {'hits': 3, 'misses': 0, 'size': 3}
+    assert label_mapper.unmapped_labels == ['localizer']
+
+
+@pytest.mark.parametrize('change', ['edit', 'add', 'remove'])
+def test_cache_is_invalidated_when_the_acronyms_change(acronym_dir, tmp_path, change):
+    cache_path = tmp_path / 'cache.sqlite'
+    labels = ['T2 tra', 'ep2d_diff', 'localizer']
+    LabelMapper(acronym_dir, cache_path).map_labels(labels, save_unmapped=False)
+    if change == 'edit':
+        (acronym_dir / 'relative' / 't2.txt').write_text('t2\nlocalizer\n')
+    elif change == 'add':
+        (acronym_dir / 'absolute').mkdir()
+        (acronym_dir / 'absolute' / 'loc.txt').write_text('localizer\n')
+    else:
+        (acronym_dir / 'relative' / 'dwi.txt').unlink()
+
+    label_mapper = LabelMapper(acronym_dir, cache_path)
+    mapped = label_mapper.map_labels(labels, save_unmapped=False)
+    assert mapped == LabelMapper(acronym_dir).map_labels(labels, save_unmapped=False)
+    assert label_mapper.cache_stats == {'hits': 0, 'misses': 3, 'size': 3}
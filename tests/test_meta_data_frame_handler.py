@@ -0,0 +1,175 @@
+import numpy as np
+import pandas as pd
+import pytest
+from MetaDataFrameHandler import MetaDataFrameHandler
+from Utils import Utils
+
+
+@pytest.fixture
+def metadata():
+    rng = np.random.default_rng(0)
+    n = 200
+    return pd.DataFrame({'Series UID': [f'1.2.{i // 4}' for i in range(n)],
+                         'Subject ID': [f'SUB-{i % 7}' for i in range(n)],
+                         'Modality': rng.choice(['MR', 'CT', 'SEG'], n),
+                         'Manufacturer': rng.choice(['SIEMENS', 'GE', 'Philips'], n),
+                         'Series Description': rng.choice(['t2_tse_tra', 'ep2d_diff', 'ADC', None], n),
+                         'File Location': [f'./SUB-{i % 7}/series-{i // 4}' for i in range(n)]})
+
+
+@pytest.fixture
+def metadata_file(metadata, tmp_path):
+    metadata.to_csv(tmp_path / 'metadata.csv', index=False)
+    return tmp_path / 'metadata.csv'
+
+
+def apply_operations(handler: MetaDataFrameHandler) -> MetaDataFrameHandler:
+    handler.filter_by_key(col='Modality', key='MR')
+    handler.remove_nan(cols=['Series Description'])
+    handler.exclude_by_key(col='Manufacturer', key='GE')
+    handler.add_root_to_path(root='/data/dicom')
+    handler.rename_columns(col_dict={'Series Description': 'Label'})
+    handler.keep_columns(cols=['File Location', 'Label', 'Series UID'])
+    return handler
+
+
+@pytest.mark.parametrize('chunksize', [1, 7, 1000])
+def test_streaming_matches_eager(metadata_file, chunksize):
+    eager = apply_operations(MetaDataFrameHandler(source=metadata_file)).processed_metadata
+    streaming = apply_operations(MetaDataFrameHandler(source=metadata_file, chunksize=chunksize))
+    #read_csv infers the dtypes per chunk, so a chunk without labels has a float label column
+    pd.testing.assert_frame_equal(streaming.processed_metadata, eager, check_dtype=False)
+
+
+@pytest.mark.parametrize('suffix', ['.csv', '.parquet'])
+def test_streaming_save_matches_eager(metadata_file, tmp_path, suffix):
+    eager_file = apply_operations(MetaDataFrameHandler(source=metadata_file)).save_metadata_csv(
+        tmp_path / f'eager{suffix}', headers=True)
+    streaming_file = apply_operations(MetaDataFrameHandler(source=metadata_file, chunksize=7)).save_metadata_csv(
+        tmp_path / f'streaming{suffix}', headers=True)
+    if suffix == '.csv':
+        assert streaming_file.read_text() == eager_file.read_text()
+    else:
+        #Whether a column is stored dictionary-encoded depends on the frame (or first chunk) that is written
+        pd.testing.assert_frame_equal(pd.read_parquet(streaming_file).astype(object), pd.read_parquet(eager_file).astype(object))
+
+
+@pytest.mark.parametrize('source', ['file', 'frame'])
+def test_lazy_matches_eager(metadata, metadata_file, source):
+    source = metadata_file if source == 'file' else metadata
+    eager = apply_operations(MetaDataFrameHandler(source=source)).processed_metadata
+    lazy = apply_operations(MetaDataFrameHandler(source=source, lazy=True))
+    pd.testing.assert_frame_equal(lazy.collect(), eager)
+
+
+def test_lazy_plan_fuses_filters_and_reads_only_the_needed_columns(metadata_file, monkeypatch):
+    lazy = apply_operations(MetaDataFrameHandler(source=metadata_file, lazy=True))
+    plan, usecols = lazy.plan
+    assert [name for name, _ in plan] == ['filter_by_masks', 'add_root_to_path', 'rename_columns', 'keep_columns']
+    assert [name for name, _ in plan[0][1]['filters']] == ['filter_by_key', 'remove_nan', 'exclude_by_key']
+    #The kept columns (by their name before the rename) and the columns of the filters
+    assert usecols == ['File Location', 'Manufacturer', 'Modality', 'Series Description', 'Series UID']
+
+    read_columns = []
+    read_table = Utils.read_table
+    def recording_read_table(file_path, columns=None):
+        read_columns.append(columns)
+        return read_table(file_path, columns=columns)
+    monkeypatch.setattr(Utils, 'read_table', recording_read_table)
+    lazy.collect()
+    assert read_columns == [usecols]
+
+
+def test_lazy_plan_reads_all_columns_without_keep_columns(metadata_file):
+    lazy = MetaDataFrameHandler(source=metadata_file, lazy=True)
+    lazy.filter_by_key(col='Modality', key='MR')
+    lazy.rename_columns(col_dict={'Series Description': 'Label'})
+    lazy.remove_nan(cols=['Label'])
+    plan, usecols = lazy.plan
+    assert [name for name, _ in plan] == ['filter_by_masks', 'rename_columns', 'filter_by_masks'] and usecols is None
+    pd.testing.assert_frame_equal(lazy.collect(), MetaDataFrameHandler(source=metadata_file).processed_metadata
+                                  .query("Modality == 'MR'").rename(columns={'Series Description': 'Label'}).dropna(subset=['Label']))
+
+
+@pytest.mark.parametrize('cols', [None, ['Number of Images', 'Modality']])
+def test_processed_metadata_shares_data_until_modified(metadata, cols):
+    handler = MetaDataFrameHandler(source=metadata.assign(**{'Number of Images': np.arange(len(metadata))}))
+    view = handler.view_processed_metadata_columns(cols)
+    assert np.shares_memory(view['Number of Images'].to_numpy(), handler.collect()['Number of Images'].to_numpy())
+
+    view.loc[0, 'Number of Images'] = -1
+    view['Modality'] = 'CT'
+    assert handler.processed_metadata['Number of Images'].iloc[0] == 0
+    pd.testing.assert_series_equal(handler.processed_metadata['Modality'], metadata['Modality'])
+
+
+@pytest.fixture
+def series_metadata():
+    """Series of 1-4 files each, with a label per series; some series have no label and some rows no series UID"""
+    rng = np.random.default_rng(1)
+    rows = []
+    for series in range(120):
+        label = rng.choice(['t2', 'adc', 'dwi', 'pwi', None], p=[0.4, 0.25, 0.2, 0.1, 0.05])
+        rows.extend({'Series UID': f'1.2.{series}', 'Series Description': label, 'File Location': f'./{series}/{i}.dcm'}
+                    for i in range(rng.integers(1, 5)))
+    metadata = pd.DataFrame(rows)
+    metadata.loc[metadata.sample(5, random_state=0).index, 'Series UID'] = None
+    return metadata
+
+
+def units_per_label(df: pd.DataFrame, by_series: bool) -> pd.Series:
+    """The number of units (series, or rows) per label, counted with a plain groupby"""
+    if not by_series:
+        return df.groupby('Series Description').size()
+    #Rows without a series UID are their own unit
+    units = df['Series UID'].fillna(pd.Series([f'row-{i}' for i in range(len(df))], index=df.index))
+    return units.groupby(df['Series Description']).nunique()
+
+
+@pytest.mark.parametrize('by_series', [True, False])
+@pytest.mark.parametrize('test_ratio, test_cap, train_cap', [(0.2, None, None), ({'t2': 0.5, 'pwi': 0.0}, 3, None), (0.3, None, {'t2': 5})])
+def test_stratified_split_matches_the_per_label_counts(series_metadata, by_series, test_ratio, test_cap, train_cap):
+    handler = MetaDataFrameHandler(source=series_metadata)
+    train, test = handler.stratified_split(test_ratio=test_ratio, test_cap=test_cap, train_cap=train_cap, seed=0, by_series=by_series)
+    units = units_per_label(series_metadata, by_series)
+    for label, n_units in units.items():
+        ratio = test_ratio.get(label, 0.2) if isinstance(test_ratio, dict) else test_ratio
+        n_test = min(np.floor(ratio * n_units + 0.5), test_cap if test_cap is not None else np.inf)
+        n_train = min(n_units - n_test, train_cap.get(label, np.inf) if isinstance(train_cap, dict) else np.inf)
+        assert units_per_label(test, by_series).get(label, 0) == n_test
+        assert units_per_label(train, by_series).get(label, 0) == n_train
+    #Disjoint, labelled rows only, series are never split, and the original row order is kept
+    assert not set(train.index) & set(test.index)
+    assert train['Series Description'].notna().all() and test['Series Description'].notna().all()
+    if by_series:
+        assert not set(train['Series UID'].dropna()) & set(test['Series UID'].dropna())
+    assert train.index.is_monotonic_increasing and test.index.is_monotonic_increasing
+
+    again = MetaDataFrameHandler(source=series_metadata).stratified_split(test_ratio=test_ratio, test_cap=test_cap, train_cap=train_cap,
+                                                                            seed=0, by_series=by_series)
+    pd.testing.assert_frame_equal(again[0], train)
+    pd.testing.assert_frame_equal(again[1], test)
+
+
+def test_stratified_split_column(series_metadata):
+    handler = MetaDataFrameHandler(source=series_metadata)
+    train, test = handler.stratified_split(seed=3, col_split='Split')
+    split = handler.processed_metadata['Split']
+    assert list(split[split == 'train'].index) == list(train.index) and list(split[split == 'test'].index) == list(test.index)
+    assert split[series_metadata['Series Description'].isna()].isna().all()
+
+
+@pytest.mark.parametrize('by_series', [True, False])
+@pytest.mark.parametrize('n', [2, {'t2': 3, 'adc': 100}])
+def test_sample_per_label_matches_the_per_label_counts(series_metadata, by_series, n):
+    handler = MetaDataFrameHandler(source=series_metadata)
+    sampled = handler.sample_per_label(n, seed=0, by_series=by_series)
+    units = units_per_label(series_metadata, by_series)
+    expected = {label: min(n.get(label, 0) if isinstance(n, dict) else n, n_units) for label, n_units in units.items()}
+    assert units_per_label(sampled, by_series).to_dict() == {label: count for label, count in expected.items() if count}
+    if by_series:
+        #Whole series are kept
+        kept = series_metadata[series_metadata['Series UID'].isin(sampled['Series UID'].dropna())]
+        assert set(kept.index) <= set(sampled.index)
+    assert sampled.index.is_monotonic_increasing
+    pd.testing.assert_frame_equal(sampled, series_metadata.loc[sampled.index])
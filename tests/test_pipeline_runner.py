@@ -0,0 +1,60 @@
+import re
+import pandas as pd
+import pytest
+from PipelineRunner import PipelineRunner
+
+
+@pytest.fixture
+def config(tmp_path):
+    pd.DataFrame({'File Location': ['s1', 's2', 's3', 's4'],
+                  'Series Description': ['T2 tra', 'ep2d_diff', 'localizer', 'T2 sag'],
+                  'Modality': ['MR', 'MR', 'MR', 'CT'],
+                  'Series UID': ['1', '2', '3', '4']}).to_csv(tmp_path / 'metadata.csv', index=False)
+    (tmp_path / 'acronyms' / 'relative').mkdir(parents=True)
+    (tmp_path / 'acronyms' / 'relative' / 't2.txt').write_text('t2\n')
+    (tmp_path / 'acronyms' / 'relative' / 'dwi.txt').write_text('diff\n')
+    return {'checkpoint_dir': str(tmp_path / 'checkpoints'),
+            'stages': [{'type': 'metadata', 'source': str(tmp_path / 'metadata.csv'),
+                        'operations': [{'filter_by_key': {'col': 'Modality', 'key': 'MR'}},
+                                       {'add_root_to_path': {'root': '/data'}}]},
+                       {'type': 'save', 'path': str(tmp_path / 'metadata_processed.csv')},
+                       {'type': 'map_labels', 'acronym_dir': str(tmp_path / 'acronyms'),
+                        'unmapped_labels': str(tmp_path / 'unmapped_labels.txt')},
+                       {'type': 'encode_labels', 'label_map': str(tmp_path / 'labelmap.json')}]}
+
+
+def run(config, capsys) -> tuple:
+    """Run the pipeline; returns its output and the names of the stages that ran"""
+    df = PipelineRunner(config).run()
+    return df, re.findall(r'^Running stage (\w+)$', capsys.readouterr().out, flags=re.MULTILINE)
+
+
+def test_rerun_skips_the_up_to_date_stages(config, capsys):
+    first, ran = run(config, capsys)
+    assert ran == ['metadata', 'save', 'map_labels', 'encode_labels']
+    assert first['Series Description'].tolist()[:2] == ['t2', 'dwi'] and pd.isna(first['Series Description'].iloc[2])
+    second, ran = run(config, capsys)
+    assert ran == []
+    #The checkpoint is read back from Parquet, which stores the repeated strings as categoricals
+    pd.testing.assert_frame_equal(second.astype(object), first.astype(object))
+
+
+def test_changed_acronym_file_reruns_only_map_labels_and_later_stages(config, tmp_path, capsys):
+    run(config, capsys)
+    (tmp_path / 'acronyms' / 'relative' / 't2.txt').write_text('t2\nlocalizer\n')
+    df, ran = run(config, capsys)
+    assert ran == ['map_labels', 'encode_labels']
+    assert df['Series Description'].tolist() == ['t2', 'dwi', 't2']
+    assert (tmp_path / 'unmapped_labels.txt').read_text() == ''
+
+
+@pytest.mark.parametrize('output, first_to_run', [('metadata_processed.csv', 'save'),
+                                                  ('unmapped_labels.txt', 'map_labels'),
+                                                  ('labelmap.json', 'encode_labels')])
+def test_stage_reruns_when_its_output_file_is_missing(config, tmp_path, capsys, output, first_to_run):
+    run(config, capsys)
+    (tmp_path / output).unlink()
+    _, ran = run(config, capsys)
+    stages = ['metadata', 'save', 'map_labels', 'encode_labels']
+    assert ran == stages[stages.index(first_to_run):]
+    assert (tmp_path / output).is_file()
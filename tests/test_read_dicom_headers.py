@@ -0,0 +1,113 @@
+import pydicom
+import pytest
+from pydicom.datadict import dictionary_description, tag_for_keyword
+from pydicom.uid import ImplicitVRLittleEndian
+import ReadDicomHeaders
+from Benchmarks import synthetic_dicom_tree
+
+#The metadata tags, plus tags after a nested sequence and a requested sequence itself
+TAGS = {**ReadDicomHeaders.METADATA_TAGS, 
+        'Sequence Name': 'SequenceName', 
+        'Instance Number': 'InstanceNumber',
+        'Referenced Image Sequence': 'ReferencedImageSequence'}
+
+
+@pytest.fixture(scope='module')
+def dicom_files(tmp_path_factory):
+    dicom_files = synthetic_dicom_tree(tmp_path_factory.mktemp('dicom'), n_series=4, n_slices=3)
+    #Implicit VR files are read with the pydicom fallback
+    for dicom_file in dicom_files[:2]:
+        ds = pydicom.dcmread(dicom_file)
+        ds.file_meta.TransferSyntaxUID = ImplicitVRLittleEndian
+        ds.save_as(dicom_file, implicit_vr=True, little_endian=True, enforce_file_format=True)
+    return dicom_files
+
+
+@pytest.mark.parametrize('tags', [ReadDicomHeaders.METADATA_TAGS, TAGS])
+def test_fast_reader_matches_read_all_dicom_headers(dicom_files, tags):
+    for dicom_file in dicom_files:
+        all_headers = {header['description']: header['value'] for header in ReadDicomHeaders.read_all_dicom_headers(dicom_file)}
+        expected = {column: all_headers.get(dictionary_description(tag_for_keyword(keyword))) for column, keyword in tags.items()}
+        assert ReadDicomHeaders.read_dicom_tags_fast(dicom_file, tags) == expected
+
+
+def test_fast_reader_matches_read_dicom_tags(dicom_files):
+    for dicom_file in dicom_files:
+        assert ReadDicomHeaders.read_dicom_tags_fast(dicom_file, TAGS) == ReadDicomHeaders.read_dicom_tags(dicom_file, TAGS)
+
+
+def test_fast_reader_does_not_fall_back_for_explicit_vr(dicom_files, monkeypatch):
+    def fallback(*args, **kwargs):
+        raise AssertionError('read_dicom_tags fallback')
+    monkeypatch.setattr(ReadDicomHeaders, 'read_dicom_tags', fallback)
+    row = ReadDicomHeaders.read_dicom_tags_fast(dicom_files[-1])
+    assert row['Modality'] == 'MR' and row['Series Description']
+
+
+@pytest.mark.parametrize('vr, value', [('SV', -2**40), ('UV', 2**40)])
+def test_fast_reader_reads_past_64_bit_integers(dicom_files, tmp_path, monkeypatch, vr, value):
+    #SV and UV elements have a 4 byte length, like OB; a private element between the metadata groups
+    ds = pydicom.dcmread(dicom_files[-1])
+    ds.add_new(0x00090010, 'LO', 'DATAMAPPER')
+    ds.add_new(0x00091001, vr, [value, 1])
+    ds.save_as(tmp_path / 'vr64.dcm', enforce_file_format=True)
+    expected = ReadDicomHeaders.read_dicom_tags(tmp_path / 'vr64.dcm')
+    monkeypatch.setattr(ReadDicomHeaders, 'read_dicom_tags', lambda *args, **kwargs: pytest.fail('read_dicom_tags fallback'))
+    assert ReadDicomHeaders.read_dicom_tags_fast(tmp_path / 'vr64.dcm') == expected
+
+
+def test_fast_reader_handles_character_sets_and_multiple_values(dicom_files, tmp_path):
+    ds = pydicom.dcmread(dicom_files[-1])
+    ds.SeriesDescription = 'Séquence T2\\axiale'
+    ds.save_as(tmp_path / 'latin1.dcm', enforce_file_format=True)
+    assert ReadDicomHeaders.read_dicom_tags_fast(tmp_path / 'latin1.dcm') == ReadDicomHeaders.read_dicom_tags(tmp_path / 'latin1.dcm')
+
+
+def test_scan_dicom_root_fast(dicom_files):
+    dicom_root = dicom_files[0].split('/SYN-')[0]
+    assert ReadDicomHeaders.scan_dicom_root(dicom_root, workers=1, fast=True).equals(ReadDicomHeaders.scan_dicom_root(dicom_root, workers=1))
+
+
+@pytest.fixture
+def series_dir(tmp_path):
+    """One directory of 5 files, of which the middle one belongs to a second series"""
+    dicom_files = synthetic_dicom_tree(tmp_path / 'dicom', n_series=1, n_slices=5)
+    ds = pydicom.dcmread(dicom_files[2])
+    ds.SeriesInstanceUID, ds.SeriesDescription = '1.2.3.4', 'localizer'
+    ds.save_as(dicom_files[2], enforce_file_format=True)
+    return tmp_path / 'dicom', dicom_files
+
+
+@pytest.mark.parametrize('fast', [False, True])
+def test_scan_dicom_root_finds_a_series_in_the_middle_of_a_directory(series_dir, fast):
+    dicom_root, dicom_files = series_dir
+    metadata = ReadDicomHeaders.scan_dicom_root(dicom_root, workers=1, sample_series='uid', fast=fast)
+    assert sorted(metadata['Number of Images']) == [1, 4]
+    assert metadata['Series UID'].is_unique and set(metadata['Series UID']) == {
+        pydicom.dcmread(dicom_files[0]).SeriesInstanceUID, '1.2.3.4'}
+    assert metadata.attrs['skipped_reads'] == 3
+
+    expanded = ReadDicomHeaders.scan_dicom_root(dicom_root, workers=1, sample_series='uid', expand=True, fast=fast)
+    everything = ReadDicomHeaders.scan_dicom_root(dicom_root, workers=1, fast=fast)
+    assert expanded.sort_values('File Location', ignore_index=True).equals(everything)
+
+
+def test_scan_dicom_root_adds_the_series_uid_for_uid_sampling(series_dir):
+    dicom_root, _ = series_dir
+    tags = {'Series Description': 'SeriesDescription'}
+    metadata = ReadDicomHeaders.scan_dicom_root(dicom_root, tags=tags, workers=1, sample_series='uid')
+    assert list(metadata.columns) == ['File Location', 'Series Description', 'Series UID', 'Number of Images']
+    metadata = ReadDicomHeaders.scan_dicom_root(dicom_root, tags=tags, workers=1, sample_series='directory')
+    assert list(metadata.columns) == ['File Location', 'Series Description', 'Number of Images']
+
+
+@pytest.mark.parametrize('sample_series', ['directory', 'uid'])
+def test_scan_dicom_root_samples_the_next_file_if_the_first_is_unreadable(tmp_path, sample_series):
+    dicom_files = synthetic_dicom_tree(tmp_path / 'dicom', n_series=2, n_slices=3)
+    for dicom_file in (dicom_files[0], dicom_files[1]):
+        with open(dicom_file, 'wb') as file:
+            file.write(b'not a DICOM file')
+    metadata = ReadDicomHeaders.scan_dicom_root(tmp_path / 'dicom', workers=1, sample_series=sample_series)
+    assert len(metadata) == 2 and metadata['Series Description'].notna().all()
+    expected = [3, 3] if sample_series == 'directory' else [1, 3]
+    assert sorted(metadata['Number of Images']) == expected
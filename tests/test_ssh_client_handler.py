@@ -0,0 +1,50 @@
+import threading
+import paramiko
+import SSHClientHandler as ssh_client_handler
+from SSHClientHandler import SSHClientHandler, SSHConnectionPool
+
+
+def test_pool_replaces_dropped_connections(ssh_handler, tmp_path):
+    (tmp_path / 'file.dcm').write_bytes(b'x' * 100)
+    with SSHConnectionPool(ssh_handler, size=2) as pool:
+        #Open the SFTP sessions of both connections, then drop both connections
+        with pool.sftp() as first, pool.sftp() as second:
+            clients = [first.get_channel().get_transport(), second.get_channel().get_transport()]
+        for transport in clients:
+            transport.close()
+        for i in range(4):
+            with pool.sftp() as sftp:
+                assert sftp.get_channel().get_transport() not in clients
+                sftp.put(str(tmp_path / 'file.dcm'), str(tmp_path / f'copy-{i}.dcm'))
+        assert all((tmp_path / f'copy-{i}.dcm').read_bytes() == b'x' * 100 for i in range(4))
+        assert len(pool._own_clients) == 2
+    assert not any(SSHClientHandler._is_active(client) for client in pool._own_clients)
+
+
+def test_session_connects_outside_the_lock(server, monkeypatch):
+    connecting, release = threading.Event(), threading.Event()
+    connect_client = SSHClientHandler._connect_client
+    def slow_connect_client(self, client):
+        connecting.set()
+        release.wait(10)
+        return connect_client(self, client)
+    monkeypatch.setattr(SSHClientHandler, '_connect_client', slow_connect_client)
+
+    handler = SSHClientHandler(missing_host_key_policy=paramiko.AutoAddPolicy())
+    thread = threading.Thread(target=handler.connect_to_remote, kwargs=server.credentials)
+    thread.start()
+    try:
+        assert connecting.wait(10)
+        #Other hosts can use the session cache while the connection is being made
+        acquired = ssh_client_handler._SESSIONS_LOCK.acquire(timeout=1)
+        if acquired:
+            ssh_client_handler._SESSIONS_LOCK.release()
+        assert acquired
+    finally:
+        release.set()
+        thread.join()
+    try:
+        assert SSHClientHandler._is_active(handler.ssh)
+        assert ssh_client_handler._SESSIONS[(server.credentials['hostname'], server.credentials['port'])][1] is handler.ssh
+    finally:
+        SSHClientHandler.close_sessions()